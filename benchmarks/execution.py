@@ -0,0 +1,185 @@
+"""Benchmarks of the execution hot path of SubProcessExecution.
+
+The results are written as json, by default to .dev/benchmarks/, so that they can be compared between releases.
+
+Usage: python benchmarks/execution.py [--quick] [--output results.json] [--compare previous.json]
+"""
+import os
+import sys
+
+import argparse
+import json
+import platform
+import statistics
+import subprocess
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import tjpy_subprocess_util  # noqa: E402
+from tjpy_subprocess_util.capture import FullCapture, TailCapture  # noqa: E402
+from tjpy_subprocess_util.exception import SubProcessExecutionException  # noqa: E402
+from tjpy_subprocess_util.execution import SubProcessExecution  # noqa: E402
+
+_project_directory = Path(__file__).resolve().parent.parent
+
+
+def _latency_summary(durations_seconds: List[float]) -> Dict[str, float]:
+    durations_microseconds = sorted(duration * 1_000_000 for duration in durations_seconds)
+    return {
+        "iterations": len(durations_microseconds),
+        "mean_us": round(statistics.mean(durations_microseconds), 1),
+        "median_us": round(statistics.median(durations_microseconds), 1),
+        "p95_us": round(durations_microseconds[int(len(durations_microseconds) * 0.95) - 1], 1),
+    }
+
+
+def _measure(function: Callable[[], object], iterations: int) -> List[float]:
+    function()  # warm-up
+    durations = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def _measure_memory(function: Callable[[], object]) -> Dict[str, float]:
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        function()
+        duration = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"seconds": round(duration, 3), "peak_python_heap_mb": round(peak / 1024 / 1024, 1)}
+
+
+def benchmark_call_overhead(iterations: int) -> Dict:
+    bare = _latency_summary(_measure(lambda: subprocess.run(["true"], stdout=subprocess.PIPE,
+                                                            stderr=subprocess.PIPE, encoding="utf-8"), iterations))
+    execute = _latency_summary(_measure(lambda: SubProcessExecution.execute(["true"]), iterations))
+    captured = _latency_summary(_measure(lambda: SubProcessExecution.execute(["true"], capture=FullCapture()),
+                                         iterations))
+    return {
+        "subprocess_run": bare,
+        "execute": execute,
+        "execute_full_capture": captured,
+        "execute_overhead_us": round(execute["median_us"] - bare["median_us"], 1),
+    }
+
+
+def benchmark_tiny_command_throughput(commands: int) -> Dict:
+    args_list = [["true"]] * commands
+    start = time.perf_counter()
+    for args in args_list:
+        SubProcessExecution.execute(args)
+    serial_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    SubProcessExecution.execute_many(args_list)
+    parallel_seconds = time.perf_counter() - start
+    return {
+        "commands": commands,
+        "serial_commands_per_second": round(commands / serial_seconds, 1),
+        "execute_many_commands_per_second": round(commands / parallel_seconds, 1),
+    }
+
+
+def benchmark_large_output(megabytes: int) -> Dict:
+    # stdout and stderr both get the given amount of output
+    args = ["sh", "-c", f"head -c {megabytes * 1024 * 1024} /dev/zero | tr '\\0' 'x'; "
+                        f"head -c {megabytes * 1024 * 1024} /dev/zero | tr '\\0' 'y' >&2"]
+    return {
+        "megabytes_per_stream": megabytes,
+        "execute": _measure_memory(lambda: SubProcessExecution.execute(args)),
+        "execute_binary": _measure_memory(lambda: SubProcessExecution.execute(args, binary=True)),
+        "execute_full_capture": _measure_memory(lambda: SubProcessExecution.execute(args, capture=FullCapture())),
+        "execute_tail_capture": _measure_memory(lambda: SubProcessExecution.execute(args, capture=TailCapture())),
+        "stream": _measure_memory(lambda: sum(1 for _ in SubProcessExecution.stream(args, lines=False))),
+    }
+
+
+def benchmark_custom_input(megabytes: int) -> Dict:
+    custom_input = "x" * (megabytes * 1024 * 1024)
+    results = {"megabytes": megabytes}
+    for name, capture in (("execute", None), ("execute_full_capture", FullCapture())):
+        start = time.perf_counter()
+        SubProcessExecution.execute(["sh", "-c", "cat > /dev/null"], custom_input=custom_input, capture=capture)
+        results[f"{name}_megabytes_per_second"] = round(megabytes / (time.perf_counter() - start), 1)
+    return results
+
+
+def benchmark_exception_construction(iterations: int) -> Dict:
+    stdout = "output line\n" * 100_000
+    stderr = "error line\n" * 100_000
+
+    def construct_and_format():
+        return SubProcessExecutionException(["command", "argument"], 1, stdout, stderr).message
+
+    return {"output_characters_per_stream": len(stdout),
+            "construct_and_format": _latency_summary(_measure(construct_and_format, iterations))}
+
+
+def _compare(results: Dict, previous_results: Dict, path: Optional[List[str]] = None) -> None:
+    # prints the relative change of every numeric value present in both results
+    path = path or []
+    for key, value in results.items():
+        previous_value = previous_results.get(key) if isinstance(previous_results, dict) else None
+        if isinstance(value, dict) and isinstance(previous_value, dict):
+            _compare(value, previous_value, path + [key])
+        elif isinstance(value, (int, float)) and isinstance(previous_value, (int, float)) and previous_value != 0:
+            change = (value - previous_value) / previous_value * 100
+            print(f"{'.'.join(path + [key]):<70} {previous_value:>12} -> {value:>12} ({change:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--quick", action="store_true", help="fewer iterations and smaller outputs")
+    parser.add_argument("--output", type=Path, help="json file for the results")
+    parser.add_argument("--compare", type=Path, help="json file of a previous run to compare against")
+    arguments = parser.parse_args()
+
+    scale = 0.1 if arguments.quick else 1
+    benchmarks = {
+        "call_overhead": lambda: benchmark_call_overhead(int(1000 * scale)),
+        "tiny_command_throughput": lambda: benchmark_tiny_command_throughput(int(2000 * scale)),
+        "large_output": lambda: benchmark_large_output(max(int(100 * scale), 1)),
+        "custom_input": lambda: benchmark_custom_input(max(int(200 * scale), 1)),
+        "exception_construction": lambda: benchmark_exception_construction(int(1000 * scale)),
+    }
+    results = {}
+    for name, benchmark in benchmarks.items():
+        print(f"running {name} ...", file=sys.stderr)
+        results[name] = benchmark()
+
+    timestamp = datetime.now()
+    report = {
+        "version": tjpy_subprocess_util.__version__,
+        "timestamp": timestamp.isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "quick": arguments.quick,
+        "results": results,
+    }
+    output = arguments.output
+    if output is None:
+        output = _project_directory.joinpath(".dev", "benchmarks",
+                                             f"execution-{report['version']}-{timestamp:%Y%m%d-%H%M%S}.json")
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2), encoding="utf-8")
+    print(json.dumps(results, indent=2))
+    print(f"results written to {output}", file=sys.stderr)
+
+    if arguments.compare is not None:
+        previous_report = json.loads(arguments.compare.read_text(encoding="utf-8"))
+        _compare(results, previous_report["results"])
+
+
+if __name__ == "__main__":
+    main()
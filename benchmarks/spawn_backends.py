@@ -0,0 +1,73 @@
+"""Spawns per second of the spawn backends depending on the resident memory of the parent process.
+
+Usage: python benchmarks/spawn_backends.py [--rss-mb 0 512 2048] [--duration 2] [--json results.json]
+"""
+import os
+import sys
+
+import argparse
+import json
+import platform
+import time
+from pathlib import Path
+from typing import Dict, List
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from tjpy_subprocess_util.execution import SubProcessExecution  # noqa: E402
+from tjpy_subprocess_util.spawn import SPAWN_BACKEND_POSIX_SPAWN, SPAWN_BACKEND_SUBPROCESS  # noqa: E402
+
+_command = ["true"]
+
+
+def _current_rss_mb() -> float:
+    with open("/proc/self/statm") as statm:
+        resident_pages = int(statm.read().split()[1])
+    return resident_pages * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+
+
+def _spawns_per_second(spawn_backend: str, duration_seconds: float) -> float:
+    spawns = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration_seconds:
+        SubProcessExecution.execute(_command, spawn_backend=spawn_backend)
+        spawns += 1
+    return spawns / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rss-mb", type=int, nargs="+", default=[0, 256, 1024],
+                        help="additional resident memory of the parent process, allocated before measuring")
+    parser.add_argument("--duration", type=float, default=2.0, help="seconds per measurement")
+    parser.add_argument("--json", type=Path, help="write the results to this file")
+    arguments = parser.parse_args()
+
+    backends = [SPAWN_BACKEND_SUBPROCESS, SPAWN_BACKEND_POSIX_SPAWN]
+    results: List[Dict] = []
+    ballast: List[bytes] = []
+    print(f"{'rss (MB)':>10} " + " ".join(f"{backend + ' (1/s)':>18}" for backend in backends))
+    for additional_rss_mb in sorted(arguments.rss_mb):
+        # bytes filled with a non-zero value are actually resident, unlike a zeroed allocation
+        missing_mb = additional_rss_mb - sum(len(part) for part in ballast) // 1024 // 1024
+        if missing_mb > 0:
+            ballast.append(b"\x01" * (missing_mb * 1024 * 1024))
+        rss_mb = _current_rss_mb()
+        row = {"rss_mb": round(rss_mb), "spawns_per_second": {}}
+        for backend in backends:
+            row["spawns_per_second"][backend] = round(_spawns_per_second(backend, arguments.duration), 1)
+        results.append(row)
+        print(f"{row['rss_mb']:>10} " + " ".join(f"{row['spawns_per_second'][backend]:>18}" for backend in backends))
+
+    if arguments.json is not None:
+        arguments.json.write_text(json.dumps({
+            "benchmark": "spawn_backends",
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "command": _command,
+            "results": results,
+        }, indent=2), encoding="utf-8")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,12 @@
+import os
+import sys
+
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def null_stdin(monkeypatch):
+    # pytest replaces stdin with a pseudo file without a file descriptor, which commands inheriting stdin need
+    with open(os.devnull) as stdin:
+        monkeypatch.setattr(sys, "stdin", stdin)
+        yield
@@ -0,0 +1,81 @@
+import asyncio
+import time
+
+import pytest
+
+from tjpy_subprocess_util.async_execution import AsyncSubProcessExecution
+from tjpy_subprocess_util.exception import SubProcessExecutionException, SubProcessStartException
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def test_execute():
+    result = run(AsyncSubProcessExecution.execute(["sh", "-c", "echo out; echo err >&2"]))
+
+    assert (result.exit_code, result.stdout, result.stderr) == (0, "out\n", "err\n")
+
+
+def test_failures():
+    with pytest.raises(SubProcessExecutionException) as exception_info:
+        run(AsyncSubProcessExecution.execute(["sh", "-c", "exit 4"]))
+    assert exception_info.value.exit_code == 4
+
+    with pytest.raises(SubProcessStartException):
+        run(AsyncSubProcessExecution.execute(["tjpy-missing-command"]))
+
+
+def test_custom_input_is_written_while_the_output_is_read():
+    # more than the pipe buffers hold in both directions
+    chunks = (b"x" * 1024 * 1024 for _ in range(8))
+
+    result = run(AsyncSubProcessExecution.execute(["cat"], custom_input=chunks))
+
+    assert len(result.stdout) == 8 * 1024 * 1024
+
+
+def test_text_custom_input():
+    assert run(AsyncSubProcessExecution.execute(["cat"], custom_input="äöü\n")).stdout == "äöü\n"
+
+
+def test_error_of_the_custom_input_is_raised():
+    def failing_input():
+        yield b"partial"
+        raise ValueError("input failed")
+
+    with pytest.raises(ValueError, match="input failed"):
+        run(AsyncSubProcessExecution.execute(["cat"], custom_input=failing_input()))
+
+
+def test_cancelled_execution_kills_the_command():
+    async def cancel_execution():
+        task = asyncio.ensure_future(AsyncSubProcessExecution.execute(["sleep", "10"]))
+        await asyncio.sleep(0.2)
+        task.cancel()
+        await task
+
+    with pytest.raises(asyncio.CancelledError):
+        run(cancel_execution())
+
+
+def test_input_is_produced_outside_of_the_event_loop(tmp_path):
+    marker = tmp_path / "marker"
+
+    def input_after_output():
+        deadline = time.monotonic() + 5
+        while not marker.exists():
+            if time.monotonic() > deadline:
+                raise TimeoutError("the output has not been drained while the input was produced")
+            time.sleep(0.01)
+        yield b"input"
+
+    result = run(AsyncSubProcessExecution.execute(
+        ["sh", "-c", 'head -c 1000000 /dev/zero; touch "$0"; cat', str(marker)], custom_input=input_after_output()))
+
+    assert result.stdout_size_bytes == 1000005
+    assert result.stdout.endswith("input")
@@ -0,0 +1,47 @@
+from tjpy_subprocess_util.cache import ResultCache
+from tjpy_subprocess_util.execution import SubProcessExecution
+
+
+def test_key_covers_the_working_directory(tmp_path):
+    cache = ResultCache()
+    first_directory = tmp_path / "first"
+    second_directory = tmp_path / "second"
+
+    assert cache.key(["ls"], first_directory, None) != cache.key(["ls"], second_directory, None)
+
+
+def test_key_resolves_the_current_directory(tmp_path, monkeypatch):
+    cache = ResultCache()
+    monkeypatch.chdir(tmp_path)
+
+    assert cache.key(["ls"], None, None) == cache.key(["ls"], tmp_path, None)
+
+
+def test_cached_result_is_not_reused_in_another_directory(tmp_path, monkeypatch):
+    cache = ResultCache()
+    for name in ("first", "second"):
+        (tmp_path / name).mkdir()
+        (tmp_path / name / f"{name}.txt").write_text(name)
+
+    monkeypatch.chdir(tmp_path / "first")
+    first_result = SubProcessExecution.execute(["ls"], cache=cache)
+    monkeypatch.chdir(tmp_path / "second")
+    second_result = SubProcessExecution.execute(["ls"], cache=cache)
+
+    assert first_result.stdout == "first.txt\n"
+    assert second_result.stdout == "second.txt\n"
+    assert cache.stats.misses == 2
+
+
+def test_cached_result_is_reused_until_a_dependency_changes(tmp_path):
+    cache = ResultCache()
+    dependency = tmp_path / "input.txt"
+    dependency.write_text("one")
+    args = ["cat", str(dependency)]
+
+    assert SubProcessExecution.execute(args, cache=cache, cache_dependencies=[dependency]).stdout == "one"
+    assert SubProcessExecution.execute(args, cache=cache, cache_dependencies=[dependency]).stdout == "one"
+    dependency.write_text("three")
+
+    assert SubProcessExecution.execute(args, cache=cache, cache_dependencies=[dependency]).stdout == "three"
+    assert cache.stats.hits == 1
@@ -0,0 +1,67 @@
+import pytest
+
+from tjpy_subprocess_util.capture import COMPRESSION_LZMA, COMPRESSION_ZLIB, CompressedCapture, FileCapture, \
+    FullCapture, TailBuffer
+from tjpy_subprocess_util.exception import SubProcessExecutionException
+from tjpy_subprocess_util.execution import SubProcessExecution
+
+
+def test_tail_buffer_counts_all_written_bytes_and_lines():
+    buffer = TailBuffer(4)
+
+    for chunk in (b"ab\n", b"cdef\n", b"g"):
+        buffer.write(chunk)
+
+    assert buffer.getvalue() == b"ef\ng"
+    assert buffer.truncated
+    assert (buffer.stats.total_bytes, buffer.stats.total_lines, buffer.stats.captured_bytes) == (9, 2, 4)
+
+
+def test_binary_result_is_only_decoded_when_the_text_is_accessed():
+    result = SubProcessExecution.execute(["printf", "\\377ok"], binary=True)
+
+    assert result.stdout_bytes == b"\xffok"
+    assert result.stdout_size_bytes == 3
+    with pytest.raises(UnicodeDecodeError):
+        result.stdout
+
+
+def test_followed_output_is_captured_as_well(capsys):
+    result = SubProcessExecution.execute(["echo", "both"], follow_output=True, capture=FullCapture())
+
+    assert result.stdout == "both\n"
+    assert capsys.readouterr().out == "both\n"
+
+
+def test_file_capture_maps_the_output():
+    result = SubProcessExecution.execute(["seq", "1", "100000"], capture=FileCapture())
+
+    assert result.stdout_file is not None
+    with result.stdout_file:
+        assert result.stdout_file.size == result.stdout_size_bytes
+        assert result.stdout_file.count_lines() == 100000
+        assert result.stdout_file.tail(7) == b"\n100000\n"[-7:]
+
+
+@pytest.mark.parametrize("method", [COMPRESSION_ZLIB, COMPRESSION_LZMA])
+def test_compressed_capture(method):
+    result = SubProcessExecution.execute(["seq", "1", "100000"], capture=CompressedCapture(method))
+    expected_output = "".join(f"{number}\n" for number in range(1, 100001))
+
+    assert result.stdout_compressed is not None
+    assert result.stdout_compressed.compressed_size < len(expected_output) // 2
+    assert result.stdout_size_bytes == len(expected_output)
+    assert result.stdout == expected_output
+    assert sum(1 for _ in result.stdout_compressed.lines()) == 100000
+
+
+def test_compressed_output_of_a_failure_is_decompressed_on_access():
+    with pytest.raises(SubProcessExecutionException) as exception_info:
+        SubProcessExecution.execute(["sh", "-c", "echo out; echo err >&2; exit 1"], capture=CompressedCapture())
+
+    assert (exception_info.value.stdout, exception_info.value.stderr) == ("out\n", "err\n")
+
+
+def test_unknown_compression_method_is_rejected():
+    with pytest.raises(ValueError):
+        CompressedCapture("unknown")
@@ -0,0 +1,53 @@
+import pytest
+
+from tjpy_subprocess_util.command import CommandTemplate
+from tjpy_subprocess_util.exception import SubProcessExecutionException, SubProcessOutputLimitException, \
+    SubProcessStartException
+from tjpy_subprocess_util.execution import SubProcessExecution
+from tjpy_subprocess_util.limits import ResourceLimits
+from tjpy_subprocess_util.spawn import SPAWN_BACKEND_POSIX_SPAWN, SPAWN_BACKEND_SUBPROCESS
+
+
+def test_executable_is_resolved_once():
+    template = CommandTemplate(["sh", "-c"])
+
+    assert template.resolved_executable.endswith("/sh")
+    assert template.run("echo $1", "-", "extra").stdout == "extra\n"
+
+
+@pytest.mark.parametrize("spawn_backend", [SPAWN_BACKEND_SUBPROCESS, SPAWN_BACKEND_POSIX_SPAWN])
+def test_command_keeps_the_given_args(spawn_backend):
+    template = CommandTemplate(["sh", "-c"], spawn_backend=spawn_backend)
+
+    assert template.run("echo $0").stdout == "sh\n"
+    with pytest.raises(SubProcessExecutionException) as exception_info:
+        template.run("exit 2")
+    assert exception_info.value.subprocess_args == ["sh", "-c", "exit 2"]
+
+
+def test_missing_executable_can_not_be_started():
+    with pytest.raises(SubProcessStartException) as exception_info:
+        CommandTemplate(["tjpy-missing-command"]).run()
+
+    assert exception_info.value.subprocess_args == ["tjpy-missing-command"]
+
+
+def test_limits_apply_to_every_run():
+    template = CommandTemplate(["yes"], limits=ResourceLimits(output_bytes=4))
+
+    for _ in range(2):
+        with pytest.raises(SubProcessOutputLimitException):
+            template.run()
+
+
+def test_environment_and_limits_are_prepared_once(monkeypatch):
+    template = CommandTemplate(["sh", "-c", "echo $TJPY_VALUE"], environment={"TJPY_VALUE": "value"},
+                               limits=ResourceLimits(nice=1))
+
+    def prepare_again(*_):
+        raise AssertionError("prepared again")
+    monkeypatch.setattr(ResourceLimits, "command_prefix", prepare_again)
+    monkeypatch.setattr(SubProcessExecution, "_merge_environment", prepare_again)
+
+    for _ in range(2):
+        assert template.run().stdout == "value\n"
@@ -0,0 +1,214 @@
+import os
+import signal
+import threading
+import time
+from typing import Generator, cast
+
+import pytest
+
+from tjpy_subprocess_util.capture import TailCapture
+from tjpy_subprocess_util.exception import SubProcessBatchException, SubProcessExecutionException, \
+    SubProcessPipelineException
+from tjpy_subprocess_util.execution import SubProcessExecution
+from tjpy_subprocess_util.reactor import ChildReactor
+from tjpy_subprocess_util.spawn import SPAWN_BACKEND_POSIX_SPAWN
+
+
+def test_execute_many_returns_results_in_input_order():
+    args_list = [["sh", "-c", f"sleep 0.{3 - index}; echo {index}"] for index in range(3)]
+
+    results = SubProcessExecution.execute_many(args_list, max_concurrency=3)
+
+    assert [result.stdout for result in results] == ["0\n", "1\n", "2\n"]
+
+
+def test_execute_many_raises_first_failure_without_starting_further_commands(tmp_path):
+    marker = tmp_path / "marker"
+
+    with pytest.raises(SubProcessExecutionException) as exception_info:
+        SubProcessExecution.execute_many([["sh", "-c", "exit 3"], ["touch", str(marker)]], max_concurrency=1)
+
+    assert exception_info.value.exit_code == 3
+    assert not marker.exists()
+
+
+def test_execute_many_aggregates_failures():
+    with pytest.raises(SubProcessBatchException) as exception_info:
+        SubProcessExecution.execute_many([["true"], ["sh", "-c", "exit 2"], ["echo", "ok"]], max_concurrency=1,
+                                         aggregate_failures=True)
+
+    failures = exception_info.value.failures
+    assert [index for index, _ in failures] == [1]
+    assert isinstance(failures[0][1], SubProcessExecutionException)
+    results = exception_info.value.results
+    assert results is not None
+    assert results[1] is None
+    assert results[2].stdout == "ok\n"
+
+
+def test_execute_many_as_completed_yields_every_index():
+    completed = SubProcessExecution.execute_many_as_completed([["echo", str(index)] for index in range(5)])
+
+    assert sorted(index for index, _ in completed) == list(range(5))
+
+
+def test_stream_kills_the_command_when_stopped_early():
+    lines = cast(Generator[str, None, None],
+                 SubProcessExecution.stream(["sh", "-c", "echo $$; while :; do echo line; done"]))
+    pid = int(next(lines))
+    assert next(lines) == "line\n"
+
+    lines.close()
+
+    # the child has been killed and reaped
+    with pytest.raises(ProcessLookupError):
+        os.kill(pid, 0)
+
+
+def test_stream_yields_lines_including_an_incomplete_last_line():
+    assert list(SubProcessExecution.stream(["printf", "a\\nb\\nc"])) == ["a\n", "b\n", "c"]
+
+
+def test_tail_capture_keeps_the_end_of_the_output_and_counts_everything():
+    result = SubProcessExecution.execute(["sh", "-c", "seq 1 10000"], capture=TailCapture(max_bytes=10))
+
+    assert result.stdout == "\n9999\n10000\n"[-10:]
+    assert result.stdout_stats is not None
+    assert result.stdout_stats.total_bytes == len("".join(f"{number}\n" for number in range(1, 10001)))
+    assert result.stdout_stats.total_lines == 10000
+    assert result.stdout_stats.captured_bytes == 10
+    assert result.stdout_stats.truncated
+
+
+def test_pipeline_stage_killed_by_sigpipe_is_not_a_failure():
+    result = SubProcessExecution.execute_pipeline([["yes"], ["head", "-n", "2"]])
+
+    assert result.stdout == "y\ny\n"
+    assert result.stage_exit_codes == [-signal.SIGPIPE, 0]
+
+
+def test_pipeline_reports_the_failed_stage():
+    with pytest.raises(SubProcessPipelineException) as exception_info:
+        SubProcessExecution.execute_pipeline([["echo", "a"], ["sh", "-c", "cat; exit 4"], ["cat"]])
+
+    assert exception_info.value.stage_index == 1
+    assert exception_info.value.stage_exit_codes == [0, 4, 0]
+
+
+def test_last_pipeline_stage_killed_by_sigpipe_is_a_failure():
+    with pytest.raises(SubProcessPipelineException) as exception_info:
+        SubProcessExecution.execute_pipeline([["echo", "a"], ["sh", "-c", "kill -PIPE $$"]])
+
+    assert exception_info.value.stage_index == 1
+
+
+def test_reactor_supervises_many_commands():
+    args_list = [["sh", "-c", f"echo {index}; exit $(({index} % 10 == 9))"] for index in range(50)]
+
+    with pytest.raises(SubProcessBatchException) as exception_info:
+        SubProcessExecution.execute_many(args_list, reactor=ChildReactor(), max_concurrency=20,
+                                         aggregate_failures=True)
+
+    assert [index for index, _ in exception_info.value.failures] == list(range(9, 50, 10))
+    results = exception_info.value.results
+    assert results is not None
+    assert results[10].stdout == "10\n"
+
+
+def test_reactor_can_not_be_combined_with_followed_output():
+    with pytest.raises(ValueError):
+        SubProcessExecution.execute_many([["true"]], reactor=ChildReactor(), follow_output=True)
+
+
+def test_posix_spawn_backend():
+    result = SubProcessExecution.execute(["sh", "-c", "cat; echo $0"], custom_input="in ",
+                                         spawn_backend=SPAWN_BACKEND_POSIX_SPAWN)
+
+    assert result.stdout == "in sh\n"
+    assert result.execution_stats is not None
+    assert result.execution_stats.spawn_latency_seconds is not None
+
+
+@pytest.mark.parametrize("custom_input", ["text", b"text", [b"te", "xt"], iter([b"t", b"ext"])])
+def test_custom_input_types(custom_input):
+    assert SubProcessExecution.execute(["cat"], custom_input=custom_input).stdout == "text"
+
+
+def test_custom_input_file(tmp_path):
+    input_file = tmp_path / "input"
+    input_file.write_bytes(b"from file")
+
+    assert SubProcessExecution.execute(["cat"], custom_input=input_file).stdout == "from file"
+    with input_file.open("rb") as file:
+        assert SubProcessExecution.execute(["cat"], custom_input=file).stdout == "from file"
+
+
+def wait_for(path, timeout_seconds=5.0):
+    deadline = time.monotonic() + timeout_seconds
+    while not path.exists():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def input_after_output(marker):
+    # the input only follows once the command has written its output, which must be drained in the meantime
+    if not wait_for(marker):
+        raise TimeoutError("the output has not been drained while the input was produced")
+    yield b"input"
+
+
+def test_output_is_drained_while_the_input_is_produced(tmp_path):
+    marker = tmp_path / "marker"
+
+    result = SubProcessExecution.execute(["sh", "-c", 'head -c 1000000 /dev/zero; touch "$0"; cat', str(marker)],
+                                         custom_input=input_after_output(marker))
+
+    assert result.stdout_size_bytes == 1000005
+    assert result.stdout.endswith("input")
+
+
+def test_available_input_of_a_file_object_is_written_right_away(tmp_path):
+    marker = tmp_path / "marker"
+    read_fd, write_fd = os.pipe()
+    os.write(write_fd, b"a")
+    marker_seen = []
+
+    def finish_input():
+        marker_seen.append(wait_for(marker))
+        os.write(write_fd, b"b")
+        os.close(write_fd)
+    finisher = threading.Thread(target=finish_input)
+    finisher.start()
+    with open(read_fd, "rb") as input_file:
+        result = SubProcessExecution.execute(["sh", "-c", 'head -c 1 >/dev/null; touch "$0"; cat', str(marker)],
+                                             custom_input=input_file)
+    finisher.join()
+
+    assert marker_seen == [True]
+    assert result.stdout == "b"
+
+
+@pytest.mark.skipif(not os.path.isdir("/proc/self/fd"), reason="needs /proc")
+def test_posix_spawn_closes_inheritable_file_descriptors():
+    read_fd, write_fd = os.pipe()
+    os.set_inheritable(write_fd, True)
+    try:
+        result = SubProcessExecution.execute(
+            ["sh", "-c", f"[ -e /proc/self/fd/{write_fd} ] && echo open || echo closed"],
+            spawn_backend=SPAWN_BACKEND_POSIX_SPAWN)
+    finally:
+        os.close(read_fd)
+        os.close(write_fd)
+
+    assert result.stdout == "closed\n"
+
+
+def test_execution_stats_contain_the_resource_usage():
+    result = SubProcessExecution.execute(["sh", "-c", "i=0; while [ $i -lt 20000 ]; do i=$((i+1)); done"])
+
+    assert result.execution_stats is not None
+    assert result.execution_stats.duration_seconds > 0
+    assert result.execution_stats.cpu_seconds is not None
+    assert result.execution_stats.max_rss_bytes
@@ -0,0 +1,58 @@
+import time
+
+import pytest
+
+from tjpy_subprocess_util.exception import SubProcessExecutionException, SubProcessStartException
+from tjpy_subprocess_util.execution import SubProcessExecution
+from tjpy_subprocess_util.forkserver import ForkServer
+
+
+@pytest.fixture(scope="module")
+def fork_server():
+    with ForkServer() as started_fork_server:
+        yield started_fork_server
+
+
+def failing_input():
+    yield b"partial input"
+    raise ValueError("input failed")
+
+
+def test_fork_server_executes_commands(fork_server):
+    result = SubProcessExecution.execute(["sh", "-c", "cat; echo error >&2"], custom_input="input",
+                                         fork_server=fork_server)
+
+    assert (result.stdout, result.stderr) == ("input", "error\n")
+
+
+def test_fork_server_reports_failures(fork_server):
+    with pytest.raises(SubProcessExecutionException) as exception_info:
+        SubProcessExecution.execute(["sh", "-c", "exit 3"], fork_server=fork_server)
+    assert exception_info.value.exit_code == 3
+
+    with pytest.raises(SubProcessStartException):
+        SubProcessExecution.execute(["tjpy-missing-command"], fork_server=fork_server)
+
+
+def test_fork_server_drains_the_output_while_the_input_is_produced(fork_server, tmp_path):
+    marker = tmp_path / "marker"
+
+    def input_after_output():
+        deadline = time.monotonic() + 5
+        while not marker.exists():
+            if time.monotonic() > deadline:
+                raise TimeoutError("the output has not been drained while the input was produced")
+            time.sleep(0.01)
+        yield b"input"
+
+    result = SubProcessExecution.execute(["sh", "-c", 'head -c 1000000 /dev/zero; touch "$0"; cat', str(marker)],
+                                         custom_input=input_after_output(), fork_server=fork_server,
+                                         binary=True)
+
+    assert result.stdout_bytes[-5:] == b"input"
+    assert len(result.stdout_bytes) == 1000005
+
+
+def test_fork_server_raises_the_error_of_the_custom_input(fork_server):
+    with pytest.raises(ValueError, match="input failed"):
+        SubProcessExecution.execute(["cat"], custom_input=failing_input(), fork_server=fork_server)
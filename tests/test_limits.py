@@ -0,0 +1,88 @@
+import shutil
+import signal
+
+import pytest
+
+from tjpy_subprocess_util.exception import SubProcessCpuTimeLimitException, SubProcessExecutionException, \
+    SubProcessFileSizeLimitException, SubProcessLimitException, SubProcessOutputLimitException, SubProcessStartException
+from tjpy_subprocess_util.execution import SubProcessExecution
+from tjpy_subprocess_util.instrumentation import ExecutionStats
+from tjpy_subprocess_util.limits import ResourceLimits
+
+
+requires_prlimit = pytest.mark.skipif(shutil.which("prlimit") is None, reason="prlimit is not installed")
+
+
+def failure(exit_code, cpu_seconds=None):
+    execution_stats = ExecutionStats(1.0, None, cpu_seconds, 0.0 if cpu_seconds is not None else None)
+    return SubProcessExecutionException(["command"], exit_code, "out", "err", execution_stats=execution_stats)
+
+
+def test_cpu_time_signal_is_mapped_to_the_cpu_time_limit():
+    limits = ResourceLimits(cpu_seconds=2)
+
+    exception = limits.limit_exception(failure(-signal.SIGXCPU))
+
+    assert isinstance(exception, SubProcessCpuTimeLimitException)
+    assert exception.limit == 2
+    assert (exception.exit_code, exception.stdout, exception.stderr) == (-signal.SIGXCPU, "out", "err")
+
+
+def test_kill_at_the_hard_cpu_time_limit_is_mapped_to_the_cpu_time_limit():
+    limits = ResourceLimits(cpu_seconds=2)
+
+    assert isinstance(limits.limit_exception(failure(-signal.SIGKILL, cpu_seconds=3.0)),
+                      SubProcessCpuTimeLimitException)
+    assert type(limits.limit_exception(failure(-signal.SIGKILL, cpu_seconds=0.5))) is SubProcessExecutionException
+
+
+def test_file_size_signal_reported_by_a_shell_is_mapped_to_the_file_size_limit():
+    limits = ResourceLimits(file_size_bytes=100)
+
+    exception = limits.limit_exception(failure(128 + signal.SIGXFSZ))
+
+    assert isinstance(exception, SubProcessFileSizeLimitException)
+    assert exception.limit == 100
+
+
+def test_exceeded_output_is_mapped_to_the_output_limit():
+    exception = ResourceLimits(output_bytes=10).limit_exception(failure(-signal.SIGKILL), output_limit_exceeded=True)
+
+    assert isinstance(exception, SubProcessOutputLimitException)
+    assert isinstance(exception, SubProcessLimitException)
+
+
+def test_other_failures_are_kept():
+    original_failure = failure(1)
+
+    assert ResourceLimits(cpu_seconds=1, file_size_bytes=1).limit_exception(original_failure) is original_failure
+    # a signal of a limit which has not been set is not a breach of it
+    assert type(ResourceLimits().limit_exception(failure(-signal.SIGXCPU))) is SubProcessExecutionException
+
+
+def test_output_limit_kills_the_command_and_keeps_the_output_up_to_the_limit():
+    with pytest.raises(SubProcessOutputLimitException) as exception_info:
+        SubProcessExecution.execute(["yes"], limits=ResourceLimits(output_bytes=10))
+
+    assert exception_info.value.stdout == "y\n" * 5
+    assert exception_info.value.exit_code == -signal.SIGKILL
+
+
+@requires_prlimit
+def test_file_size_limit(tmp_path):
+    with pytest.raises(SubProcessFileSizeLimitException):
+        SubProcessExecution.execute(["sh", "-c", f"head -c 1000 /dev/zero > {tmp_path / 'file'}"],
+                                    limits=ResourceLimits(file_size_bytes=100))
+
+
+@requires_prlimit
+def test_limited_command_keeps_its_args():
+    result = SubProcessExecution.execute(["sh", "-c", "echo $0; ulimit -n"], limits=ResourceLimits(open_files=50))
+
+    assert result.stdout == "sh\n50\n"
+
+
+@requires_prlimit
+def test_missing_limited_command_can_not_be_started():
+    with pytest.raises(SubProcessStartException):
+        SubProcessExecution.execute(["tjpy-missing-command"], limits=ResourceLimits(open_files=50))
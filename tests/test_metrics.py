@@ -0,0 +1,62 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from tjpy_subprocess_util.exception import SubProcessExecutionException
+from tjpy_subprocess_util.execution import SubProcessExecution
+from tjpy_subprocess_util.instrumentation import ExecutionObservers
+from tjpy_subprocess_util.metrics import MetricsRegistry
+
+
+@pytest.fixture
+def registry():
+    metrics_registry = MetricsRegistry()
+    ExecutionObservers.register(metrics_registry)
+    yield metrics_registry
+    ExecutionObservers.unregister(metrics_registry)
+
+
+def test_executions_are_aggregated_per_command(registry):
+    SubProcessExecution.execute(["printf", "ä\\n"])
+    with pytest.raises(SubProcessExecutionException):
+        SubProcessExecution.execute(["sh", "-c", "echo error >&2; exit 1"])
+
+    snapshot = registry.snapshot()
+
+    assert snapshot["printf"].calls == 1
+    # output is counted in bytes, not in characters
+    assert snapshot["printf"].stdout_bytes == 3
+    assert (snapshot["sh"].calls, snapshot["sh"].failures) == (1, 1)
+    assert 'subprocess_calls_total{command="printf"} 1' in registry.to_prometheus_text()
+
+
+def test_output_size_is_counted_when_the_output_is_read(registry):
+    result = SubProcessExecution.execute(["printf", "a\\r\\n"])
+
+    # the size is the one written by the command, before the line breaks are translated
+    assert result.stdout == "a\n"
+    assert result.stdout_size_bytes == 3
+    assert registry.snapshot()["printf"].stdout_bytes == 3
+
+
+def test_pipelines_and_streamed_executions_are_observed(registry):
+    SubProcessExecution.execute_pipeline([["printf", "a\\nb\\n"], ["cat"]])
+    assert list(SubProcessExecution.stream(["echo", "streamed"])) == ["streamed\n"]
+    assert SubProcessExecution.execute_json(["echo", "[1]"]) == [1]
+    with pytest.raises(SubProcessExecutionException):
+        list(SubProcessExecution.stream_jsonl(["sh", "-c", "echo {}; exit 1"]))
+
+    snapshot = registry.snapshot()
+
+    # a pipeline counts as one execution of its first command
+    assert (snapshot["printf"].calls, snapshot["printf"].stdout_bytes) == (1, 4)
+    assert (snapshot["echo"].calls, snapshot["echo"].stdout_bytes) == (2, 13)
+    assert (snapshot["sh"].calls, snapshot["sh"].failures) == (1, 1)
+
+
+def test_metrics_of_exited_threads_are_kept(registry):
+    for _ in range(3):
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            list(executor.map(lambda _: SubProcessExecution.execute(["true"]), range(4)))
+
+    assert registry.snapshot()["true"].calls == 12
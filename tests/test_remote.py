@@ -0,0 +1,48 @@
+import pytest
+
+from tjpy_subprocess_util.exception import SubProcessAuthenticationException, SubProcessBatchException, \
+    SubProcessStartException
+from tjpy_subprocess_util.remote import RemoteAgent, RemoteExecutor, WorkerAgent
+
+
+@pytest.fixture
+def agent_address(tmp_path):
+    with WorkerAgent(str(tmp_path / "agent.sock"), token="secret") as agent:
+        yield agent.address
+
+
+def failing_input():
+    yield b"partial input"
+    raise ValueError("input failed")
+
+
+def test_remote_executor_executes_commands_on_the_agent(agent_address):
+    executor = RemoteExecutor([RemoteAgent(agent_address, token="secret", max_concurrency=2)])
+
+    results = executor.execute_many([["echo", str(number)] for number in range(4)])
+
+    assert [result.stdout for result in results] == ["0\n", "1\n", "2\n", "3\n"]
+
+
+def test_remote_executor_raises_the_error_of_the_custom_input(agent_address):
+    executor = RemoteExecutor([RemoteAgent(agent_address, token="secret")])
+
+    with pytest.raises(ValueError, match="input failed"):
+        executor.execute(["cat"], custom_input=failing_input())
+
+
+def test_agent_rejects_a_wrong_token(agent_address):
+    executor = RemoteExecutor([RemoteAgent(agent_address, token="wrong")])
+
+    with pytest.raises(SubProcessAuthenticationException):
+        executor.execute(["cat"], custom_input=b"x" * 1024 * 1024)
+
+
+def test_unreachable_agents_are_aggregated_as_start_failures(tmp_path):
+    executor = RemoteExecutor([RemoteAgent(str(tmp_path / "missing.sock"), token="secret")])
+
+    with pytest.raises(SubProcessBatchException) as exception_info:
+        executor.execute_many([["true"], ["true"]], aggregate_failures=True)
+
+    assert [type(failure) for _, failure in exception_info.value.failures] == [SubProcessStartException] * 2
+    assert all(isinstance(failure.__cause__, ConnectionError) for _, failure in exception_info.value.failures)
@@ -0,0 +1,33 @@
+import pytest
+
+from tjpy_subprocess_util.exception import SubProcessScheduleException
+from tjpy_subprocess_util.scheduler import CommandScheduler
+
+
+def test_commands_start_after_their_dependencies(tmp_path):
+    log = tmp_path / "log"
+    scheduler = CommandScheduler(max_concurrency=4)
+    scheduler.add("last", ["sh", "-c", f"echo last >> {log}"], dependencies=["first", "second"])
+    scheduler.add("first", ["sh", "-c", f"sleep 0.1; echo first >> {log}"])
+    scheduler.add("second", ["sh", "-c", f"echo second >> {log}"], dependencies=["first"])
+
+    report = scheduler.run()
+
+    assert log.read_text() == "first\nsecond\nlast\n"
+    assert report.results["last"].exit_code == 0
+    assert report.critical_path == ["first", "second", "last"]
+
+
+def test_commands_depending_on_a_failure_are_skipped():
+    scheduler = CommandScheduler(max_concurrency=2, continue_on_error=True)
+    scheduler.add("failing", ["false"])
+    scheduler.add("dependent", ["true"], dependencies=["failing"])
+    scheduler.add("independent", ["true"])
+
+    with pytest.raises(SubProcessScheduleException) as exception_info:
+        scheduler.run()
+
+    report = exception_info.value.report
+    assert [name for name, _ in exception_info.value.failed_commands] == ["failing"]
+    assert report.skipped == ["dependent"]
+    assert "independent" in report.results
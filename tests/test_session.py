@@ -0,0 +1,70 @@
+import os
+import signal
+import time
+
+import pytest
+
+from tjpy_subprocess_util.exception import SubProcessExecutionException
+from tjpy_subprocess_util.session import DelimiterProtocol, SubProcessSession
+
+
+def test_requests_reuse_the_same_child():
+    with SubProcessSession(["sh"]) as session:
+        first_result = session.execute("echo first; echo error >&2")
+        pid = session.pid
+        second_result = session.execute("echo second")
+
+        assert session.pid == pid
+        assert session.restarts == 0
+    assert (first_result.stdout, first_result.stderr) == ("first\n", "error\n")
+    assert second_result.stdout == "second\n"
+
+
+def test_failed_request_keeps_the_child():
+    with SubProcessSession(["sh"]) as session:
+        with pytest.raises(SubProcessExecutionException) as exception_info:
+            session.execute("false")
+
+        assert exception_info.value.exit_code == 1
+        assert session.execute("echo still there").stdout == "still there\n"
+        assert session.restarts == 0
+
+
+def test_child_exiting_during_a_request_is_restarted():
+    with SubProcessSession(["sh"]) as session:
+        with pytest.raises(SubProcessExecutionException) as exception_info:
+            session.execute("echo partial; exit 5")
+
+        assert exception_info.value.exit_code == 5
+        assert exception_info.value.stdout == "partial\n"
+        assert session.execute("echo back").stdout == "back\n"
+        assert session.restarts == 1
+
+
+def test_child_exiting_between_requests_is_restarted():
+    with SubProcessSession(["sh"]) as session:
+        session.execute("true")
+        pid = session.pid
+        assert pid is not None
+        os.kill(pid, signal.SIGKILL)
+        time.sleep(0.1)
+
+        assert session.execute("echo back").stdout == "back\n"
+        assert session.pid != pid
+        assert session.restarts == 1
+
+
+def test_closed_session_is_started_again_without_counting_a_restart():
+    session = SubProcessSession(["sh"])
+    session.execute("true")
+    session.close()
+
+    assert session.execute("echo again").stdout == "again\n"
+    assert session.restarts == 0
+    session.close()
+
+
+def test_delimiter_protocol():
+    with SubProcessSession(["cat"], protocol=DelimiterProtocol()) as session:
+        assert session.execute("one").stdout == "one"
+        assert session.execute("two").stdout == "two"
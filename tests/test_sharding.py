@@ -0,0 +1,38 @@
+import pytest
+
+from tjpy_subprocess_util.execution import SubProcessExecution
+from tjpy_subprocess_util.sharding import ArgumentSharder
+
+
+def test_shards_pack_the_arguments_up_to_the_limit():
+    environment = {"PATH": "/usr/bin:/bin"}
+    limit = ArgumentSharder.argument_limit(environment)
+    argument = "a" * 1000
+    arguments_per_shard = (limit - ArgumentSharder.argument_size("echo")) // ArgumentSharder.argument_size(argument)
+    argument_count = 2 * arguments_per_shard + 1
+
+    shards = list(ArgumentSharder.shards(["echo"], [argument] * argument_count, environment))
+
+    assert [len(shard) - 1 for shard in shards] == [arguments_per_shard, arguments_per_shard, 1]
+    assert all(shard[0] == "echo" for shard in shards)
+    for shard in shards:
+        assert sum(ArgumentSharder.argument_size(shard_argument) for shard_argument in shard) <= limit
+
+
+def test_shards_respect_max_args_per_shard():
+    shards = list(ArgumentSharder.shards(["echo", "-n"], (str(number) for number in range(5)), max_args_per_shard=2))
+
+    assert shards == [["echo", "-n", "0", "1"], ["echo", "-n", "2", "3"], ["echo", "-n", "4"]]
+
+
+def test_shards_reject_an_argument_which_does_not_fit_into_a_command_line():
+    with pytest.raises(ValueError):
+        list(ArgumentSharder.shards(["echo"], ["a" * (ArgumentSharder.argument_limit() + 1)]))
+
+
+def test_execute_sharded_joins_the_output_in_argument_order():
+    result = SubProcessExecution.execute_sharded(["echo"], (str(number) for number in range(10)),
+                                                 max_args_per_shard=3)
+
+    assert result.shard_argument_counts == [3, 3, 3, 1]
+    assert result.stdout == "0 1 2\n3 4 5\n6 7 8\n9\n"
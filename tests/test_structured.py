@@ -0,0 +1,49 @@
+import json
+
+import pytest
+
+from tjpy_subprocess_util.exception import SubProcessOutputParseException
+from tjpy_subprocess_util.execution import SubProcessExecution
+from tjpy_subprocess_util.structured import JsonDocumentParser, JsonLinesParser
+
+
+def test_json_lines_split_across_chunks():
+    parser = JsonLinesParser()
+    data = '{"name": "ä"}\n\n[1, 2]\n"last"'.encode("utf-8")
+
+    records = []
+    for offset in range(len(data)):
+        records += parser.feed(data[offset:offset + 1])
+    records += parser.finish()
+
+    assert records == [{"name": "ä"}, [1, 2], "last"]
+
+
+def test_json_document_split_across_chunks():
+    document = {"items": [{"id": number, "text": "ü" * number} for number in range(20)], "done": True}
+    data = json.dumps(document, ensure_ascii=False).encode("utf-8")
+    parser = JsonDocumentParser()
+
+    for offset in range(0, len(data), 7):
+        parser.feed(data[offset:offset + 7])
+
+    assert parser.finish() == document
+
+
+def test_json_array_elements_are_parsed_while_split_across_chunks():
+    data = b'[{"a": 1}, 22, "x,]", [3]]'
+    parser = JsonDocumentParser()
+
+    elements = []
+    for offset in range(len(data)):
+        elements += parser.feed(data[offset:offset + 1])
+
+    assert parser.finish() == [{"a": 1}, 22, "x,]", [3]]
+    assert elements == [{"a": 1}, 22, "x,]", [3]]
+
+
+def test_stream_jsonl_raises_parse_exception_with_line_number():
+    with pytest.raises(SubProcessOutputParseException) as exception_info:
+        list(SubProcessExecution.stream_jsonl(["printf", '{"a": 1}\\nnot json\\n']))
+
+    assert exception_info.value.line_number == 2
@@ -0,0 +1,141 @@
+import threading
+
+import pytest
+
+from tjpy_subprocess_util.exception import SubProcessExecutionException
+from tjpy_subprocess_util.execution import SubProcessExecution
+from tjpy_subprocess_util.instrumentation import ExecutionObserver, ExecutionObservers
+from tjpy_subprocess_util.scheduler import CommandScheduler
+from tjpy_subprocess_util.throttle import AdaptiveLimiter
+
+
+class InFlightObserver(ExecutionObserver):
+
+    def __init__(self, limiter: AdaptiveLimiter):
+        self.limiter = limiter
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def on_start(self, args, working_directory):
+        with self._lock:
+            self.max_in_flight = max(self.max_in_flight, self.limiter.in_flight)
+
+
+@pytest.fixture
+def in_flight_observer():
+    observer = InFlightObserver(AdaptiveLimiter(min_limit=1, max_limit=2, initial_limit=2))
+    ExecutionObservers.register(observer)
+    yield observer
+    ExecutionObservers.unregister(observer)
+
+
+def test_shared_limiter_caps_all_callers(in_flight_observer):
+    limiter = in_flight_observer.limiter
+    scheduler = CommandScheduler(limiter=limiter)
+    for index in range(4):
+        scheduler.add(f"command {index}", ["sleep", "0.05"])
+
+    threads = [threading.Thread(target=SubProcessExecution.execute_many,
+                                args=([["sleep", "0.05"]] * 4,), kwargs={"limiter": limiter}) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    scheduler.run()
+    for thread in threads:
+        thread.join()
+
+    assert 1 <= in_flight_observer.max_in_flight <= 2
+    assert limiter.in_flight == 0
+
+
+def test_limiter_slots_are_released_after_failures():
+    limiter = AdaptiveLimiter(min_limit=1, max_limit=2, initial_limit=2)
+
+    with pytest.raises(SubProcessExecutionException):
+        SubProcessExecution.execute_many([["false"], ["true"], ["true"]], limiter=limiter)
+
+    assert limiter.in_flight == 0
+
+
+@pytest.fixture
+def host(monkeypatch):
+    # the measurements of the host, None is a measurement which is not available
+    measurements = {"load_per_cpu": None, "available_memory_ratio": None}
+    monkeypatch.setattr(AdaptiveLimiter, "_load_per_cpu", staticmethod(lambda cpu_count: measurements["load_per_cpu"]))
+    monkeypatch.setattr(AdaptiveLimiter, "_available_memory_ratio",
+                        staticmethod(lambda: measurements["available_memory_ratio"]))
+    return measurements
+
+
+def complete(limiter, latency_seconds, command="command"):
+    limiter.acquire()
+    limiter.release(latency_seconds, command)
+
+
+def test_limiter_decreases_on_load(host):
+    limiter = AdaptiveLimiter(max_limit=16, initial_limit=16, adjust_interval_seconds=0)
+    host["load_per_cpu"] = 2.0
+
+    complete(limiter, 0.01)
+
+    assert limiter.limit == 8
+    assert limiter.decisions[-1].reason == "load"
+    assert limiter.decisions[-1].load_per_cpu == 2.0
+
+
+def test_limiter_decreases_on_low_memory(host):
+    limiter = AdaptiveLimiter(max_limit=16, initial_limit=16, adjust_interval_seconds=0)
+    host["available_memory_ratio"] = 0.05
+
+    complete(limiter, 0.01)
+
+    assert limiter.limit == 8
+    assert limiter.decisions[-1].reason == "memory"
+
+
+def test_limiter_decreases_on_latency_of_the_same_command(host):
+    limiter = AdaptiveLimiter(max_limit=16, initial_limit=16, adjust_interval_seconds=0)
+    for _ in range(4):
+        complete(limiter, 0.01)
+    assert limiter.decisions == []
+
+    for _ in range(16):
+        complete(limiter, 0.1)
+
+    assert limiter.limit == 8
+    decision = limiter.decisions[-1]
+    assert decision.reason == "latency"
+    assert decision.latency_ratio is not None and decision.latency_ratio > 2.0
+
+
+def test_limiter_increases_when_saturated(host):
+    limiter = AdaptiveLimiter(max_limit=4, initial_limit=2, adjust_interval_seconds=0)
+    limiter.acquire()
+    limiter.acquire()
+
+    limiter.release(0.01)
+
+    assert limiter.limit == 3
+    assert limiter.decisions[-1].reason == "saturated"
+    limiter.release(0.01)
+
+
+def test_limiter_ignores_mix_of_fast_and_slow_commands(host):
+    limiter = AdaptiveLimiter(max_limit=16, initial_limit=16, adjust_interval_seconds=0)
+
+    for index in range(100):
+        if index % 10 == 9:
+            complete(limiter, 2.0, "slow")
+        else:
+            complete(limiter, 0.005, "fast")
+
+    assert limiter.limit == 16
+    assert [decision.reason for decision in limiter.decisions] == []
+
+
+def test_limiter_ignores_occasional_slow_runs_of_a_command(host):
+    limiter = AdaptiveLimiter(max_limit=16, initial_limit=16, adjust_interval_seconds=0)
+
+    for index in range(100):
+        complete(limiter, 2.0 if index % 10 == 9 else 0.005)
+
+    assert limiter.limit == 16
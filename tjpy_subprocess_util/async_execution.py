@@ -0,0 +1,127 @@
+import sys
+
+import asyncio
+import logging
+import subprocess
+import time
+from pathlib import Path
+from typing import Any, Dict, IO, List, Mapping, Optional, Union
+
+from tjpy_subprocess_util.exception import SubProcessExecutionException, SubProcessStartException
+from tjpy_subprocess_util.execution import Result, SubProcessExecution
+from tjpy_subprocess_util.instrumentation import ExecutionObservers, ExecutionStats
+from tjpy_subprocess_util.source import CustomInput, InputSource
+
+_logger = logging.getLogger(__name__)
+
+# the input is written in pieces of this size, so the transport never buffers more than one of them
+_INPUT_CHUNK_SIZE = 64 * 1024
+
+
+class AsyncSubProcessExecution:
+
+    @staticmethod
+    async def execute(args: List[str],
+                      check_error_code: bool = True,
+                      follow_output: bool = False,
+                      working_directory: Optional[Path] = None,
+                      logging_level: str = "DEBUG",
+                      custom_input: Optional[CustomInput] = None,
+                      environment: Optional[Dict[str, str]] = None) -> Result:
+        # the custom_input is written chunk by chunk while the output is read, chunks of files and iterables are
+        # produced on the event loop, so they should be quick to produce (e.g. not a slow network stream)
+        SubProcessExecution._log_execute_call(args, working_directory, logging_level)
+        observers = ExecutionObservers.current()
+        ExecutionObservers.notify_start(observers, args, working_directory)
+        try:
+            result = await AsyncSubProcessExecution._execute(args, check_error_code, follow_output, working_directory,
+                                                             custom_input,
+                                                             SubProcessExecution._merge_environment(environment))
+        except (SubProcessExecutionException, SubProcessStartException) as sub_process_exception:
+            ExecutionObservers.notify_failure(observers, args, sub_process_exception)
+            raise
+        ExecutionObservers.notify_complete(observers, args, result)
+        return result
+
+    @staticmethod
+    async def _execute(args: List[str],
+                       check_error_code: bool,
+                       follow_output: bool,
+                       working_directory: Optional[Path],
+                       custom_input: Optional[CustomInput],
+                       environment: Optional[Mapping[str, str]]) -> Result:
+        # the child is reaped by the event loop, so only the timing is available and not the resource usage
+        stdout: Union[None, int, IO[Any]] = sys.stdout if follow_output else subprocess.PIPE
+        stderr: Union[None, int, IO[Any]] = sys.stderr if follow_output else subprocess.PIPE
+        stdin: Union[None, int, IO[Any]] = sys.stdin if custom_input is None else subprocess.PIPE
+        start_time = time.perf_counter()
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *args,
+                cwd=working_directory,
+                stdout=stdout,
+                stderr=stderr,
+                stdin=stdin,
+                env=environment
+            )
+        except (OSError, subprocess.SubprocessError) as sub_process_error:
+            raise SubProcessStartException(list(args)) from sub_process_error
+        spawn_latency_seconds = time.perf_counter() - start_time
+
+        # communicate only reads the output, the input is written concurrently by this task
+        communication = asyncio.ensure_future(process.communicate())
+        try:
+            if custom_input is not None:
+                await AsyncSubProcessExecution._write_input(process, custom_input)
+            stdout_bytes, stderr_bytes = await communication
+        except BaseException:
+            # the child must not outlive the cancelled task or a failing custom input
+            communication.cancel()
+            if process.returncode is None:
+                _logger.debug(f"Killing command {args} because its execution has been cancelled or its input failed.")
+                process.kill()
+                await process.wait()
+            raise
+
+        exit_code = process.returncode
+        assert exit_code is not None
+        execution_stats = ExecutionStats(time.perf_counter() - start_time, spawn_latency_seconds)
+        stdout_text = SubProcessExecution._decode_output(stdout_bytes)
+        stderr_text = SubProcessExecution._decode_output(stderr_bytes)
+        if check_error_code and exit_code != 0:
+            SubProcessExecution._log_failed_command_output(stdout_text, stderr_text, follow_output)
+            raise SubProcessExecutionException(list(args), exit_code, stdout_text, stderr_text,
+                                               execution_stats=execution_stats)
+        return Result(
+            exit_code=exit_code,
+            stdout=stdout_text,
+            stderr=stderr_text,
+            execution_stats=execution_stats,
+            stdout_size=len(stdout_bytes) if stdout_bytes is not None else 0,
+            stderr_size=len(stderr_bytes) if stderr_bytes is not None else 0
+        )
+
+    @staticmethod
+    async def _write_input(process: asyncio.subprocess.Process, custom_input: CustomInput) -> None:
+        assert process.stdin is not None
+        chunks = InputSource.chunks(custom_input)
+        # file objects and iterables might block while producing a chunk, so they are read in the default executor
+        produce_in_executor = not InputSource.is_reusable(custom_input)
+        loop = asyncio.get_event_loop()
+        try:
+            while True:
+                if produce_in_executor:
+                    chunk = await loop.run_in_executor(None, next, chunks, None)
+                else:
+                    chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                chunk_view = memoryview(chunk)
+                for offset in range(0, len(chunk_view), _INPUT_CHUNK_SIZE):
+                    process.stdin.write(chunk_view[offset:offset + _INPUT_CHUNK_SIZE])
+                    await process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            # same as communicate, a command which does not read all of its input is not a failure
+            pass
+        finally:
+            process.stdin.close()
@@ -0,0 +1,211 @@
+import os
+
+import collections
+import hashlib
+import json
+import logging
+import tempfile
+import threading
+from pathlib import Path
+from typing import Any, Iterable, List, Mapping, Optional, Tuple, Union
+
+from tjpy_subprocess_util.capture import OutputStats
+
+_logger = logging.getLogger(__name__)
+
+_HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class CacheStats:
+
+    def __init__(self) -> None:
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    @property
+    def hit_ratio(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups != 0 else 0.0
+
+
+class CachedOutput:
+    # what is kept per cache entry, results are recreated from it for every hit because Result is mutable
+
+    def __init__(self,
+                 exit_code: int,
+                 stdout: bytes,
+                 stderr: bytes,
+                 stdout_stats: Optional[OutputStats],
+                 stderr_stats: Optional[OutputStats]):
+        self.exit_code = exit_code
+        self.stdout = stdout
+        self.stderr = stderr
+        self.stdout_stats = stdout_stats
+        self.stderr_stats = stderr_stats
+
+    @property
+    def size(self) -> int:
+        return len(self.stdout) + len(self.stderr)
+
+
+class ResultCache:
+    # memoizes results of successful commands, keyed on the args, working directory, custom input and the
+    # fingerprints of dependency paths (modification time and size, optionally also the hash of the content)
+    # entries are kept in an in-memory LRU and optionally also persisted in a directory to survive the process
+
+    def __init__(self,
+                 max_entries: int = 1024,
+                 max_bytes: int = 64 * 1024 * 1024,
+                 persistent_directory: Optional[Path] = None,
+                 hash_dependencies: bool = False):
+        if max_entries < 1 or max_bytes < 1:
+            raise ValueError("max_entries and max_bytes must be at least 1")
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._persistent_directory = persistent_directory
+        self._hash_dependencies = hash_dependencies
+        self._entries: "collections.OrderedDict[str, CachedOutput]" = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.stats = CacheStats()
+
+    def key(self,
+            args: List[str],
+            working_directory: Optional[Path],
+            custom_input: Union[None, str, bytes, bytearray, memoryview],
+            dependencies: Optional[Iterable[Path]] = None,
+            environment: Optional[Mapping[str, str]] = None,
+            executable: Optional[str] = None) -> str:
+        # environment is the overlay given to execute, the rest of the environment is not part of the key
+        input_key: Any = custom_input
+        if custom_input is not None and not isinstance(custom_input, str):
+            # binary input is represented by its hash, which also keeps the key small
+            input_key = {"sha256": hashlib.sha256(custom_input).hexdigest()}
+        # the directory the command actually runs in, so the same relative command in another directory is a miss
+        # relative dependencies are resolved the same way, as they refer to other files in another directory
+        key_parts = [
+            list(args),
+            str(Path(working_directory or os.getcwd()).resolve()),
+            input_key,
+            [self._fingerprint(Path(dependency).resolve()) for dependency in dependencies or []],
+        ]
+        if environment is not None:
+            # only added if given, so keys of executions without an environment stay the same
+            key_parts.append(sorted(environment.items()))
+        if executable is not None:
+            key_parts.append({"executable": executable})
+        return hashlib.sha256(json.dumps(key_parts).encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[CachedOutput]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is None and self._persistent_directory is not None:
+            entry = self._load(key)
+            if entry is not None:
+                with self._lock:
+                    self._store_in_memory(key, entry)
+        with self._lock:
+            if entry is None:
+                self.stats.misses += 1
+            else:
+                self.stats.hits += 1
+        return entry
+
+    def put(self, key: str, entry: CachedOutput) -> None:
+        with self._lock:
+            self.stats.stores += 1
+            self._store_in_memory(key, entry)
+        if self._persistent_directory is not None:
+            self._save(key, entry)
+
+    def clear(self) -> None:
+        # only clears the in-memory entries, the persistent directory can simply be deleted
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def _store_in_memory(self, key: str, entry: CachedOutput) -> None:
+        if entry.size > self._max_bytes:
+            return
+        previous_entry = self._entries.pop(key, None)
+        if previous_entry is not None:
+            self._size -= previous_entry.size
+        self._entries[key] = entry
+        self._size += entry.size
+        while len(self._entries) > self._max_entries or self._size > self._max_bytes:
+            _, evicted_entry = self._entries.popitem(last=False)
+            self._size -= evicted_entry.size
+            self.stats.evictions += 1
+
+    def _fingerprint(self, path: Path) -> Tuple[Any, ...]:
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            return str(path), None
+        content_hash = None
+        if self._hash_dependencies and path.is_file():
+            content_hash = hashlib.sha256()
+            with path.open("rb") as file:
+                for chunk in iter(lambda: file.read(_HASH_CHUNK_SIZE), b""):
+                    content_hash.update(chunk)
+        return str(path), stat.st_mtime_ns, stat.st_size, None if content_hash is None else content_hash.hexdigest()
+
+    def _entry_path(self, key: str) -> Path:
+        assert self._persistent_directory is not None
+        return self._persistent_directory.joinpath(key[:2], key)
+
+    def _load(self, key: str) -> Optional[CachedOutput]:
+        # format: json header line, followed by the raw stdout and stderr
+        try:
+            content = self._entry_path(key).read_bytes()
+        except FileNotFoundError:
+            return None
+        try:
+            header_end = content.index(b"\n")
+            header = json.loads(content[:header_end].decode("utf-8"))
+            stdout_end = header_end + 1 + header["stdout_length"]
+            return CachedOutput(header["exit_code"],
+                                content[header_end + 1:stdout_end],
+                                content[stdout_end:],
+                                ResultCache._stats_from_json(header["stdout_stats"]),
+                                ResultCache._stats_from_json(header["stderr_stats"]))
+        except (ValueError, KeyError) as error:
+            _logger.warning(f"Ignoring corrupt entry {key} of the result cache: {error}")
+            return None
+
+    def _save(self, key: str, entry: CachedOutput) -> None:
+        entry_path = self._entry_path(key)
+        entry_path.parent.mkdir(parents=True, exist_ok=True)
+        header = json.dumps({
+            "exit_code": entry.exit_code,
+            "stdout_length": len(entry.stdout),
+            "stdout_stats": ResultCache._stats_to_json(entry.stdout_stats),
+            "stderr_stats": ResultCache._stats_to_json(entry.stderr_stats),
+        }).encode("utf-8")
+        # written to a temporary file first, so concurrent readers never see a partially written entry
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=str(entry_path.parent), prefix=".tmp-")
+        try:
+            with os.fdopen(file_descriptor, "wb") as file:
+                file.write(header + b"\n")
+                file.write(entry.stdout)
+                file.write(entry.stderr)
+            os.replace(temporary_path, str(entry_path))
+        except BaseException:
+            os.unlink(temporary_path)
+            raise
+
+    @staticmethod
+    def _stats_to_json(stats: Optional[OutputStats]) -> Optional[List[int]]:
+        if stats is None:
+            return None
+        return [stats.total_bytes, stats.total_lines, stats.captured_bytes]
+
+    @staticmethod
+    def _stats_from_json(stats: Optional[List[int]]) -> Optional[OutputStats]:
+        if stats is None:
+            return None
+        return OutputStats(*stats)
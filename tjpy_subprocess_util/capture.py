@@ -0,0 +1,329 @@
+import os
+
+import lzma
+import mmap
+import tempfile
+import zlib
+from abc import abstractmethod
+from pathlib import Path
+from typing import Any, IO, Iterator, List, Optional
+
+COMPRESSION_ZLIB = "zlib"
+COMPRESSION_LZMA = "lzma"
+
+
+class OutputStats:
+
+    def __init__(self,
+                 total_bytes: int,
+                 total_lines: int,
+                 captured_bytes: int):
+        self.total_bytes = total_bytes
+        self.total_lines = total_lines
+        self.captured_bytes = captured_bytes
+
+    @property
+    def truncated(self) -> bool:
+        return self.captured_bytes < self.total_bytes
+
+
+class CaptureBuffer:
+    # receives the output of a single stream of a sub-process chunk by chunk
+
+    def __init__(self) -> None:
+        self.total_bytes = 0
+        self.total_lines = 0
+
+    def write(self, data: bytes) -> None:
+        self.total_bytes += len(data)
+        self.total_lines += data.count(b"\n")
+        self._store(data)
+
+    @abstractmethod
+    def _store(self, data: bytes) -> None:
+        pass
+
+    @abstractmethod
+    def getvalue(self) -> bytes:
+        pass
+
+    @property
+    def truncated(self) -> bool:
+        return self.stats.truncated
+
+    @property
+    def stats(self) -> OutputStats:
+        return OutputStats(self.total_bytes, self.total_lines, self._captured_bytes())
+
+    @abstractmethod
+    def _captured_bytes(self) -> int:
+        pass
+
+
+class OutputCapture:
+    # describes how the output streams of a command are captured, a new buffer is created for every stream
+
+    @abstractmethod
+    def create_buffer(self) -> CaptureBuffer:
+        pass
+
+
+class FullBuffer(CaptureBuffer):
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._chunks: List[bytes] = []
+
+    def _store(self, data: bytes) -> None:
+        self._chunks.append(data)
+
+    def getvalue(self) -> bytes:
+        if len(self._chunks) > 1:
+            self._chunks = [b"".join(self._chunks)]
+        return self._chunks[0] if len(self._chunks) != 0 else b""
+
+    def _captured_bytes(self) -> int:
+        return self.total_bytes
+
+
+class FullCapture(OutputCapture):
+
+    def create_buffer(self) -> CaptureBuffer:
+        return FullBuffer()
+
+
+class TailBuffer(CaptureBuffer):
+    # keeps only the last max_bytes bytes of everything written to it, while still counting all written bytes
+
+    def __init__(self, max_bytes: int) -> None:
+        super().__init__()
+        if max_bytes < 1:
+            raise ValueError(f"max_bytes must be at least 1, but was {max_bytes}")
+        self._max_bytes = max_bytes
+        self._buffer = bytearray()
+
+    @property
+    def max_bytes(self) -> int:
+        return self._max_bytes
+
+    def _store(self, data: bytes) -> None:
+        if len(data) >= self._max_bytes:
+            self._buffer = bytearray(data[len(data) - self._max_bytes:])
+        else:
+            self._buffer += data
+            # trimming only when twice the size is reached keeps the cost of trimming amortized constant
+            if len(self._buffer) > 2 * self._max_bytes:
+                del self._buffer[:len(self._buffer) - self._max_bytes]
+
+    def getvalue(self) -> bytes:
+        return bytes(self._buffer[-self._max_bytes:])
+
+    def _captured_bytes(self) -> int:
+        return min(self.total_bytes, self._max_bytes)
+
+
+class TailCapture(OutputCapture):
+    # keeps a fixed memory ceiling per stream, only the last max_bytes bytes are available after the execution
+
+    def __init__(self, max_bytes: int = 64 * 1024) -> None:
+        if max_bytes < 1:
+            raise ValueError(f"max_bytes must be at least 1, but was {max_bytes}")
+        self.max_bytes = max_bytes
+
+    def create_buffer(self) -> CaptureBuffer:
+        return TailBuffer(self.max_bytes)
+
+
+class CompressedOutput:
+    # compressed output of a stream, which is only decompressed when it is accessed
+
+    def __init__(self, method: str, compressed_chunks: List[bytes], raw_size: int):
+        self.method = method
+        self.raw_size = raw_size
+        self._compressed_chunks = compressed_chunks
+
+    @property
+    def compressed_size(self) -> int:
+        return sum(len(chunk) for chunk in self._compressed_chunks)
+
+    @property
+    def compression_ratio(self) -> float:
+        return self.raw_size / self.compressed_size if self.compressed_size != 0 else 1.0
+
+    def chunks(self, max_chunk_bytes: int = 1024 * 1024) -> Iterator[bytes]:
+        # decompresses chunk by chunk, so the complete output never has to be in memory
+        decompressor = CompressedOutput._decompressor(self.method)
+        for compressed_chunk in self._compressed_chunks:
+            pending_input = compressed_chunk
+            while True:
+                data = decompressor.decompress(pending_input, max_chunk_bytes)
+                if len(data) != 0:
+                    yield data
+                if self.method == COMPRESSION_LZMA:
+                    # lzma keeps the input which did not fit into the output itself
+                    if decompressor.needs_input or decompressor.eof:
+                        break
+                    pending_input = b""
+                else:
+                    pending_input = decompressor.unconsumed_tail
+                    if len(pending_input) == 0:
+                        break
+
+    def lines(self) -> Iterator[bytes]:
+        # the lines without their line break
+        incomplete_line = b""
+        for chunk in self.chunks():
+            lines = (incomplete_line + chunk).split(b"\n")
+            incomplete_line = lines.pop()
+            yield from lines
+        if len(incomplete_line) != 0:
+            yield incomplete_line
+
+    def decompress(self) -> bytes:
+        return b"".join(self.chunks())
+
+    def decode(self) -> str:
+        # decoded like the text mode of subprocess, invalid characters are replaced instead of failing
+        return self.decompress().decode("utf-8", errors="replace").replace("\r\n", "\n").replace("\r", "\n")
+
+    @staticmethod
+    def _decompressor(method: str) -> Any:
+        if method == COMPRESSION_LZMA:
+            return lzma.LZMADecompressor()
+        return zlib.decompressobj()
+
+
+class CompressedBuffer(CaptureBuffer):
+    # compresses the output chunk by chunk as it arrives, the compressed chunks are kept in memory
+
+    def __init__(self, method: str, level: int) -> None:
+        super().__init__()
+        self._method = method
+        self._compressor: Any = lzma.LZMACompressor(preset=level) if method == COMPRESSION_LZMA \
+            else zlib.compressobj(level)
+        self._compressed_chunks: List[bytes] = []
+        self._output: Optional[CompressedOutput] = None
+
+    def _store(self, data: bytes) -> None:
+        if self._output is not None:
+            raise ValueError("The output has already been completed")
+        compressed_chunk = self._compressor.compress(data)
+        if len(compressed_chunk) != 0:
+            self._compressed_chunks.append(compressed_chunk)
+
+    def output(self) -> CompressedOutput:
+        # completes the compression, nothing can be written afterwards
+        if self._output is None:
+            self._compressed_chunks.append(self._compressor.flush())
+            self._output = CompressedOutput(self._method, self._compressed_chunks, self.total_bytes)
+        return self._output
+
+    def getvalue(self) -> bytes:
+        return self.output().decompress()
+
+    def _captured_bytes(self) -> int:
+        return self.total_bytes
+
+
+class CompressedCapture(OutputCapture):
+    # captures the complete output, but compressed, for large outputs which are needed in full (e.g. for archiving)
+    # the default levels favor speed, so that compressing keeps up with fast commands
+    # results and exceptions keep the CompressedOutput and only decompress it when the output is accessed
+
+    def __init__(self, method: str = COMPRESSION_ZLIB, level: Optional[int] = None) -> None:
+        if method not in (COMPRESSION_ZLIB, COMPRESSION_LZMA):
+            raise ValueError(f"Unknown compression method {method}")
+        self.method = method
+        self.level = level if level is not None else 1 if method == COMPRESSION_ZLIB else 0
+
+    def create_buffer(self) -> CaptureBuffer:
+        return CompressedBuffer(self.method, self.level)
+
+
+class OutputFile:
+    # output written by the command directly into an anonymous file (a memfd on Linux, otherwise a temporary file)
+    # the content is accessed through a read-only mmap, so even huge outputs never have to be copied into python
+    # the file is gone as soon as it is closed, which also happens when it is garbage collected
+
+    def __init__(self, file: IO[bytes], path: str):
+        self._file = file
+        self._path = path
+        self._mmap: Optional[mmap.mmap] = None
+
+    @staticmethod
+    def create(directory: Optional[Path] = None) -> "OutputFile":
+        if directory is None and hasattr(os, "memfd_create"):
+            fd = os.memfd_create("tjpy_subprocess_util_output")
+            return OutputFile(open(fd, "rb"), f"/proc/{os.getpid()}/fd/{fd}")
+        named_file = tempfile.NamedTemporaryFile(dir=None if directory is None else str(directory),
+                                                 prefix="tjpy_subprocess_util_output_")
+        return OutputFile(named_file, named_file.name)  # type: ignore
+
+    def fileno(self) -> int:
+        return self._file.fileno()
+
+    @property
+    def path(self) -> str:
+        # can be passed to other commands (e.g. grep), but is only valid as long as this file is open
+        return self._path
+
+    @property
+    def size(self) -> int:
+        return os.fstat(self.fileno()).st_size
+
+    def mmap(self) -> Optional[mmap.mmap]:
+        # None for an empty output, which can not be mapped
+        if self._mmap is None and self.size != 0:
+            self._mmap = mmap.mmap(self.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def view(self) -> memoryview:
+        output_mmap = self.mmap()
+        return memoryview(output_mmap) if output_mmap is not None else memoryview(b"")
+
+    def read_bytes(self) -> bytes:
+        return bytes(self.view())
+
+    def tail(self, max_bytes: int) -> bytes:
+        view = self.view()
+        return bytes(view[max(len(view) - max_bytes, 0):])
+
+    def count_lines(self) -> int:
+        output_mmap = self.mmap()
+        if output_mmap is None:
+            return 0
+        chunk_size = 16 * 1024 * 1024
+        return sum(output_mmap[offset:offset + chunk_size].count(b"\n")
+                   for offset in range(0, len(output_mmap), chunk_size))
+
+    def close(self) -> None:
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # views of the mapping are still in use, it is unmapped as soon as they are garbage collected
+                pass
+            self._mmap = None
+        self._file.close()
+
+    def __enter__(self) -> "OutputFile":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+
+class FileCapture(OutputCapture):
+    # stdout is redirected directly into an OutputFile instead of a pipe, so it never passes through this process
+    # stderr is still captured through a pipe, by default fully, the buffers of stderr_capture are used for it
+    # files are created in the given directory instead of memory, e.g. for outputs larger than the available memory
+
+    def __init__(self, directory: Optional[Path] = None, stderr_capture: Optional[OutputCapture] = None) -> None:
+        self.directory = directory
+        self.stderr_capture = stderr_capture or FullCapture()
+
+    def create_buffer(self) -> CaptureBuffer:
+        return self.stderr_capture.create_buffer()
+
+    def create_file(self) -> OutputFile:
+        return OutputFile.create(self.directory)
@@ -0,0 +1,76 @@
+import os
+
+import logging
+import shutil
+from pathlib import Path
+from typing import Dict, List, Mapping, Optional
+
+from tjpy_subprocess_util.capture import OutputCapture
+from tjpy_subprocess_util.execution import Result, SubProcessExecution
+from tjpy_subprocess_util.forkserver import ForkServer
+from tjpy_subprocess_util.limits import ResourceLimits
+from tjpy_subprocess_util.source import CustomInput
+from tjpy_subprocess_util.spawn import SPAWN_BACKEND_SUBPROCESS
+
+
+class CommandTemplate:
+    # prepared command for issuing many executions of the same executable with a low overhead per call
+    # the executable is only resolved in PATH once and then executed by its path, the args of the template stay as
+    # they are, so exceptions, observers and the command itself (as argv[0]) still see the given executable
+    # the resolved executable is kept, so a new template is needed if the executable is moved or replaced in PATH
+    # the environment of the child, the log level and the shims of the limits are also only prepared once, so changes
+    # of the environment of this process, the tools in PATH or the writability of the cgroup need a new template too
+
+    def __init__(self,
+                 args: List[str],
+                 working_directory: Optional[Path] = None,
+                 environment: Optional[Dict[str, str]] = None,
+                 logging_level: str = "DEBUG",
+                 check_error_code: bool = True,
+                 capture: Optional[OutputCapture] = None,
+                 binary: bool = False,
+                 spawn_backend: str = SPAWN_BACKEND_SUBPROCESS,
+                 fork_server: Optional[ForkServer] = None,
+                 limits: Optional[ResourceLimits] = None):
+        if len(args) == 0:
+            raise ValueError("A command template needs at least the executable")
+        self.args = list(args)
+        self.working_directory = working_directory
+        self.check_error_code = check_error_code
+        self.capture = capture
+        self.binary = binary
+        self.spawn_backend = spawn_backend
+        self.fork_server = fork_server
+        self.limits = limits
+        self.logging_level = logging_level
+        self.environment = environment
+        self._resolved_executable: Optional[str] = None
+        self._child_environment = SubProcessExecution._merge_environment(environment)
+        self._log_level: int = logging._nameToLevel[logging_level]
+        self._limits_prefix = limits.command_prefix() if limits is not None else None
+
+    @property
+    def resolved_executable(self) -> str:
+        if self._resolved_executable is None:
+            self._resolved_executable = CommandTemplate._resolve_executable(self.args[0], self.environment)
+        return self._resolved_executable
+
+    def run(self, *extra_args: str, custom_input: Optional[CustomInput] = None) -> Result:
+        # executes the args of the template followed by the extra args
+        args = self.args + list(extra_args)
+        SubProcessExecution._log_execute_call(args, self.working_directory, self._log_level)
+        return SubProcessExecution._execute_uncached(args, self.check_error_code, False, self.working_directory,
+                                                     custom_input, self.capture, self.binary, self.spawn_backend,
+                                                     self.fork_server, self._child_environment, self.limits,
+                                                     self.resolved_executable, self._limits_prefix)
+
+    @staticmethod
+    def _resolve_executable(executable: str, environment: Optional[Mapping[str, str]]) -> str:
+        # paths are used as they are, they might be relative to the working directory
+        if os.sep in executable or (os.altsep is not None and os.altsep in executable):
+            return executable
+        # the PATH of the environment given to the template replaces the one of this process
+        search_path = environment.get("PATH") if environment is not None else None
+        resolved_executable = shutil.which(executable, path=search_path)
+        # an executable which can not be found is kept, so that executing it raises the usual start exception
+        return resolved_executable if resolved_executable is not None else executable
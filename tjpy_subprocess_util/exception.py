@@ -1,6 +1,9 @@
 import logging
 from abc import abstractmethod
-from typing import List
+from typing import Any, List, Optional, Tuple
+
+from tjpy_subprocess_util.capture import CompressedOutput, OutputStats
+from tjpy_subprocess_util.instrumentation import ExecutionStats
 
 _logger = logging.getLogger(__name__)
 
@@ -38,31 +41,89 @@ class SubProcessStartException(SubProcessException):
         return f"Command {self._subprocess_args} could not be started."
 
 
+class SubProcessAuthenticationException(SubProcessStartException):
+    # the helper which should execute the command (e.g. a worker agent) rejected the token of the request
+
+    def __init__(self,
+                 subprocess_args: List[str],
+                 peer_name: str
+                 ) -> None:
+        super().__init__(subprocess_args)
+        self._peer_name = peer_name
+
+    @property
+    def peer_name(self) -> str:
+        return self._peer_name
+
+    @property
+    def message(self) -> str:
+        return f"Command {self._subprocess_args} could not be started, because {self._peer_name} rejected the token " \
+            f"of the request."
+
+
 class SubProcessExecutionException(SubProcessException):
 
     def __init__(self,
                  subprocess_args: List[str],
                  exit_code: int,
                  stdout: str,
-                 stderr: str
+                 stderr: str,
+                 stdout_stats: Optional[OutputStats] = None,
+                 stderr_stats: Optional[OutputStats] = None,
+                 execution_stats: Optional[ExecutionStats] = None,
+                 stdout_compressed: Optional[CompressedOutput] = None,
+                 stderr_compressed: Optional[CompressedOutput] = None
                  ) -> None:
+        # with a compressed output, the text of the stream is ignored and only decompressed when it is accessed
         self._exit_code = exit_code
-        self._stdout = stdout
-        self._stderr = stderr
+        self._stdout: Optional[str] = stdout if stdout_compressed is None else None
+        self._stderr: Optional[str] = stderr if stderr_compressed is None else None
+        self._stdout_stats = stdout_stats
+        self._stderr_stats = stderr_stats
+        self._execution_stats = execution_stats
+        self._stdout_compressed = stdout_compressed
+        self._stderr_compressed = stderr_compressed
         super().__init__(subprocess_args)
 
     @property
     def stdout(self):
+        if self._stdout is None:
+            assert self._stdout_compressed is not None
+            self._stdout = self._stdout_compressed.decode()
         return self._stdout
 
     @property
     def stderr(self):
+        if self._stderr is None:
+            assert self._stderr_compressed is not None
+            self._stderr = self._stderr_compressed.decode()
         return self._stderr
 
+    @property
+    def stdout_compressed(self) -> Optional[CompressedOutput]:
+        return self._stdout_compressed
+
+    @property
+    def stderr_compressed(self) -> Optional[CompressedOutput]:
+        return self._stderr_compressed
+
     @property
     def exit_code(self):
         return self._exit_code
 
+    @property
+    def stdout_stats(self) -> Optional[OutputStats]:
+        # only available if the output has been captured chunk by chunk, stdout might only be the tail in that case
+        return self._stdout_stats
+
+    @property
+    def stderr_stats(self) -> Optional[OutputStats]:
+        return self._stderr_stats
+
+    @property
+    def execution_stats(self) -> Optional[ExecutionStats]:
+        return self._execution_stats
+
     @property
     def message(self) -> str:
         max_characters_per_stream = 2000
@@ -73,23 +134,262 @@ class SubProcessExecutionException(SubProcessException):
             f"{stderr_message_part}"
 
     def _stdout_in_message(self, max_characters_per_stream: int):
-        if len(self.stdout) > max_characters_per_stream:
-            trimmed_stdout = self.stdout[len(self.stdout) - max_characters_per_stream:]
-            return f"\nLast {max_characters_per_stream} characters " \
-                f"(from {len(self.stdout)} characters all-in-all) " \
-                f"(starting at next line):\n{trimmed_stdout}"
-        elif len(self.stdout) == 0:
-            return ""
-        else:
-            return f"\nStdout (starting at next line):\n{self.stdout}"
+        return self._output_in_message("Stdout", self.stdout, self.stdout_stats, max_characters_per_stream)
 
     def _stderr_in_message(self, max_characters_per_stream: int):
-        if len(self.stderr) > max_characters_per_stream:
-            trimmed_stderr = self.stderr[len(self.stderr) - max_characters_per_stream:]
+        return self._output_in_message("Stderr", self.stderr, self.stderr_stats, max_characters_per_stream)
+
+    @staticmethod
+    def _output_in_message(stream_name: str,
+                           output: str,
+                           stats: Optional[OutputStats],
+                           max_characters_per_stream: int):
+        if stats is not None and stats.truncated:
+            # only the tail of the output has been captured, so the total size is only known in bytes
+            trimmed_output = output[max(len(output) - max_characters_per_stream, 0):]
+            return f"\nLast {len(trimmed_output)} characters " \
+                f"(from {stats.total_bytes} bytes and {stats.total_lines} lines all-in-all) " \
+                f"(starting at next line):\n{trimmed_output}"
+        elif len(output) > max_characters_per_stream:
+            trimmed_output = output[len(output) - max_characters_per_stream:]
             return f"\nLast {max_characters_per_stream} characters " \
-                f"(from {len(self.stderr)} characters all-in-all) " \
-                f"(starting at next line):\n{trimmed_stderr}"
-        elif len(self.stderr) == 0:
+                f"(from {len(output)} characters all-in-all) " \
+                f"(starting at next line):\n{trimmed_output}"
+        elif len(output) == 0:
             return ""
         else:
-            return f"\nStderr (starting at next line):\n{self.stderr}"
+            return f"\n{stream_name} (starting at next line):\n{output}"
+
+
+class SubProcessPipelineException(SubProcessExecutionException):
+
+    def __init__(self,
+                 pipeline_args: List[List[str]],
+                 stage_index: int,
+                 stage_exit_codes: List[int],
+                 stdout: str,
+                 stderr: str,
+                 stdout_stats: Optional[OutputStats] = None,
+                 stderr_stats: Optional[OutputStats] = None,
+                 execution_stats: Optional[ExecutionStats] = None
+                 ) -> None:
+        # subprocess_args, exit_code and stderr are the ones of the failed stage, stdout is the one of the last stage
+        super().__init__(pipeline_args[stage_index], stage_exit_codes[stage_index], stdout, stderr,
+                         stdout_stats, stderr_stats, execution_stats)
+        self._pipeline_args = pipeline_args
+        self._stage_index = stage_index
+        self._stage_exit_codes = stage_exit_codes
+
+    @property
+    def pipeline_args(self) -> List[List[str]]:
+        return self._pipeline_args
+
+    @property
+    def stage_index(self) -> int:
+        return self._stage_index
+
+    @property
+    def stage_exit_codes(self) -> List[int]:
+        return self._stage_exit_codes
+
+    @property
+    def message(self) -> str:
+        return f"Stage {self._stage_index} of pipeline with {len(self._pipeline_args)} stages failed " \
+            f"(exit codes {self._stage_exit_codes}). {super().message}"
+
+
+class SubProcessOutputParseException(SubProcessExecutionException):
+
+    def __init__(self,
+                 subprocess_args: List[str],
+                 exit_code: int,
+                 parse_error: str,
+                 stderr: str,
+                 stderr_stats: Optional[OutputStats] = None,
+                 execution_stats: Optional[ExecutionStats] = None,
+                 line_number: Optional[int] = None
+                 ) -> None:
+        # the output has not been kept, so stdout is empty, the exit code is the one of the command (which may be 0)
+        super().__init__(subprocess_args, exit_code, "", stderr, None, stderr_stats, execution_stats)
+        self._parse_error = parse_error
+        self._line_number = line_number
+
+    @property
+    def parse_error(self) -> str:
+        return self._parse_error
+
+    @property
+    def line_number(self) -> Optional[int]:
+        # the line of the invalid record for JSON Lines output
+        return self._line_number
+
+    @property
+    def message(self) -> str:
+        max_characters_per_stream = 2000
+        line_part = f" in line {self._line_number}" if self._line_number is not None else ""
+        return f"Output of command {self._subprocess_args} is not valid JSON{line_part}: {self._parse_error}. " \
+            f"The command returned exit code {self.exit_code}." \
+            f"{self._stderr_in_message(max_characters_per_stream)}"
+
+
+class SubProcessLimitException(SubProcessExecutionException):
+    # the command failed because it exceeded one of its ResourceLimits
+    limit_name = "resource"
+
+    def __init__(self,
+                 limit: Any,
+                 subprocess_args: List[str],
+                 exit_code: int,
+                 stdout: str,
+                 stderr: str,
+                 stdout_stats: Optional[OutputStats] = None,
+                 stderr_stats: Optional[OutputStats] = None,
+                 execution_stats: Optional[ExecutionStats] = None,
+                 stdout_compressed: Optional[CompressedOutput] = None,
+                 stderr_compressed: Optional[CompressedOutput] = None
+                 ) -> None:
+        super().__init__(subprocess_args, exit_code, stdout, stderr, stdout_stats, stderr_stats, execution_stats,
+                         stdout_compressed, stderr_compressed)
+        self._limit = limit
+
+    @classmethod
+    def from_failure(cls, failure: SubProcessExecutionException, limit: Any) -> "SubProcessLimitException":
+        # the output is taken over as it is, a compressed output stays compressed
+        return cls(limit, failure._subprocess_args, failure._exit_code, failure._stdout or "", failure._stderr or "",
+                   failure._stdout_stats, failure._stderr_stats, failure._execution_stats,
+                   failure._stdout_compressed, failure._stderr_compressed)
+
+    @property
+    def limit(self) -> Any:
+        return self._limit
+
+    @property
+    def message(self) -> str:
+        return f"Command {self._subprocess_args} exceeded its {self.limit_name} limit of {self._limit}. " \
+            f"{super().message}"
+
+
+class SubProcessCpuTimeLimitException(SubProcessLimitException):
+    limit_name = "CPU time (seconds)"
+
+
+class SubProcessFileSizeLimitException(SubProcessLimitException):
+    limit_name = "file size (bytes)"
+
+
+class SubProcessOutputLimitException(SubProcessLimitException):
+    # the output up to the limit has been captured, the rest has been discarded
+    limit_name = "output (bytes)"
+
+
+class SubProcessShardException(SubProcessExecutionException):
+
+    def __init__(self,
+                 subprocess_args: List[str],
+                 shard_failures: List[Tuple[int, SubProcessExecutionException]],
+                 shard_results: List[Any]
+                 ) -> None:
+        # subprocess_args are the args without the sharded arguments,
+        # exit_code, stdout and stderr are the ones of the first failed shard
+        first_failure = shard_failures[0][1]
+        super().__init__(subprocess_args, first_failure.exit_code, first_failure.stdout, first_failure.stderr,
+                         first_failure.stdout_stats, first_failure.stderr_stats, first_failure.execution_stats)
+        self._shard_failures = shard_failures
+        self._shard_results = shard_results
+
+    @property
+    def shard_failures(self) -> List[Tuple[int, SubProcessExecutionException]]:
+        # pairs of the index of the shard and the exception of the shard, ordered by index
+        return self._shard_failures
+
+    @property
+    def shard_results(self) -> List[Any]:
+        # results of all shards in order, None for the shards which failed
+        return self._shard_results
+
+    @property
+    def message(self) -> str:
+        max_listed_failures = 10
+        max_characters_per_stream = 2000
+        listed_failures = ""
+        for index, failure in self._shard_failures[:max_listed_failures]:
+            shard_arguments = failure.subprocess_args[len(self._subprocess_args):]
+            listed_failures += f"\n[{index}] Shard with {len(shard_arguments)} arguments " \
+                f"({shard_arguments[0]!r} to {shard_arguments[-1]!r}) returned non-zero exit code " \
+                f"{failure.exit_code}.{failure._stderr_in_message(max_characters_per_stream)}"
+        omitted_failures_note = ""
+        if len(self._shard_failures) > max_listed_failures:
+            omitted_failures_note = f"\n... and {len(self._shard_failures) - max_listed_failures} more failed shards."
+        return f"{len(self._shard_failures)} of {len(self._shard_results)} shards of command " \
+            f"{self._subprocess_args} failed." \
+            f"{listed_failures}" \
+            f"{omitted_failures_note}"
+
+
+class SubProcessBatchException(SubProcessException):
+
+    def __init__(self,
+                 failures: List[Tuple[int, SubProcessException]],
+                 results: Optional[List[Any]] = None
+                 ) -> None:
+        # the args of the first failed command are used to stay compatible with code handling SubProcessException
+        super().__init__(failures[0][1].subprocess_args)
+        self._failures = failures
+        self._results = results
+
+    @property
+    def failures(self) -> List[Tuple[int, SubProcessException]]:
+        # pairs of the index of the command in the batch and the exception of the command, ordered by index
+        return self._failures
+
+    @property
+    def results(self) -> Optional[List[Any]]:
+        # results of the batch in input order, None for commands which failed or have not been executed
+        return self._results
+
+    @property
+    def message(self) -> str:
+        max_listed_failures = 10
+        listed_failures = "".join(f"\n[{index}] {failure.message}"
+                                  for index, failure in self._failures[:max_listed_failures])
+        omitted_failures_note = ""
+        if len(self._failures) > max_listed_failures:
+            omitted_failures_note = f"\n... and {len(self._failures) - max_listed_failures} more failed commands."
+        return f"{len(self._failures)} commands of the batch failed." \
+            f"{listed_failures}" \
+            f"{omitted_failures_note}"
+
+
+class SubProcessScheduleException(SubProcessBatchException):
+
+    def __init__(self,
+                 failures: List[Tuple[int, SubProcessException]],
+                 command_names: List[str],
+                 report: Any
+                 ) -> None:
+        # failures are pairs of the index of the command in the order it was added and its exception
+        super().__init__(failures)
+        self._command_names = command_names
+        self._report = report
+
+    @property
+    def failed_commands(self) -> List[Tuple[str, SubProcessException]]:
+        return [(self._command_names[index], failure) for index, failure in self.failures]
+
+    @property
+    def report(self) -> Any:
+        # the ScheduleReport with the results of the commands which succeeded and the skipped commands
+        return self._report
+
+    @property
+    def message(self) -> str:
+        max_listed_failures = 10
+        listed_failures = "".join(f"\n[{name}] {failure.message}"
+                                  for name, failure in self.failed_commands[:max_listed_failures])
+        omitted_failures_note = ""
+        if len(self.failures) > max_listed_failures:
+            omitted_failures_note = f"\n... and {len(self.failures) - max_listed_failures} more failed commands."
+        return f"{len(self.failures)} commands of the schedule failed, " \
+            f"{len(self._report.skipped)} commands have not been executed." \
+            f"{listed_failures}" \
+            f"{omitted_failures_note}"
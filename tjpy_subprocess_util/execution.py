@@ -1,34 +1,250 @@
+import os
 import sys
 
+import codecs
+import collections
+import functools
+import io
+import json
 import logging
+import mmap
+import signal
 import subprocess
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from pathlib import Path
-from subprocess import CompletedProcess
-from typing import Any, IO, Iterable, List, Optional, Union
+from typing import Any, Callable, Deque, Dict, Generator, IO, Iterable, Iterator, List, Mapping, Optional, \
+    Sequence, Tuple, Union
 
-from tjpy_subprocess_util.exception import SubProcessExecutionException, SubProcessStartException
+from tjpy_subprocess_util.cache import CachedOutput, ResultCache
+from tjpy_subprocess_util.capture import CaptureBuffer, CompressedBuffer, CompressedOutput, FileCapture, \
+    FullCapture, OutputCapture, OutputFile, OutputStats, TailBuffer
+from tjpy_subprocess_util.exception import SubProcessBatchException, SubProcessException, \
+    SubProcessExecutionException, SubProcessOutputParseException, SubProcessPipelineException, \
+    SubProcessShardException, SubProcessStartException
+from tjpy_subprocess_util.forkserver import CommandRunner, ForkServer
+from tjpy_subprocess_util.instrumentation import ExecutionObserver, ExecutionObservers, ExecutionStats
+from tjpy_subprocess_util.limits import OutputLimit, ResourceLimits
+from tjpy_subprocess_util.pump import Pump
+from tjpy_subprocess_util.reactor import ChildReactor, ReactorTask
+from tjpy_subprocess_util.sharding import ArgumentSharder
+from tjpy_subprocess_util.source import CustomInput, InputSource
+from tjpy_subprocess_util.structured import JsonDocumentParser, JsonLinesParser
+from tjpy_subprocess_util.throttle import AdaptiveLimiter
+from tjpy_subprocess_util.spawn import Process, ProcessSpawner, ResourceUsagePopen, SPAWN_BACKEND_SUBPROCESS
 
 _logger = logging.getLogger(__name__)
 
+# only the tail of an output written to a file is read for the exception if the command fails
+_FAILED_OUTPUT_FILE_TAIL_BYTES = 64 * 1024
+
 
 class Result:
+    # the output is either given as text or as raw bytes, raw bytes are only decoded when the text is accessed
+    # with a stdout_file, stdout is only read from the file when it is accessed as text or bytes
+    # with a compressed output, the stream is only decompressed when it is accessed as text or bytes
+    __slots__ = ("exit_code", "stdout_stats", "stderr_stats", "execution_stats", "stdout_file", "stdout_compressed",
+                 "stderr_compressed", "_stdout", "_stderr", "_stdout_bytes", "_stderr_bytes", "_trimmed_stdout",
+                 "_stdout_size", "_stderr_size")
+
     def __init__(self,
                  exit_code: int,
-                 stdout: str,
-                 stderr: str):
+                 stdout: Union[str, bytes],
+                 stderr: Union[str, bytes],
+                 stdout_stats: Optional[OutputStats] = None,
+                 stderr_stats: Optional[OutputStats] = None,
+                 execution_stats: Optional[ExecutionStats] = None,
+                 stdout_file: Optional[OutputFile] = None,
+                 stdout_compressed: Optional[CompressedOutput] = None,
+                 stderr_compressed: Optional[CompressedOutput] = None,
+                 stdout_size: Optional[int] = None,
+                 stderr_size: Optional[int] = None):
         self.exit_code = exit_code
-        self.stdout = stdout
-        self.stderr = stderr
+        # only available if the output has been captured chunk by chunk, stdout might only be the tail in that case
+        self.stdout_stats = stdout_stats
+        self.stderr_stats = stderr_stats
+        # timing and resource usage of the command, not available for results from the cache
+        self.execution_stats = execution_stats
+        # the file stays open as long as the result is used, it can be closed explicitly with stdout_file.close()
+        self.stdout_file = stdout_file
+        # the given stdout and stderr are ignored for the streams which are given compressed
+        self.stdout_compressed = stdout_compressed
+        self.stderr_compressed = stderr_compressed
+        stdout_given = stdout_file is None and stdout_compressed is None
+        stderr_given = stderr_compressed is None
+        self._stdout: Optional[str] = stdout if isinstance(stdout, str) and stdout_given else None
+        self._stderr: Optional[str] = stderr if isinstance(stderr, str) and stderr_given else None
+        self._stdout_bytes: Optional[bytes] = stdout if isinstance(stdout, bytes) and stdout_given else None
+        self._stderr_bytes: Optional[bytes] = stderr if isinstance(stderr, bytes) and stderr_given else None
+        self._trimmed_stdout: Optional[str] = None
+        # the number of bytes of an output given as text, as counted when it was read, so it is not encoded again
+        self._stdout_size = stdout_size
+        self._stderr_size = stderr_size
+
+    @property
+    def stdout(self) -> str:
+        if self._stdout is None:
+            self._stdout = Result._decode(self._stdout_raw(), self.stdout_stats)
+        return self._stdout
+
+    @property
+    def stderr(self) -> str:
+        if self._stderr is None:
+            self._stderr = Result._decode(self.stderr_bytes, self.stderr_stats)
+        return self._stderr
+
+    @property
+    def stdout_bytes(self) -> bytes:
+        if self._stdout_bytes is None:
+            if self.stdout_file is not None:
+                self._stdout_bytes = self.stdout_file.read_bytes()
+            elif self.stdout_compressed is not None:
+                self._stdout_bytes = self.stdout_compressed.decompress()
+            else:
+                assert self._stdout is not None
+                self._stdout_bytes = self._stdout.encode("utf-8")
+        return self._stdout_bytes
+
+    @property
+    def stderr_bytes(self) -> bytes:
+        if self._stderr_bytes is None:
+            if self.stderr_compressed is not None:
+                self._stderr_bytes = self.stderr_compressed.decompress()
+            else:
+                assert self._stderr is not None
+                self._stderr_bytes = self._stderr.encode("utf-8")
+        return self._stderr_bytes
+
+    @property
+    def stdout_size_bytes(self) -> int:
+        # the number of bytes written to stdout, also if only a part of it has been captured
+        if self.stdout_stats is not None:
+            return self.stdout_stats.total_bytes
+        elif self.stdout_file is not None:
+            return self.stdout_file.size
+        elif self.stdout_compressed is not None:
+            return self.stdout_compressed.raw_size
+        elif self._stdout_bytes is not None:
+            return len(self._stdout_bytes)
+        elif self._stdout_size is not None:
+            return self._stdout_size
+        assert self._stdout is not None
+        return len(self._stdout.encode("utf-8"))
+
+    @property
+    def stderr_size_bytes(self) -> int:
+        if self.stderr_stats is not None:
+            return self.stderr_stats.total_bytes
+        elif self.stderr_compressed is not None:
+            return self.stderr_compressed.raw_size
+        elif self._stderr_bytes is not None:
+            return len(self._stderr_bytes)
+        elif self._stderr_size is not None:
+            return self._stderr_size
+        assert self._stderr is not None
+        return len(self._stderr.encode("utf-8"))
 
     @property
     def trimmed_stdout(self):
         # the output of a sub-process normally ends with a new line for formatting purposes
         # however, it is not part of the value that is being returned from the sub-process
         # this utility property automatically removes this formatting new-line
-        if self.stdout.endswith("\n"):
-            return self.stdout[:-1]
+        if self._trimmed_stdout is None:
+            if self._stdout is None:
+                # decoding the raw output without the line break avoids copying the decoded text again
+                output = self._stdout_raw()
+                line_break_length = Result._trailing_line_break_length(bytes(output[-2:]))
+                self._trimmed_stdout = Result._decode(output[:len(output) - line_break_length], self.stdout_stats)
+            elif self._stdout.endswith("\n"):
+                self._trimmed_stdout = self._stdout[:-1]
+            else:
+                self._trimmed_stdout = self._stdout
+        return self._trimmed_stdout
+
+    def stdout_view(self) -> memoryview:
+        return self._stdout_raw()
+
+    def stderr_view(self) -> memoryview:
+        return memoryview(self.stderr_bytes)
+
+    def stdout_lines(self) -> Iterator[memoryview]:
+        if self._stdout_bytes is None and self.stdout_file is not None:
+            output_mmap = self.stdout_file.mmap()
+            return Result._lines(output_mmap) if output_mmap is not None else iter([])
+        return Result._lines(self.stdout_bytes)
+
+    def stderr_lines(self) -> Iterator[memoryview]:
+        return Result._lines(self.stderr_bytes)
+
+    def _stdout_raw(self) -> memoryview:
+        # the raw stdout without copying it, also if it is in a file
+        if self._stdout_bytes is None and self.stdout_file is not None:
+            return self.stdout_file.view()
+        return memoryview(self.stdout_bytes)
+
+    @staticmethod
+    def _lines(output: Union[bytes, mmap.mmap]) -> Iterator[memoryview]:
+        # zero-copy views of the lines without the line break, the "\r" of windows line breaks is kept
+        view = memoryview(output)
+        start = 0
+        while start < len(output):
+            end = output.find(b"\n", start)
+            if end == -1:
+                yield view[start:]
+                return
+            yield view[start:end]
+            start = end + 1
+
+    @staticmethod
+    def _trailing_line_break_length(output: bytes) -> int:
+        # the same line breaks as the ones translated to "\n" when decoding
+        if output.endswith(b"\r\n"):
+            return 2
+        elif output.endswith(b"\n") or output.endswith(b"\r"):
+            return 1
         else:
-            return self.stdout
+            return 0
+
+    @staticmethod
+    def _decode(output: Union[bytes, memoryview], stats: Optional[OutputStats]) -> str:
+        if stats is not None and stats.truncated:
+            return SubProcessExecution._decode_output_tail(output)
+        return SubProcessExecution._decode_output(output)
+
+
+class PipelineResult(Result):
+    # result of execute_pipeline, stdout is the one of the last stage and stderr the one of all stages in stage order
+    __slots__ = ("stage_exit_codes", "stage_stderr_bytes")
+
+    def __init__(self,
+                 stage_exit_codes: List[int],
+                 stdout: Union[str, bytes],
+                 stage_stderr_bytes: List[bytes],
+                 stdout_stats: Optional[OutputStats] = None,
+                 execution_stats: Optional[ExecutionStats] = None):
+        super().__init__(stage_exit_codes[-1], stdout, b"".join(stage_stderr_bytes), stdout_stats,
+                         execution_stats=execution_stats)
+        self.stage_exit_codes = stage_exit_codes
+        self.stage_stderr_bytes = stage_stderr_bytes
+
+
+class ShardedResult(Result):
+    # result of execute_sharded, stdout and stderr are the ones of all shards in shard order
+    # the exit code is the first non-zero exit code of the shards (only possible without check_error_code)
+    __slots__ = ("shard_exit_codes", "shard_argument_counts")
+
+    def __init__(self,
+                 shard_exit_codes: List[int],
+                 shard_argument_counts: List[int],
+                 stdout: Union[str, bytes],
+                 stderr: Union[str, bytes],
+                 stdout_stats: Optional[OutputStats] = None,
+                 stderr_stats: Optional[OutputStats] = None,
+                 execution_stats: Optional[ExecutionStats] = None):
+        super().__init__(next((exit_code for exit_code in shard_exit_codes if exit_code != 0), 0), stdout, stderr,
+                         stdout_stats, stderr_stats, execution_stats)
+        self.shard_exit_codes = shard_exit_codes
+        self.shard_argument_counts = shard_argument_counts
 
 
 class SubProcessExecution:
@@ -37,62 +253,1108 @@ class SubProcessExecution:
     def execute(args: List[str],
                 check_error_code: bool = True,
                 follow_output: bool = False,
-                working_directory: Path = None,
+                working_directory: Optional[Path] = None,
                 logging_level: str = "DEBUG",
-                custom_input: Optional[str] = None) -> Result:
+                custom_input: Optional[CustomInput] = None,
+                capture: Optional[OutputCapture] = None,
+                binary: bool = False,
+                spawn_backend: str = SPAWN_BACKEND_SUBPROCESS,
+                fork_server: Optional[ForkServer] = None,
+                cache: Optional[ResultCache] = None,
+                cache_dependencies: Optional[Iterable[Path]] = None,
+                environment: Optional[Dict[str, str]] = None,
+                limits: Optional[ResourceLimits] = None,
+                executable: Optional[str] = None) -> Result:
+        # in binary mode, the result holds the raw output and only decodes it when the text is accessed
+        # if follow_output is combined with a capture mode, the output is forwarded and captured at the same time
+        # with a started fork server, the command is spawned by the small helper process instead of this process
+        # with a cache, successful results are reused as long as the cache_dependencies paths stay unchanged
+        # custom_input can also be bytes, a file, a path or an iterable of chunks, which is written incrementally
+        # environment contains variables which are added to (or replace variables of) the environment of this process
+        # limits constrain the resources of the command, a breach is raised as a subclass of SubProcessLimitException
+        # executable is the program to execute instead of args[0], the args stay as they are in results, exceptions
+        # and logs and args[0] is passed to the command as its name (argv[0], except with limits)
         SubProcessExecution._log_execute_call(args, working_directory, logging_level)
+        child_environment = SubProcessExecution._merge_environment(environment)
+        if cache is None:
+            return SubProcessExecution._execute_uncached(args, check_error_code, follow_output, working_directory,
+                                                         custom_input, capture, binary, spawn_backend, fork_server,
+                                                         child_environment, limits, executable)
 
-        stdout: Union[None, int, IO[Any]] = sys.stdout if follow_output else subprocess.PIPE
-        stderr: Union[None, int, IO[Any]] = sys.stderr if follow_output else subprocess.PIPE
-        stdin: Union[None, int, IO[Any]] = sys.stdin if custom_input is None else None
-        try:
-            result: CompletedProcess = subprocess.run(
-                args,
-                cwd=working_directory,
-                stdout=stdout,
-                stderr=stderr,
-                stdin=stdin,
-                input=custom_input,
-                encoding="utf-8"
+        if follow_output:
+            raise ValueError("cache can not be combined with follow_output")
+        if custom_input is not None and not isinstance(custom_input, (str, bytes, bytearray, memoryview)):
+            raise ValueError("cache can only be combined with a custom_input given as str or bytes")
+        if isinstance(capture, FileCapture):
+            raise ValueError("cache can not be combined with FileCapture")
+        cache_key = cache.key(args, working_directory, custom_input, cache_dependencies, environment, executable)
+        cached_output = cache.get(cache_key)
+        if cached_output is not None:
+            _logger.debug(f"Using cached result for command {args}")
+            return Result(
+                exit_code=cached_output.exit_code,
+                stdout=cached_output.stdout,
+                stderr=cached_output.stderr,
+                stdout_stats=cached_output.stdout_stats,
+                stderr_stats=cached_output.stderr_stats
             )
+        result = SubProcessExecution._execute_uncached(args, check_error_code, follow_output, working_directory,
+                                                       custom_input, capture, binary, spawn_backend, fork_server,
+                                                       child_environment, limits, executable)
+        # failures might be temporary and truncated output would not be valid for other capture modes
+        truncated = any(stats is not None and stats.truncated for stats in (result.stdout_stats, result.stderr_stats))
+        if result.exit_code == 0 and not truncated:
+            cache.put(cache_key, CachedOutput(result.exit_code, result.stdout_bytes, result.stderr_bytes,
+                                              result.stdout_stats, result.stderr_stats))
+        return result
 
-            if check_error_code:
-                if result.returncode != 0:
-                    if not follow_output:
-                        if len(result.stdout) != 0:
-                            _logger.info("Stdout of failed command:\n" + result.stdout)
-                        if len(result.stderr) != 0:
-                            _logger.info("Stderr of failed command:\n" + result.stderr)
-                    else:
-                        _logger.info("Output of failed command has been redirected to stdout and stderr streams.")
-                        pass
-                result.check_returncode()
+    @staticmethod
+    def _execute_uncached(args: List[str],
+                          check_error_code: bool,
+                          follow_output: bool,
+                          working_directory: Optional[Path],
+                          custom_input: Optional[CustomInput],
+                          capture: Optional[OutputCapture],
+                          binary: bool,
+                          spawn_backend: str,
+                          fork_server: Optional[CommandRunner],
+                          environment: Optional[Mapping[str, str]],
+                          limits: Optional[ResourceLimits] = None,
+                          executable: Optional[str] = None,
+                          limits_prefix: Optional[List[str]] = None) -> Result:
+        # limits_prefix is the command prefix of the limits computed beforehand, e.g. once for a command template
+        if limits is not None and fork_server is not None:
+            raise ValueError("limits can not be combined with fork_server")
+        # the observers are taken once, so an observer registered during the execution never only gets the end
+        observers = ExecutionObservers.current()
+        ExecutionObservers.notify_start(observers, args, working_directory)
+        try:
+            if isinstance(capture, FileCapture):
+                if follow_output or fork_server is not None:
+                    raise ValueError("FileCapture can not be combined with follow_output or fork_server")
+                result = SubProcessExecution._execute_to_file(args, check_error_code, working_directory, custom_input,
+                                                              capture, spawn_backend, environment, limits, executable,
+                                                              limits_prefix)
+            # custom input is always written by the pump, which writes text chunk by chunk instead of encoding a copy
+            elif capture is not None or spawn_backend != SPAWN_BACKEND_SUBPROCESS or fork_server is not None \
+                    or custom_input is not None or limits is not None:
+                result = SubProcessExecution._execute_pumped(args, check_error_code, follow_output, working_directory,
+                                                             custom_input, capture, spawn_backend, fork_server,
+                                                             environment, limits, executable, limits_prefix)
             else:
-                if follow_output:
-                    pass
-        except subprocess.CalledProcessError as called_sub_process_error:
-            raise SubProcessExecutionException(list(args),
-                                               called_sub_process_error.returncode,
-                                               SubProcessExecution._output_to_string(called_sub_process_error.stdout),
-                                               SubProcessExecution._output_to_string(called_sub_process_error.stderr),
-                                               ) from called_sub_process_error
-        except subprocess.SubprocessError as sub_process_error:
+                result = SubProcessExecution._execute_process(args, check_error_code, follow_output,
+                                                              working_directory, binary, environment, executable)
+        except SubProcessException as sub_process_exception:
+            ExecutionObservers.notify_failure(observers, args, sub_process_exception)
+            raise
+        ExecutionObservers.notify_complete(observers, args, result)
+        return result
+
+    @staticmethod
+    def _execute_process(args: List[str],
+                         check_error_code: bool,
+                         follow_output: bool,
+                         working_directory: Optional[Path],
+                         binary: bool,
+                         environment: Optional[Mapping[str, str]],
+                         executable: Optional[str] = None) -> Result:
+        # same as subprocess.run, but the child is reaped with os.wait4 to also get its resource usage
+        # the output is always read as bytes and decoded here, so its size is known without encoding it again
+        stdout: Union[None, int, IO[Any]] = sys.stdout if follow_output else subprocess.PIPE
+        stderr: Union[None, int, IO[Any]] = sys.stderr if follow_output else subprocess.PIPE
+        start_time = time.perf_counter()
+        try:
+            with ResourceUsagePopen(
+                    args,
+                    cwd=working_directory,
+                    stdout=stdout,
+                    stderr=stderr,
+                    stdin=sys.stdin,
+                    env=environment,
+                    executable=executable
+            ) as process:
+                process.spawn_latency_seconds = time.perf_counter() - start_time
+                try:
+                    process_stdout, process_stderr = process.communicate()
+                except BaseException:
+                    process.kill()
+                    raise
+                exit_code = process.wait()
+        except (OSError, subprocess.SubprocessError) as sub_process_error:
             raise SubProcessStartException(list(args)) from sub_process_error
+        execution_stats = SubProcessExecution._execution_stats(process, start_time)
+
+        if check_error_code and exit_code != 0:
+            stdout_text = SubProcessExecution._output_to_string(process_stdout)
+            stderr_text = SubProcessExecution._output_to_string(process_stderr)
+            SubProcessExecution._log_failed_command_output(stdout_text, stderr_text, follow_output)
+            raise SubProcessExecutionException(list(args), exit_code, stdout_text, stderr_text,
+                                               execution_stats=execution_stats)
+        if binary:
+            return Result(
+                exit_code=exit_code,
+                stdout=process_stdout if process_stdout is not None else b"",
+                stderr=process_stderr if process_stderr is not None else b"",
+                execution_stats=execution_stats
+            )
+        return Result(
+            exit_code=exit_code,
+            stdout=SubProcessExecution._decode_output(process_stdout),
+            stderr=SubProcessExecution._decode_output(process_stderr),
+            execution_stats=execution_stats,
+            stdout_size=len(process_stdout) if process_stdout is not None else 0,
+            stderr_size=len(process_stderr) if process_stderr is not None else 0
+        )
+
+    @staticmethod
+    def _execute_pumped(args: List[str],
+                        check_error_code: bool,
+                        follow_output: bool,
+                        working_directory: Optional[Path],
+                        custom_input: Optional[CustomInput],
+                        capture: Optional[OutputCapture],
+                        spawn_backend: str,
+                        fork_server: Optional[CommandRunner],
+                        environment: Optional[Mapping[str, str]],
+                        limits: Optional[ResourceLimits] = None,
+                        executable: Optional[str] = None,
+                        limits_prefix: Optional[List[str]] = None) -> Result:
+        # without a capture mode, the output is either captured fully or not at all if it is followed
+        if capture is None and not follow_output:
+            capture = FullCapture()
+        stdout_buffer = capture.create_buffer() if capture is not None else None
+        stderr_buffer = capture.create_buffer() if capture is not None else None
+        on_stdout = SubProcessExecution._output_handler(sys.stdout if follow_output else None, stdout_buffer)
+        on_stderr = SubProcessExecution._output_handler(sys.stderr if follow_output else None, stderr_buffer)
+
+        output_limit: Optional[OutputLimit] = None
+        if fork_server is not None:
+            # the output of the fork server is always streamed back, also if it is only followed
+            input_chunks = None if custom_input is None else InputSource.chunks(custom_input)
+            exit_code, execution_stats = fork_server.run(args, working_directory, input_chunks,
+                                                         on_stdout or SubProcessExecution._forwarder(sys.stdout),
+                                                         on_stderr or SubProcessExecution._forwarder(sys.stderr),
+                                                         spawn_backend=spawn_backend, environment=environment,
+                                                         executable=executable)
+        else:
+            start_time = time.perf_counter()
+            process = ProcessSpawner.start(args, working_directory, custom_input is not None,
+                                           pipe_output=capture is not None, spawn_backend=spawn_backend,
+                                           environment=environment, limits=limits, executable=executable,
+                                           limits_prefix=limits_prefix)
+            output_limit = SubProcessExecution._output_limit(limits, process)
+            if output_limit is not None:
+                on_stdout = output_limit.wrap(on_stdout) if on_stdout is not None else None
+                on_stderr = output_limit.wrap(on_stderr) if on_stderr is not None else None
+            exit_code = SubProcessExecution._pump_process(process, on_stdout, on_stderr, custom_input)
+            execution_stats = SubProcessExecution._execution_stats(process, start_time)
+        output_limit_exceeded = output_limit is not None and output_limit.exceeded
+
+        if stdout_buffer is None or stderr_buffer is None:
+            if check_error_code and exit_code != 0:
+                SubProcessExecution._log_failed_command_output(None, None, follow_output)
+                raise SubProcessExecution._limit_exception(
+                    SubProcessExecutionException(list(args), exit_code, "", "", execution_stats=execution_stats),
+                    limits, output_limit_exceeded)
+            return Result(exit_code=exit_code, stdout="", stderr="", execution_stats=execution_stats)
+
+        return SubProcessExecution._result_from_buffers(args, check_error_code, follow_output, exit_code,
+                                                        stdout_buffer, stderr_buffer, execution_stats, limits,
+                                                        output_limit_exceeded)
+
+    @staticmethod
+    def _result_from_buffers(args: List[str],
+                             check_error_code: bool,
+                             follow_output: bool,
+                             exit_code: int,
+                             stdout_buffer: CaptureBuffer,
+                             stderr_buffer: CaptureBuffer,
+                             execution_stats: Optional[ExecutionStats],
+                             limits: Optional[ResourceLimits] = None,
+                             output_limit_exceeded: bool = False) -> Result:
+        stdout_compressed = stdout_buffer.output() if isinstance(stdout_buffer, CompressedBuffer) else None
+        stderr_compressed = stderr_buffer.output() if isinstance(stderr_buffer, CompressedBuffer) else None
+        if check_error_code and exit_code != 0:
+            exception = SubProcessExecution._limit_exception(SubProcessExecutionException(
+                list(args), exit_code,
+                SubProcessExecution._decode_captured_output(stdout_buffer) if stdout_compressed is None else "",
+                SubProcessExecution._decode_captured_output(stderr_buffer) if stderr_compressed is None else "",
+                stdout_buffer.stats, stderr_buffer.stats, execution_stats, stdout_compressed, stderr_compressed),
+                limits, output_limit_exceeded)
+            # compressed outputs are only decompressed if they are actually logged
+            if _logger.isEnabledFor(logging.INFO):
+                SubProcessExecution._log_failed_command_output(exception.stdout, exception.stderr, follow_output)
+            raise exception
         return Result(
-            exit_code=result.returncode,
-            stdout=SubProcessExecution._output_to_string(result.stdout),
-            stderr=SubProcessExecution._output_to_string(result.stderr)
+            exit_code=exit_code,
+            stdout=stdout_buffer.getvalue() if stdout_compressed is None else b"",
+            stderr=stderr_buffer.getvalue() if stderr_compressed is None else b"",
+            stdout_stats=stdout_buffer.stats,
+            stderr_stats=stderr_buffer.stats,
+            execution_stats=execution_stats,
+            stdout_compressed=stdout_compressed,
+            stderr_compressed=stderr_compressed
+        )
+
+    @staticmethod
+    def _execute_to_file(args: List[str],
+                         check_error_code: bool,
+                         working_directory: Optional[Path],
+                         custom_input: Optional[CustomInput],
+                         capture: FileCapture,
+                         spawn_backend: str,
+                         environment: Optional[Mapping[str, str]],
+                         limits: Optional[ResourceLimits] = None,
+                         executable: Optional[str] = None,
+                         limits_prefix: Optional[List[str]] = None) -> Result:
+        # the command writes its stdout directly into the file, only stderr (and the input) is pumped
+        # so the output limit only applies to stderr, the file can be limited with the file size limit
+        stdout_file = capture.create_file()
+        stderr_buffer = capture.create_buffer()
+        try:
+            start_time = time.perf_counter()
+            process = ProcessSpawner.start(args, working_directory, custom_input is not None,
+                                           spawn_backend=spawn_backend, stdout_file=stdout_file.fileno(),
+                                           environment=environment, limits=limits, executable=executable,
+                                           limits_prefix=limits_prefix)
+            output_limit = SubProcessExecution._output_limit(limits, process)
+            on_stderr = output_limit.wrap(stderr_buffer.write) if output_limit is not None else stderr_buffer.write
+            exit_code = SubProcessExecution._pump_process(process, None, on_stderr, custom_input)
+            execution_stats = SubProcessExecution._execution_stats(process, start_time)
+
+            if check_error_code and exit_code != 0:
+                stdout_tail = stdout_file.tail(_FAILED_OUTPUT_FILE_TAIL_BYTES)
+                stdout_stats = OutputStats(stdout_file.size, stdout_file.count_lines(), len(stdout_tail))
+                if stdout_stats.truncated:
+                    stdout_text = SubProcessExecution._decode_output_tail(stdout_tail)
+                else:
+                    stdout_text = SubProcessExecution._decode_output(stdout_tail, errors="replace")
+                stderr_text = SubProcessExecution._decode_captured_output(stderr_buffer)
+                SubProcessExecution._log_failed_command_output(stdout_text, stderr_text, False)
+                raise SubProcessExecution._limit_exception(
+                    SubProcessExecutionException(list(args), exit_code, stdout_text, stderr_text,
+                                                 stdout_stats, stderr_buffer.stats, execution_stats),
+                    limits, output_limit is not None and output_limit.exceeded)
+        except BaseException:
+            stdout_file.close()
+            raise
+        return Result(
+            exit_code=exit_code,
+            stdout=b"",
+            stderr=stderr_buffer.getvalue(),
+            stderr_stats=stderr_buffer.stats,
+            execution_stats=execution_stats,
+            stdout_file=stdout_file
+        )
+
+    @staticmethod
+    def _output_limit(limits: Optional[ResourceLimits], process: Process) -> Optional[OutputLimit]:
+        if limits is None or limits.output_bytes is None:
+            return None
+        return OutputLimit(limits.output_bytes, process.kill)
+
+    @staticmethod
+    def _limit_exception(failure: SubProcessExecutionException,
+                         limits: Optional[ResourceLimits],
+                         output_limit_exceeded: bool) -> SubProcessExecutionException:
+        return limits.limit_exception(failure, output_limit_exceeded) if limits is not None else failure
+
+    @staticmethod
+    def _execution_stats(process: Process, start_time: float) -> ExecutionStats:
+        # the process must already have been reaped, the resource usage is only set by reaping it
+        return ExecutionStats.from_resource_usage(time.perf_counter() - start_time,
+                                                  process.spawn_latency_seconds, process.resource_usage)
+
+    @staticmethod
+    def _output_handler(followed_stream: Optional[IO[str]],
+                        buffer: Optional[CaptureBuffer]) -> Optional[Callable[[bytes], None]]:
+        if followed_stream is None:
+            return buffer.write if buffer is not None else None
+        elif buffer is None:
+            return None
+        return SubProcessExecution._tee(SubProcessExecution._forwarder(followed_stream), buffer.write)
+
+    @staticmethod
+    def _pump_process(process: Process,
+                      on_stdout: Optional[Callable[[bytes], None]],
+                      on_stderr: Optional[Callable[[bytes], None]],
+                      custom_input: Optional[CustomInput]) -> int:
+        pump = SubProcessExecution._create_process_pump(process, on_stdout, on_stderr, custom_input)
+        try:
+            pump.run()
+            return process.wait()
+        finally:
+            SubProcessExecution._close_process_pump(process, pump)
+
+    @staticmethod
+    def _create_process_pump(process: Process,
+                             on_stdout: Optional[Callable[[bytes], None]],
+                             on_stderr: Optional[Callable[[bytes], None]],
+                             custom_input: Optional[CustomInput]) -> Pump:
+        pump = Pump()
+        if on_stdout is not None:
+            assert process.stdout is not None
+            pump.add_reader(process.stdout, on_stdout)
+        if on_stderr is not None:
+            assert process.stderr is not None
+            pump.add_reader(process.stderr, on_stderr)
+        if custom_input is not None:
+            assert process.stdin is not None
+            pump.add_writer(process.stdin, InputSource.pumped_chunks(custom_input))
+        return pump
+
+    @staticmethod
+    def _close_process_pump(process: Process, pump: Pump) -> None:
+        pump.close()
+        if process.returncode is None:
+            _logger.debug(f"Killing command {process.args!r} because its output is not consumed anymore.")
+            process.kill()
+            process.wait()
+
+    @staticmethod
+    def _forwarder(stream: IO[str]) -> Callable[[bytes], None]:
+        # text written to the stream before must be visible before the output of the command
+        stream.flush()
+        binary_stream: Optional[IO[bytes]] = getattr(stream, "buffer", None)
+        if binary_stream is not None:
+            def forward_bytes(data: bytes) -> None:
+                binary_stream.write(data)  # type: ignore
+                binary_stream.flush()  # type: ignore
+            return forward_bytes
+
+        # streams without an underlying binary buffer, e.g. replaced streams in tests, get the decoded text
+        decoder = io.IncrementalNewlineDecoder(codecs.getincrementaldecoder("utf-8")(errors="replace"), translate=True)
+
+        def forward_text(data: bytes) -> None:
+            stream.write(decoder.decode(data))
+            stream.flush()
+        return forward_text
+
+    @staticmethod
+    def _tee(*callbacks: Callable[[bytes], None]) -> Callable[[bytes], None]:
+        def call_all(data: bytes) -> None:
+            for callback in callbacks:
+                callback(data)
+        return call_all
+
+    @staticmethod
+    def _decode_captured_output(buffer: CaptureBuffer) -> str:
+        # used for failures, which should never fail because of an invalid output
+        if buffer.truncated:
+            return SubProcessExecution._decode_output_tail(buffer.getvalue())
+        return SubProcessExecution._decode_output(buffer.getvalue(), errors="replace")
+
+    @staticmethod
+    def stream(args: List[str],
+               check_error_code: bool = True,
+               working_directory: Optional[Path] = None,
+               logging_level: str = "DEBUG",
+               custom_input: Optional[CustomInput] = None,
+               lines: bool = True,
+               stderr_tail_bytes: int = 64 * 1024,
+               environment: Optional[Dict[str, str]] = None) -> Iterator[str]:
+        # yields the stdout of the command while it is running, either line by line (including the line break)
+        # or as decoded chunks in the size they arrive in
+        # only the last stderr_tail_bytes bytes of stderr are kept for the exception if the command fails
+        # if the iteration is stopped prematurely, the command is killed (and the observers only see its start)
+        SubProcessExecution._log_execute_call(args, working_directory, logging_level)
+        observers = ExecutionObservers.current()
+        ExecutionObservers.notify_start(observers, args, working_directory)
+        start_time = time.perf_counter()
+        try:
+            process = ProcessSpawner.start(args, working_directory, custom_input is not None,
+                                           environment=SubProcessExecution._merge_environment(environment))
+        except SubProcessException as start_exception:
+            ExecutionObservers.notify_failure(observers, args, start_exception)
+            raise
+
+        decoder = io.IncrementalNewlineDecoder(codecs.getincrementaldecoder("utf-8")(), translate=True)
+        ready_output: Deque[str] = collections.deque()
+        incomplete_line_parts: List[str] = []
+
+        def on_stdout(data: bytes, final: bool = False):
+            text = decoder.decode(data, final)
+            if not lines:
+                if len(text) != 0:
+                    ready_output.append(text)
+                return
+            last_line_break = text.rfind("\n")
+            if last_line_break == -1:
+                incomplete_line_parts.append(text)
+                return
+            incomplete_line_parts.append(text[:last_line_break])
+            complete_lines = "".join(incomplete_line_parts).split("\n")
+            ready_output.extend(line + "\n" for line in complete_lines)
+            incomplete_line_parts.clear()
+            incomplete_line_parts.append(text[last_line_break + 1:])
+
+        stderr_tail = TailBuffer(stderr_tail_bytes)
+        stdout_size = 0
+        chunks = SubProcessExecution._stdout_chunks(process, custom_input, stderr_tail)
+        try:
+            for chunk in chunks:
+                stdout_size += len(chunk)
+                on_stdout(chunk)
+                while len(ready_output) != 0:
+                    yield ready_output.popleft()
+            on_stdout(b"", final=True)
+            yield from ready_output
+            last_line_without_line_break = "".join(incomplete_line_parts)
+            if len(last_line_without_line_break) != 0:
+                yield last_line_without_line_break
+        finally:
+            chunks.close()
+        SubProcessExecution._finish_streamed(observers, args, process, start_time, stdout_size, stderr_tail,
+                                             check_error_code)
+
+    @staticmethod
+    def stream_jsonl(args: List[str],
+                     check_error_code: bool = True,
+                     working_directory: Optional[Path] = None,
+                     logging_level: str = "DEBUG",
+                     custom_input: Optional[CustomInput] = None,
+                     stderr_tail_bytes: int = 64 * 1024,
+                     environment: Optional[Dict[str, str]] = None) -> Iterator[Any]:
+        # yields the records of JSON Lines output while the command is running, empty lines are skipped
+        # after an invalid line, the rest of the output is discarded and a SubProcessOutputParseException is raised
+        # when the command exited, unless it failed (then the SubProcessExecutionException is raised instead)
+        SubProcessExecution._log_execute_call(args, working_directory, logging_level)
+        observers = ExecutionObservers.current()
+        ExecutionObservers.notify_start(observers, args, working_directory)
+        start_time = time.perf_counter()
+        try:
+            process = ProcessSpawner.start(args, working_directory, custom_input is not None,
+                                           environment=SubProcessExecution._merge_environment(environment))
+        except SubProcessException as start_exception:
+            ExecutionObservers.notify_failure(observers, args, start_exception)
+            raise
+        parser = JsonLinesParser()
+        parse_error: Optional[ValueError] = None
+        stderr_tail = TailBuffer(stderr_tail_bytes)
+        stdout_size = 0
+        chunks = SubProcessExecution._stdout_chunks(process, custom_input, stderr_tail)
+        try:
+            for chunk in chunks:
+                stdout_size += len(chunk)
+                if parse_error is None:
+                    try:
+                        records = parser.feed(chunk)
+                    except ValueError as value_error:
+                        parse_error = value_error
+                        continue
+                    yield from records
+            if parse_error is None:
+                try:
+                    records = parser.finish()
+                except ValueError as value_error:
+                    parse_error = value_error
+                else:
+                    yield from records
+        finally:
+            chunks.close()
+        SubProcessExecution._finish_streamed(observers, args, process, start_time, stdout_size, stderr_tail,
+                                             check_error_code, parse_error, parser.line_number)
+
+    @staticmethod
+    def execute_json(args: List[str],
+                     check_error_code: bool = True,
+                     working_directory: Optional[Path] = None,
+                     logging_level: str = "DEBUG",
+                     custom_input: Optional[CustomInput] = None,
+                     stderr_tail_bytes: int = 64 * 1024,
+                     environment: Optional[Dict[str, str]] = None) -> Any:
+        # returns the parsed JSON document printed by the command, it is parsed while the command is writing it:
+        # the elements of a top-level array are parsed as soon as they are complete and their text is dropped,
+        # any other document is kept as raw bytes (not as text) until it is complete
+        SubProcessExecution._log_execute_call(args, working_directory, logging_level)
+        observers = ExecutionObservers.current()
+        ExecutionObservers.notify_start(observers, args, working_directory)
+        start_time = time.perf_counter()
+        try:
+            process = ProcessSpawner.start(args, working_directory, custom_input is not None,
+                                           environment=SubProcessExecution._merge_environment(environment))
+        except SubProcessException as start_exception:
+            ExecutionObservers.notify_failure(observers, args, start_exception)
+            raise
+        parser = JsonDocumentParser()
+        parse_error: Optional[ValueError] = None
+        document: Any = None
+        stderr_tail = TailBuffer(stderr_tail_bytes)
+        stdout_size = 0
+        chunks = SubProcessExecution._stdout_chunks(process, custom_input, stderr_tail)
+        try:
+            for chunk in chunks:
+                stdout_size += len(chunk)
+                if parse_error is None:
+                    try:
+                        parser.feed(chunk)
+                    except ValueError as value_error:
+                        parse_error = value_error
+        finally:
+            chunks.close()
+        # a failed command is reported instead of its (probably incomplete) document
+        if parse_error is None and (not check_error_code or process.returncode == 0):
+            try:
+                document = parser.finish()
+            except ValueError as value_error:
+                parse_error = value_error
+        SubProcessExecution._finish_streamed(observers, args, process, start_time, stdout_size, stderr_tail,
+                                             check_error_code, parse_error)
+        return document
+
+    @staticmethod
+    def _stdout_chunks(process: Process,
+                       custom_input: Optional[CustomInput],
+                       stderr_tail: TailBuffer) -> Generator[bytes, None, None]:
+        # yields the raw stdout of the process in the chunks it arrives in and waits for the process at the end
+        # if the generator is closed before, the process is killed
+        ready_chunks: Deque[bytes] = collections.deque()
+        pump = SubProcessExecution._create_process_pump(process, ready_chunks.append, stderr_tail.write, custom_input)
+        try:
+            while pump.active:
+                pump.poll()
+                while len(ready_chunks) != 0:
+                    yield ready_chunks.popleft()
+            process.wait()
+        finally:
+            SubProcessExecution._close_process_pump(process, pump)
+
+    @staticmethod
+    def _finish_streamed(observers: Tuple[ExecutionObserver, ...],
+                         args: List[str],
+                         process: Process,
+                         start_time: float,
+                         stdout_size: int,
+                         stderr_tail: TailBuffer,
+                         check_error_code: bool,
+                         parse_error: Optional[ValueError] = None,
+                         line_number: Optional[int] = None) -> None:
+        # raises the failure of a streamed command and notifies the observers about its end, the result for the
+        # observers has no stdout, it has been passed on while streaming
+        try:
+            if check_error_code:
+                SubProcessExecution._check_streamed_exit_code(args, process, start_time, stderr_tail)
+            if parse_error is not None:
+                raise SubProcessExecution._output_parse_exception(args, process, start_time, stderr_tail,
+                                                                  parse_error, line_number) from parse_error
+        except SubProcessException as sub_process_exception:
+            ExecutionObservers.notify_failure(observers, args, sub_process_exception)
+            raise
+        assert process.returncode is not None
+        ExecutionObservers.notify_complete(observers, args, Result(
+            exit_code=process.returncode,
+            stdout="",
+            stderr=stderr_tail.getvalue(),
+            stderr_stats=stderr_tail.stats,
+            execution_stats=SubProcessExecution._execution_stats(process, start_time),
+            stdout_size=stdout_size
+        ))
+
+    @staticmethod
+    def _check_streamed_exit_code(args: List[str], process: Process, start_time: float, stderr_tail: TailBuffer):
+        assert process.returncode is not None
+        if process.returncode != 0:
+            stderr_text = SubProcessExecution._decode_captured_output(stderr_tail)
+            SubProcessExecution._log_failed_command_output(None, stderr_text, False)
+            raise SubProcessExecutionException(list(args), process.returncode, "", stderr_text,
+                                               stderr_stats=stderr_tail.stats,
+                                               execution_stats=SubProcessExecution._execution_stats(process,
+                                                                                                    start_time))
+
+    @staticmethod
+    def _output_parse_exception(args: List[str],
+                                process: Process,
+                                start_time: float,
+                                stderr_tail: TailBuffer,
+                                parse_error: ValueError,
+                                line_number: Optional[int]) -> SubProcessOutputParseException:
+        assert process.returncode is not None
+        if isinstance(parse_error, json.JSONDecodeError):
+            # the position is relative to the text that has been parsed, which is only a part of the output
+            context = parse_error.doc[parse_error.pos:parse_error.pos + 100]
+            parse_error_text = f"{parse_error.msg} near {context!r}" if len(context) != 0 else parse_error.msg
+        else:
+            parse_error_text = str(parse_error)
+        return SubProcessOutputParseException(list(args), process.returncode, parse_error_text,
+                                              SubProcessExecution._decode_captured_output(stderr_tail),
+                                              stderr_tail.stats,
+                                              SubProcessExecution._execution_stats(process, start_time), line_number)
+
+    @staticmethod
+    def execute_pipeline(args_list: List[List[str]],
+                         check_error_code: bool = True,
+                         working_directory: Optional[Path] = None,
+                         logging_level: str = "DEBUG",
+                         custom_input: Optional[CustomInput] = None,
+                         capture: Optional[OutputCapture] = None,
+                         binary: bool = False,
+                         environment: Optional[Dict[str, str]] = None) -> PipelineResult:
+        # executes the commands connected like a shell pipeline, the stdout of a stage is directly connected to the
+        # stdin of the next stage by an OS pipe, so the data of the intermediate stages never passes this process
+        # only the stdout of the last stage and the stderr of all stages are captured
+        # a non-last stage killed by SIGPIPE is not a failure, it just got no reader anymore (e.g. "... | head")
+        # observers see the pipeline as a single execution, with the args of the stages joined by "|"
+        if len(args_list) == 0:
+            raise ValueError("A pipeline needs at least one command")
+        command_text = " | ".join(SubProcessExecution._get_command_text_for_logging(args, None) for args in args_list)
+        working_directory_note = f" in {working_directory}" if working_directory is not None else ""
+        _logger.log(logging._nameToLevel[logging_level], f"Executing pipeline: {command_text}{working_directory_note}")
+        pipeline_args = list(args_list[0])
+        for args in args_list[1:]:
+            pipeline_args += ["|"] + args
+        observers = ExecutionObservers.current()
+        ExecutionObservers.notify_start(observers, pipeline_args, working_directory)
+        try:
+            result = SubProcessExecution._execute_pipeline(args_list, check_error_code, working_directory,
+                                                           custom_input, capture, binary, environment)
+        except SubProcessException as sub_process_exception:
+            ExecutionObservers.notify_failure(observers, pipeline_args, sub_process_exception)
+            raise
+        ExecutionObservers.notify_complete(observers, pipeline_args, result)
+        return result
+
+    @staticmethod
+    def _execute_pipeline(args_list: List[List[str]],
+                          check_error_code: bool,
+                          working_directory: Optional[Path],
+                          custom_input: Optional[CustomInput],
+                          capture: Optional[OutputCapture],
+                          binary: bool,
+                          environment: Optional[Dict[str, str]]) -> PipelineResult:
+        capture = capture or FullCapture()
+        stdout_buffer = capture.create_buffer()
+        stderr_buffers = [capture.create_buffer() for _ in args_list]
+
+        start_time = time.perf_counter()
+        processes = SubProcessExecution._start_pipeline(args_list, working_directory, custom_input is not None,
+                                                        SubProcessExecution._merge_environment(environment))
+        spawn_latency_seconds = time.perf_counter() - start_time
+        pump = Pump()
+        try:
+            for process, stderr_buffer in zip(processes, stderr_buffers):
+                assert process.stderr is not None
+                pump.add_reader(process.stderr, stderr_buffer.write)
+            assert processes[-1].stdout is not None
+            pump.add_reader(processes[-1].stdout, stdout_buffer.write)
+            if custom_input is not None:
+                assert processes[0].stdin is not None
+                pump.add_writer(processes[0].stdin, InputSource.pumped_chunks(custom_input))
+            pump.run()
+            exit_codes = [process.wait() for process in processes]
+        finally:
+            pump.close()
+            for process in processes:
+                if process.returncode is None:
+                    process.kill()
+                    process.wait()
+        execution_stats = SubProcessExecution._pipeline_execution_stats(processes, start_time, spawn_latency_seconds)
+
+        failed_stages = [index for index, exit_code in enumerate(exit_codes)
+                         if exit_code != 0 and (exit_code != -signal.SIGPIPE or index == len(exit_codes) - 1)]
+        if check_error_code and len(failed_stages) != 0:
+            failed_stage = failed_stages[0]
+            stdout_text = SubProcessExecution._decode_captured_output(stdout_buffer)
+            stderr_text = SubProcessExecution._decode_captured_output(stderr_buffers[failed_stage])
+            SubProcessExecution._log_failed_command_output(stdout_text, stderr_text, False)
+            raise SubProcessPipelineException([list(args) for args in args_list], failed_stage, exit_codes,
+                                              stdout_text, stderr_text, stdout_buffer.stats,
+                                              stderr_buffers[failed_stage].stats, execution_stats)
+        stdout = stdout_buffer.getvalue()
+        return PipelineResult(
+            stage_exit_codes=exit_codes,
+            stdout=stdout if binary else Result._decode(stdout, stdout_buffer.stats),
+            stage_stderr_bytes=[stderr_buffer.getvalue() for stderr_buffer in stderr_buffers],
+            stdout_stats=stdout_buffer.stats,
+            execution_stats=execution_stats
+        )
+
+    @staticmethod
+    def _start_pipeline(args_list: List[List[str]],
+                        working_directory: Optional[Path],
+                        pipe_input: bool,
+                        environment: Optional[Mapping[str, str]]) -> List[ResourceUsagePopen]:
+        processes: List[ResourceUsagePopen] = []
+        stdin: Union[None, int, IO[Any]] = subprocess.PIPE if pipe_input else sys.stdin
+        try:
+            for args in args_list:
+                try:
+                    process = ResourceUsagePopen(args, cwd=working_directory, stdin=stdin,
+                                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=environment)
+                except (OSError, subprocess.SubprocessError) as sub_process_error:
+                    raise SubProcessStartException(list(args)) from sub_process_error
+                finally:
+                    # the read end is owned by the next stage now, keeping it open here would hide the end of file
+                    if len(processes) != 0:
+                        assert processes[-1].stdout is not None
+                        processes[-1].stdout.close()
+                processes.append(process)
+                stdin = process.stdout
+        except BaseException:
+            for started_process in processes:
+                started_process.kill()
+                started_process.wait()
+            raise
+        return processes
+
+    @staticmethod
+    def _pipeline_execution_stats(processes: List[ResourceUsagePopen],
+                                  start_time: float,
+                                  spawn_latency_seconds: float) -> ExecutionStats:
+        stage_stats = [ExecutionStats.from_resource_usage(0.0, None, process.resource_usage) for process in processes]
+        return SubProcessExecution._combined_execution_stats(stage_stats, time.perf_counter() - start_time,
+                                                             spawn_latency_seconds)
+
+    @staticmethod
+    def _combined_execution_stats(stats_list: Sequence[Optional[ExecutionStats]],
+                                  duration_seconds: float,
+                                  spawn_latency_seconds: Optional[float]) -> ExecutionStats:
+        # the CPU time is summed up over all commands, the max RSS is the one of the largest command
+        if any(stats is None or stats.cpu_seconds is None for stats in stats_list):
+            return ExecutionStats(duration_seconds, spawn_latency_seconds)
+        return ExecutionStats(duration_seconds, spawn_latency_seconds,
+                              sum(stats.user_cpu_seconds or 0.0 for stats in stats_list if stats is not None),
+                              sum(stats.system_cpu_seconds or 0.0 for stats in stats_list if stats is not None),
+                              max((stats.max_rss_bytes or 0 for stats in stats_list if stats is not None), default=0))
+
+    @staticmethod
+    def execute_many(args_list: Iterable[List[str]],
+                     check_error_code: bool = True,
+                     follow_output: bool = False,
+                     working_directory: Optional[Path] = None,
+                     logging_level: str = "DEBUG",
+                     custom_input: Optional[CustomInput] = None,
+                     capture: Optional[OutputCapture] = None,
+                     binary: bool = False,
+                     spawn_backend: str = SPAWN_BACKEND_SUBPROCESS,
+                     fork_server: Optional[ForkServer] = None,
+                     cache: Optional[ResultCache] = None,
+                     cache_dependencies: Optional[Iterable[Path]] = None,
+                     environment: Optional[Dict[str, str]] = None,
+                     max_concurrency: Optional[int] = None,
+                     aggregate_failures: bool = False,
+                     limiter: Optional[AdaptiveLimiter] = None,
+                     reactor: Optional[ChildReactor] = None,
+                     limits: Optional[ResourceLimits] = None) -> List[Result]:
+        # executes the commands in parallel and returns the results in input order
+        # without aggregate_failures the first failure is raised and no further commands are started,
+        # otherwise all commands are executed and a SubProcessBatchException containing all failures is raised
+        # the custom_input is given to every command, so it must be reusable (e.g. not a generator)
+        # with a limiter, the number of parallel commands is adapted to the load of the host instead of max_concurrency
+        # with a reactor, all commands are supervised by the calling thread instead of a thread per command,
+        # which allows thousands of parallel commands (by default as many as the file descriptor limit allows)
+        # the limits apply to every single command
+        return SubProcessExecution._results_in_order(SubProcessExecution.execute_many_as_completed(
+            args_list, check_error_code=check_error_code, follow_output=follow_output,
+            working_directory=working_directory, logging_level=logging_level, custom_input=custom_input,
+            capture=capture, binary=binary, spawn_backend=spawn_backend, fork_server=fork_server, cache=cache,
+            cache_dependencies=cache_dependencies, environment=environment, max_concurrency=max_concurrency,
+            aggregate_failures=aggregate_failures, limiter=limiter, reactor=reactor, limits=limits))
+
+    @staticmethod
+    def execute_many_as_completed(args_list: Iterable[List[str]],
+                                  check_error_code: bool = True,
+                                  follow_output: bool = False,
+                                  working_directory: Optional[Path] = None,
+                                  logging_level: str = "DEBUG",
+                                  custom_input: Optional[CustomInput] = None,
+                                  capture: Optional[OutputCapture] = None,
+                                  binary: bool = False,
+                                  spawn_backend: str = SPAWN_BACKEND_SUBPROCESS,
+                                  fork_server: Optional[ForkServer] = None,
+                                  cache: Optional[ResultCache] = None,
+                                  cache_dependencies: Optional[Iterable[Path]] = None,
+                                  environment: Optional[Dict[str, str]] = None,
+                                  max_concurrency: Optional[int] = None,
+                                  aggregate_failures: bool = False,
+                                  limiter: Optional[AdaptiveLimiter] = None,
+                                  reactor: Optional[ChildReactor] = None,
+                                  limits: Optional[ResourceLimits] = None) -> Iterator[Tuple[int, Result]]:
+        # same as execute_many, but yields pairs of input index and result as soon as a command finishes
+        SubProcessExecution._check_reusable_input(custom_input)
+        outcomes: Generator[Tuple[int, Union[Result, SubProcessException]], None, None]
+        if reactor is not None:
+            if follow_output or fork_server is not None or cache is not None or limiter is not None \
+                    or isinstance(capture, FileCapture):
+                raise ValueError("A reactor can not be combined with follow_output, fork_server, cache, limiter "
+                                 "or FileCapture")
+            outcomes = SubProcessExecution._reactor_outcomes(args_list, reactor, check_error_code, working_directory,
+                                                             logging_level, custom_input, capture, environment,
+                                                             max_concurrency, limits)
+        else:
+            execute: Callable[[List[str]], Result] = functools.partial(
+                SubProcessExecution.execute,
+                check_error_code=check_error_code,
+                follow_output=follow_output,
+                working_directory=working_directory,
+                logging_level=logging_level,
+                custom_input=custom_input,
+                capture=capture,
+                binary=binary,
+                spawn_backend=spawn_backend,
+                fork_server=fork_server,
+                cache=cache,
+                cache_dependencies=None if cache_dependencies is None else list(cache_dependencies),
+                environment=environment,
+                limits=limits
+            )
+            outcomes = SubProcessExecution._execute_many_outcomes(args_list, execute, max_concurrency, limiter)
+        return SubProcessExecution._results_as_completed(outcomes, aggregate_failures)
+
+    @staticmethod
+    def execute_sharded(args: List[str],
+                        arguments: Iterable[str],
+                        check_error_code: bool = True,
+                        working_directory: Optional[Path] = None,
+                        logging_level: str = "DEBUG",
+                        capture: Optional[OutputCapture] = None,
+                        binary: bool = False,
+                        spawn_backend: str = SPAWN_BACKEND_SUBPROCESS,
+                        fork_server: Optional[ForkServer] = None,
+                        environment: Optional[Dict[str, str]] = None,
+                        max_concurrency: Optional[int] = None,
+                        max_args_per_shard: Optional[int] = None,
+                        limiter: Optional[AdaptiveLimiter] = None,
+                        reactor: Optional[ChildReactor] = None,
+                        limits: Optional[ResourceLimits] = None) -> ShardedResult:
+        # executes the args followed by the arguments (like xargs), split into as few command lines as the limit of
+        # the system for the size of arguments and environment allows, the shards are executed in parallel
+        # all shards are executed, failed shards are reported together in a SubProcessShardException
+        # nothing is executed if there are no arguments
+        if isinstance(capture, FileCapture):
+            raise ValueError("FileCapture can not be used for sharded commands")
+        start_time = time.perf_counter()
+        shard_argument_counts: List[int] = []
+
+        def shards() -> Iterator[List[str]]:
+            child_environment = SubProcessExecution._merge_environment(environment)
+            for shard in ArgumentSharder.shards(args, arguments, child_environment, max_args_per_shard):
+                shard_argument_counts.append(len(shard) - len(args))
+                yield shard
+
+        results: Dict[int, Result] = {}
+        try:
+            for index, result in SubProcessExecution.execute_many_as_completed(
+                    shards(), check_error_code=check_error_code, working_directory=working_directory,
+                    logging_level=logging_level, capture=capture, binary=binary, spawn_backend=spawn_backend,
+                    fork_server=fork_server, environment=environment, max_concurrency=max_concurrency,
+                    aggregate_failures=True, limiter=limiter, reactor=reactor,
+                    limits=limits):
+                results[index] = result
+        except SubProcessBatchException as batch_exception:
+            # a shard which can not be started is not a failure of the command, but of its invocation
+            for _, failure in batch_exception.failures:
+                if not isinstance(failure, SubProcessExecutionException):
+                    raise failure
+            shard_failures = [(index, failure) for index, failure in batch_exception.failures
+                              if isinstance(failure, SubProcessExecutionException)]
+            raise SubProcessShardException(list(args), shard_failures,
+                                           [results.get(index) for index in range(len(shard_argument_counts))]) \
+                from None
+
+        shard_results = [results[index] for index in range(len(shard_argument_counts))]
+        stdout: Union[str, bytes]
+        stderr: Union[str, bytes]
+        if binary:
+            stdout = b"".join(result.stdout_bytes for result in shard_results)
+            stderr = b"".join(result.stderr_bytes for result in shard_results)
+        else:
+            # every shard is decoded on its own, its output can not end within a character of the next shard
+            stdout = "".join(result.stdout for result in shard_results)
+            stderr = "".join(result.stderr for result in shard_results)
+        return ShardedResult(
+            shard_exit_codes=[result.exit_code for result in shard_results],
+            shard_argument_counts=shard_argument_counts,
+            stdout=stdout,
+            stderr=stderr,
+            stdout_stats=SubProcessExecution._combined_output_stats([result.stdout_stats for result in shard_results]),
+            stderr_stats=SubProcessExecution._combined_output_stats([result.stderr_stats for result in shard_results]),
+            execution_stats=SubProcessExecution._combined_execution_stats(
+                [result.execution_stats for result in shard_results], time.perf_counter() - start_time, None)
         )
 
+    @staticmethod
+    def _combined_output_stats(stats_list: List[Optional[OutputStats]]) -> Optional[OutputStats]:
+        if len(stats_list) == 0 or any(stats is None for stats in stats_list):
+            return None
+        return OutputStats(sum(stats.total_bytes for stats in stats_list if stats is not None),
+                           sum(stats.total_lines for stats in stats_list if stats is not None),
+                           sum(stats.captured_bytes for stats in stats_list if stats is not None))
+
+    @staticmethod
+    def _check_reusable_input(custom_input: Optional[CustomInput]) -> None:
+        if custom_input is not None and not InputSource.is_reusable(custom_input):
+            raise ValueError(f"custom_input of type {type(custom_input).__name__} can only be used for one command")
+
+    @staticmethod
+    def _results_as_completed(outcomes: Generator[Tuple[int, Union[Result, SubProcessException]], None, None],
+                              aggregate_failures: bool) -> Iterator[Tuple[int, Result]]:
+        # yields the results of the outcomes, without aggregate_failures the first failure is raised and stops the
+        # outcomes, otherwise the failures are raised together after the last result
+        failures: List[Tuple[int, SubProcessException]] = []
+        try:
+            for index, outcome in outcomes:
+                if isinstance(outcome, SubProcessException):
+                    if not aggregate_failures:
+                        raise outcome
+                    failures.append((index, outcome))
+                else:
+                    yield index, outcome
+        finally:
+            outcomes.close()
+        if len(failures) != 0:
+            raise SubProcessBatchException(sorted(failures, key=lambda failure: failure[0]))
+
+    @staticmethod
+    def _results_in_order(results_as_completed: Iterator[Tuple[int, Result]]) -> List[Result]:
+        # collects the results in input order, a SubProcessBatchException is raised again with the results
+        results: Dict[int, Result] = {}
+        try:
+            for index, result in results_as_completed:
+                results[index] = result
+        except SubProcessBatchException as batch_exception:
+            command_count = len(results) + len(batch_exception.failures)
+            raise SubProcessBatchException(batch_exception.failures,
+                                           [results.get(index) for index in range(command_count)]) from None
+        return [results[index] for index in range(len(results))]
+
+    @staticmethod
+    def _execute_many_outcomes(args_list: Iterable[List[str]],
+                               execute: Callable[[List[str]], Result],
+                               max_concurrency: Optional[int],
+                               limiter: Optional[AdaptiveLimiter] = None
+                               ) -> Generator[Tuple[int, Union[Result, SubProcessException]], None, None]:
+        if limiter is not None:
+            max_concurrency = limiter.max_limit
+        if max_concurrency is None:
+            max_concurrency = os.cpu_count() or 1
+        if max_concurrency < 1:
+            raise ValueError(f"max_concurrency must be at least 1, but was {max_concurrency}")
+
+        # commands are only submitted when a slot is free, so the args can be produced lazily
+        # and a failure stops further commands from being started
+        # a slot of the limiter is acquired before submitting and released by the worker, so the limit also holds
+        # together with other callers sharing the limiter, while commands of this call are running, the slot is only
+        # tried to be acquired, so their outcomes are not held back by the commands of other callers
+        indexed_args = enumerate(args_list)
+        in_flight: Dict[Future, int] = {}
+        next_args = next(indexed_args, None)
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            while True:
+                while next_args is not None and len(in_flight) < max_concurrency:
+                    if limiter is not None:
+                        if not limiter.acquire(timeout=0 if len(in_flight) != 0 else None):
+                            break
+                        execute_and_release = limiter.releasing(execute, AdaptiveLimiter.command_name)
+                        in_flight[executor.submit(execute_and_release, next_args[1])] = next_args[0]
+                    else:
+                        in_flight[executor.submit(execute, next_args[1])] = next_args[0]
+                    next_args = next(indexed_args, None)
+                if len(in_flight) == 0:
+                    return
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    outcome: Union[Result, SubProcessException]
+                    try:
+                        outcome = future.result()
+                    except SubProcessException as sub_process_exception:
+                        outcome = sub_process_exception
+                    yield in_flight.pop(future), outcome
+
+    @staticmethod
+    def _reactor_outcomes(args_list: Iterable[List[str]],
+                          reactor: ChildReactor,
+                          check_error_code: bool,
+                          working_directory: Optional[Path],
+                          logging_level: str,
+                          custom_input: Optional[CustomInput],
+                          capture: Optional[OutputCapture],
+                          environment: Optional[Dict[str, str]],
+                          max_concurrency: Optional[int],
+                          limits: Optional[ResourceLimits]
+                          ) -> Generator[Tuple[int, Union[Result, SubProcessException]], None, None]:
+        if capture is None:
+            capture = FullCapture()
+        child_environment = SubProcessExecution._merge_environment(environment)
+        observers = ExecutionObservers.current()
+
+        def tasks() -> Iterator[ReactorTask]:
+            assert capture is not None
+            for index, args in enumerate(args_list):
+                SubProcessExecution._log_execute_call(args, working_directory, logging_level)
+                ExecutionObservers.notify_start(observers, args, working_directory)
+                yield ReactorTask(index, args, working_directory, custom_input, child_environment,
+                                  capture.create_buffer(), capture.create_buffer(), limits)
+
+        finished_tasks = reactor.run(tasks(), max_concurrency)
+        try:
+            for task in finished_tasks:
+                outcome: Union[Result, SubProcessException]
+                try:
+                    if task.start_exception is not None:
+                        raise task.start_exception
+                    assert task.exit_code is not None
+                    outcome = SubProcessExecution._result_from_buffers(task.args, check_error_code, False,
+                                                                       task.exit_code, task.stdout_buffer,
+                                                                       task.stderr_buffer, task.execution_stats,
+                                                                       task.limits, task.output_limit_exceeded)
+                except SubProcessException as sub_process_exception:
+                    ExecutionObservers.notify_failure(observers, task.args, sub_process_exception)
+                    outcome = sub_process_exception
+                else:
+                    ExecutionObservers.notify_complete(observers, task.args, outcome)
+                yield task.index, outcome
+        finally:
+            finished_tasks.close()
+
+    @staticmethod
+    def _merge_environment(environment: Optional[Dict[str, str]]) -> Optional[Dict[str, str]]:
+        # None keeps the environment of this process without copying it
+        if environment is None:
+            return None
+        merged_environment = dict(os.environ)
+        merged_environment.update(environment)
+        return merged_environment
+
     @staticmethod
     def _output_to_string(output):
-        return "" if output is None else str(output)
+        if output is None:
+            return ""
+        elif isinstance(output, bytes):
+            return SubProcessExecution._decode_output(output, errors="replace")
+        return str(output)
+
+    @staticmethod
+    def _decode_output(output: Union[None, bytes, memoryview], errors: str = "strict") -> str:
+        # equivalent to the decoding of subprocess in text mode, including the translation of newlines
+        if output is None:
+            return ""
+        return str(output, "utf-8", errors).replace("\r\n", "\n").replace("\r", "\n")
+
+    @staticmethod
+    def _decode_output_tail(output: Union[bytes, memoryview]) -> str:
+        # the tail of an output might start in the middle of a multi-byte character, which is skipped
+        start = 0
+        while start < min(len(output), 3) and output[start] & 0b11000000 == 0b10000000:
+            start += 1
+        return SubProcessExecution._decode_output(output[start:], errors="replace")
+
+    @staticmethod
+    def _log_failed_command_output(stdout: Optional[str], stderr: Optional[str], follow_output: bool):
+        if not follow_output:
+            if stdout:
+                _logger.info("Stdout of failed command:\n" + stdout)
+            if stderr:
+                _logger.info("Stderr of failed command:\n" + stderr)
+        else:
+            _logger.info("Output of failed command has been redirected to stdout and stderr streams.")
 
     @staticmethod
-    def _log_execute_call(args: Iterable[str], working_directory: Optional[Path], log_level: str):
-        command_text = SubProcessExecution._get_command_text_for_logging(args, working_directory)
-        log_level_int: int = logging._nameToLevel[log_level]
-        _logger.log(log_level_int, f"Executing command: {command_text}")
+    def _log_execute_call(args: Iterable[str], working_directory: Optional[Path], log_level: Union[str, int]):
+        log_level_int: int = log_level if isinstance(log_level, int) else logging._nameToLevel[log_level]
+        # the command text is only formatted if it is actually logged
+        if _logger.isEnabledFor(log_level_int):
+            command_text = SubProcessExecution._get_command_text_for_logging(args, working_directory)
+            _logger.log(log_level_int, f"Executing command: {command_text}")
 
     @staticmethod
     def _get_command_text_for_logging(args: Iterable[str], working_directory: Optional[Path]) -> str:
@@ -0,0 +1,337 @@
+import os
+import sys
+
+import hmac
+import logging
+import selectors
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+from abc import abstractmethod
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Mapping, Optional, Tuple, Union
+
+from tjpy_subprocess_util.exception import SubProcessAuthenticationException, SubProcessStartException
+from tjpy_subprocess_util.instrumentation import ExecutionStats
+from tjpy_subprocess_util.pump import ChunkFeeder, Pump
+from tjpy_subprocess_util.spawn import ProcessSpawner, SPAWN_BACKEND_SUBPROCESS
+from tjpy_subprocess_util.wire import FrameStream
+
+_logger = logging.getLogger(__name__)
+
+_FRAME_REQUEST = b"R"
+_FRAME_INPUT = b"I"
+_FRAME_INPUT_END = b"i"
+_FRAME_STDOUT = b"O"
+_FRAME_STDERR = b"E"
+_FRAME_EXIT = b"X"
+_FRAME_START_FAILURE = b"S"
+_FRAME_REJECTED = b"A"
+# how long a rejected client gets to close the connection, while the rest of its request is discarded
+_REJECTED_DRAIN_SECONDS = 5.0
+
+_INPUT_CHUNK_SIZE = 64 * 1024
+
+
+class CommandRunner:
+    # executes commands outside of this process, the output is streamed back and passed to the callbacks
+
+    @abstractmethod
+    def run(self,
+            args: List[str],
+            working_directory: Optional[Path],
+            custom_input: Optional[Iterable[Union[bytes, memoryview]]],
+            on_stdout: Callable[[bytes], None],
+            on_stderr: Callable[[bytes], None],
+            spawn_backend: str = SPAWN_BACKEND_SUBPROCESS,
+            environment: Optional[Mapping[str, str]] = None,
+            executable: Optional[str] = None) -> Tuple[int, ExecutionStats]:
+        # returns the exit code and the stats of the execution
+        # executable is the program to execute instead of args[0], as for ProcessSpawner.start
+        pass
+
+
+class ForkServer(CommandRunner):
+    # small helper process which should be started early, while the parent process is still small
+    # commands are spawned by the helper instead of the (possibly huge and multi-threaded) parent process
+    # the helper exits as soon as the parent process exits or the fork server is stopped
+    # commands spawned by the helper do not inherit the stdin of the parent process, but can get custom input
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._process: Optional[subprocess.Popen] = None
+        self._directory: Optional[str] = None
+        self._socket_path: Optional[str] = None
+
+    @property
+    def running(self) -> bool:
+        return self._process is not None and self._process.poll() is None
+
+    def start(self) -> None:
+        with self._lock:
+            if self.running:
+                return
+            if not hasattr(os, "fork") or not hasattr(socket, "AF_UNIX"):
+                raise OSError("The fork server is only supported on POSIX systems.")
+            # the directory is only accessible by the current user, which protects the socket
+            self._directory = tempfile.mkdtemp(prefix="tjpy_subprocess_util_forkserver_")
+            socket_path = os.path.join(self._directory, "socket")
+            package_parent_directory = str(Path(__file__).resolve().parent.parent)
+            server_code = f"import sys; sys.path.insert(0, {package_parent_directory!r}); " \
+                f"from tjpy_subprocess_util.forkserver import ForkServer; " \
+                f"ForkServer._serve({socket_path!r})"
+            self._process = subprocess.Popen([sys.executable, "-c", server_code],
+                                             stdin=subprocess.PIPE,
+                                             stdout=subprocess.PIPE)
+            assert self._process.stdout is not None
+            if self._process.stdout.readline() != b"ready\n":
+                self._stop()
+                raise OSError("The fork server could not be started.")
+            self._socket_path = socket_path
+            _logger.debug(f"Started fork server with pid {self._process.pid} listening on {socket_path}")
+
+    def stop(self) -> None:
+        with self._lock:
+            self._stop()
+
+    def _stop(self) -> None:
+        if self._process is not None:
+            # closing the pipe to the helper makes it exit
+            assert self._process.stdin is not None and self._process.stdout is not None
+            self._process.stdin.close()
+            self._process.stdout.close()
+            self._process.wait()
+            self._process = None
+        if self._directory is not None:
+            shutil.rmtree(self._directory, ignore_errors=True)
+            self._directory = None
+        self._socket_path = None
+
+    def __enter__(self) -> "ForkServer":
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.stop()
+
+    def run(self,
+            args: List[str],
+            working_directory: Optional[Path],
+            custom_input: Optional[Iterable[Union[bytes, memoryview]]],
+            on_stdout: Callable[[bytes], None],
+            on_stderr: Callable[[bytes], None],
+            spawn_backend: str = SPAWN_BACKEND_SUBPROCESS,
+            environment: Optional[Mapping[str, str]] = None,
+            executable: Optional[str] = None) -> Tuple[int, ExecutionStats]:
+        # executes the command through the helper, the output is streamed back and passed to the callbacks
+        # without an environment, the command gets the environment this process had when the helper was started
+        # returns the exit code and the stats of the execution, the resource usage is determined by the helper
+        if not self.running or self._socket_path is None:
+            raise RuntimeError("The fork server has not been started.")
+        start_time = time.perf_counter()
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(self._socket_path)
+        return ForkServer._run_on_connection(connection, "the fork server", {
+            "args": list(args),
+            "working_directory": None if working_directory is None else str(working_directory),
+            "pipe_input": custom_input is not None,
+            "spawn_backend": spawn_backend,
+            "environment": None if environment is None else dict(environment),
+            "executable": executable,
+        }, custom_input, on_stdout, on_stderr, start_time)
+
+    @staticmethod
+    def _run_on_connection(connection: socket.socket,
+                           peer_name: str,
+                           request: Dict[str, Any],
+                           custom_input: Optional[Iterable[Union[bytes, memoryview]]],
+                           on_stdout: Callable[[bytes], None],
+                           on_stderr: Callable[[bytes], None],
+                           start_time: float) -> Tuple[int, ExecutionStats]:
+        # client side of a request to a helper, the connection is closed afterwards
+        args = request["args"]
+        frames = FrameStream(connection)
+        # an error raised by the custom input in the sending thread, it is raised again on the calling thread
+        input_errors: List[BaseException] = []
+        try:
+            frames.send_json(_FRAME_REQUEST, request)
+            if custom_input is not None:
+                # the input is sent concurrently, otherwise a command producing output before reading all its input
+                # could block forever
+                threading.Thread(target=ForkServer._send_input, args=(frames, custom_input, input_errors),
+                                 daemon=True).start()
+            while True:
+                frame = frames.receive()
+                if frame is None:
+                    raise ConnectionError(f"Connection to {peer_name} has been lost while executing {args}.")
+                frame_type, payload = frame
+                if frame_type == _FRAME_STDOUT:
+                    on_stdout(payload)
+                elif frame_type == _FRAME_STDERR:
+                    on_stderr(payload)
+                elif frame_type == _FRAME_EXIT:
+                    if len(input_errors) != 0:
+                        raise input_errors[0]
+                    exit_message = FrameStream.decode_json(payload)
+                    helper_stats = exit_message["execution_stats"]
+                    helper_stats["duration_seconds"] = time.perf_counter() - start_time
+                    return int(exit_message["exit_code"]), ExecutionStats(**helper_stats)
+                elif frame_type == _FRAME_START_FAILURE:
+                    start_error = OSError(FrameStream.decode_json(payload)["error"])
+                    raise SubProcessStartException(list(args)) from start_error
+                elif frame_type == _FRAME_REJECTED:
+                    raise SubProcessAuthenticationException(list(args), peer_name)
+                else:
+                    raise ConnectionError(f"Unexpected frame {frame_type!r} from {peer_name}.")
+        except OSError:
+            # the connection has been shut down because the custom input failed
+            if len(input_errors) != 0:
+                raise input_errors[0]
+            raise
+        finally:
+            frames.close()
+
+    @staticmethod
+    def _send_input(frames: FrameStream,
+                    custom_input: Iterable[Union[bytes, memoryview]],
+                    input_errors: List[BaseException]) -> None:
+        chunks = iter(custom_input)
+        while True:
+            try:
+                chunk = next(chunks, None)
+            except BaseException as input_error:
+                input_errors.append(input_error)
+                # without the end of the input, the helper kills the command, the shutdown also ends the wait of the
+                # calling thread for the output
+                try:
+                    frames.shutdown()
+                except OSError:
+                    pass
+                return
+            try:
+                if chunk is None:
+                    frames.send(_FRAME_INPUT_END)
+                    return
+                chunk_view = memoryview(chunk)
+                for offset in range(0, len(chunk_view), _INPUT_CHUNK_SIZE):
+                    frames.send(_FRAME_INPUT, chunk_view[offset:offset + _INPUT_CHUNK_SIZE])
+            except OSError:
+                # the connection has already been closed, e.g. because the command exited without reading all input
+                return
+
+    @staticmethod
+    def _serve(socket_path: str) -> None:
+        # entry point of the helper process
+        # every connection is handled by a thread, spawning from the small helper is cheap in contrast to forking it
+        # stdin is a pipe from the parent process, which becomes readable (end of file) when the parent exits
+        # commands must not read from it, so it is replaced by /dev/null for them
+        parent_pipe = os.dup(0)
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(devnull, 0)
+        os.close(devnull)
+
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(socket_path)
+        listener.listen(128)
+        selector = selectors.DefaultSelector()
+        selector.register(listener, selectors.EVENT_READ)
+        selector.register(parent_pipe, selectors.EVENT_READ)
+        sys.stdout.buffer.write(b"ready\n")
+        sys.stdout.buffer.flush()
+
+        while True:
+            for key, _ in selector.select():
+                if key.fileobj is not listener:
+                    # the directory is also removed here in case the parent process exited without stopping the helper
+                    listener.close()
+                    shutil.rmtree(os.path.dirname(socket_path), ignore_errors=True)
+                    return
+                connection, _ = listener.accept()
+                threading.Thread(target=ForkServer._handle, args=(connection,), daemon=True).start()
+
+    @staticmethod
+    def _handle(connection: socket.socket, token: Optional[str] = None) -> None:
+        # server side of a request, with a token only requests containing the same token are executed
+        # an "environment_overlay" of the request is merged into the environment of the server
+        frames = FrameStream(connection)
+        frame = frames.receive()
+        if frame is None or frame[0] != _FRAME_REQUEST:
+            frames.close()
+            return
+        request = FrameStream.decode_json(frame[1])
+        if token is not None and not hmac.compare_digest(str(request.get("token", "")).encode("utf-8"),
+                                                         token.encode("utf-8")):
+            _logger.warning(f"Rejected request with invalid token from {connection.getpeername()!r}")
+            ForkServer._reject(connection, frames)
+            return
+        working_directory = request["working_directory"]
+        environment = request["environment"]
+        if request.get("environment_overlay") is not None:
+            environment = dict(os.environ)
+            environment.update(request["environment_overlay"])
+        start_time = time.perf_counter()
+        try:
+            process = ProcessSpawner.start(request["args"],
+                                           None if working_directory is None else Path(working_directory),
+                                           request["pipe_input"],
+                                           spawn_backend=request["spawn_backend"],
+                                           environment=environment,
+                                           executable=request.get("executable"))
+        except SubProcessStartException as start_exception:
+            frames.send_json(_FRAME_START_FAILURE, {"error": str(start_exception.__cause__)})
+            frames.close()
+            return
+
+        pump = Pump()
+        assert process.stdout is not None and process.stderr is not None
+        pump.add_reader(process.stdout, lambda data: frames.send(_FRAME_STDOUT, data))
+        pump.add_reader(process.stderr, lambda data: frames.send(_FRAME_STDERR, data))
+        if request["pipe_input"]:
+            assert process.stdin is not None
+            pump.add_writer(process.stdin, ChunkFeeder(ForkServer._received_input(frames)))
+        try:
+            pump.run()
+            exit_code = process.wait()
+        except OSError as connection_error:
+            # the client is gone or its input failed, the command is killed below
+            _logger.debug(f"Aborted command {request['args']!r}: {connection_error}")
+            frames.close()
+            return
+        finally:
+            pump.close()
+            if process.returncode is None:
+                process.kill()
+                process.wait()
+        execution_stats = ExecutionStats.from_resource_usage(time.perf_counter() - start_time,
+                                                             process.spawn_latency_seconds, process.resource_usage)
+        frames.send_json(_FRAME_EXIT, {"exit_code": exit_code, "execution_stats": vars(execution_stats)})
+        frames.close()
+
+    @staticmethod
+    def _reject(connection: socket.socket, frames: FrameStream) -> None:
+        # the client is told about the rejection instead of only losing the connection
+        # input it already sent is read until it closes the connection, closing with unread data would reset the
+        # connection and the client might lose the rejection
+        try:
+            frames.send(_FRAME_REJECTED)
+            frames.shutdown_sending()
+            connection.settimeout(_REJECTED_DRAIN_SECONDS)
+            while frames.receive() is not None:
+                pass
+        except OSError:
+            pass
+        finally:
+            frames.close()
+
+    @staticmethod
+    def _received_input(frames: FrameStream) -> Iterator[bytes]:
+        while True:
+            frame = frames.receive()
+            if frame is None:
+                raise ConnectionError("Connection has been lost before the end of the input.")
+            if frame[0] != _FRAME_INPUT:
+                return
+            yield frame[1]
@@ -0,0 +1,109 @@
+import sys
+
+import logging
+import threading
+from pathlib import Path
+from typing import Any, List, Optional, Tuple
+
+_logger = logging.getLogger(__name__)
+
+
+class ExecutionStats:
+    # timing and resource usage of a single execution, values which could not be determined are None
+    # (e.g. the resource usage of the child is only available on POSIX systems)
+
+    def __init__(self,
+                 duration_seconds: float,
+                 spawn_latency_seconds: Optional[float] = None,
+                 user_cpu_seconds: Optional[float] = None,
+                 system_cpu_seconds: Optional[float] = None,
+                 max_rss_bytes: Optional[int] = None):
+        self.duration_seconds = duration_seconds
+        self.spawn_latency_seconds = spawn_latency_seconds
+        self.user_cpu_seconds = user_cpu_seconds
+        self.system_cpu_seconds = system_cpu_seconds
+        self.max_rss_bytes = max_rss_bytes
+
+    @property
+    def cpu_seconds(self) -> Optional[float]:
+        if self.user_cpu_seconds is None or self.system_cpu_seconds is None:
+            return None
+        return self.user_cpu_seconds + self.system_cpu_seconds
+
+    @staticmethod
+    def from_resource_usage(duration_seconds: float,
+                            spawn_latency_seconds: Optional[float],
+                            resource_usage: Any) -> "ExecutionStats":
+        if resource_usage is None:
+            return ExecutionStats(duration_seconds, spawn_latency_seconds)
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        # on Linux it also covers the memory of the forked child before exec, so small commands report at least that
+        max_rss_bytes = resource_usage.ru_maxrss if sys.platform == "darwin" else resource_usage.ru_maxrss * 1024
+        return ExecutionStats(duration_seconds, spawn_latency_seconds,
+                              resource_usage.ru_utime, resource_usage.ru_stime, max_rss_bytes)
+
+    def __repr__(self) -> str:
+        return f"ExecutionStats({', '.join(f'{name}={value!r}' for name, value in vars(self).items())})"
+
+
+class ExecutionObserver:
+    # base class for hooks which are notified about every execution, e.g. to feed metrics
+    # observers are called on the thread of the execution and must therefore be thread-safe and fast
+
+    def on_start(self, args: List[str], working_directory: Optional[Path]) -> None:
+        pass
+
+    def on_complete(self, args: List[str], result: Any) -> None:
+        # result is the Result of the execution, which also carries the ExecutionStats
+        pass
+
+    def on_failure(self, args: List[str], exception: Exception) -> None:
+        # exception is the SubProcessException raised by the execution
+        pass
+
+
+class ExecutionObservers:
+    # the registered observers are kept in an immutable tuple, so notifying never needs a lock
+    _observers: Tuple[ExecutionObserver, ...] = ()
+    _lock = threading.Lock()
+
+    @staticmethod
+    def register(observer: ExecutionObserver) -> None:
+        with ExecutionObservers._lock:
+            ExecutionObservers._observers = ExecutionObservers._observers + (observer,)
+
+    @staticmethod
+    def unregister(observer: ExecutionObserver) -> None:
+        with ExecutionObservers._lock:
+            ExecutionObservers._observers = tuple(registered for registered in ExecutionObservers._observers
+                                                  if registered is not observer)
+
+    @staticmethod
+    def current() -> Tuple[ExecutionObserver, ...]:
+        return ExecutionObservers._observers
+
+    @staticmethod
+    def notify_start(observers: Tuple[ExecutionObserver, ...],
+                     args: List[str],
+                     working_directory: Optional[Path]) -> None:
+        for observer in observers:
+            try:
+                observer.on_start(args, working_directory)
+            except Exception:
+                _logger.exception(f"Observer {observer} failed on the start of command {args}")
+
+    @staticmethod
+    def notify_complete(observers: Tuple[ExecutionObserver, ...], args: List[str], result: Any) -> None:
+        for observer in observers:
+            try:
+                observer.on_complete(args, result)
+            except Exception:
+                _logger.exception(f"Observer {observer} failed on the completion of command {args}")
+
+    @staticmethod
+    def notify_failure(observers: Tuple[ExecutionObserver, ...], args: List[str], exception: Exception) -> None:
+        for observer in observers:
+            try:
+                observer.on_failure(args, exception)
+            except Exception:
+                _logger.exception(f"Observer {observer} failed on the failure of command {args}")
@@ -0,0 +1,187 @@
+import os
+
+import logging
+import resource
+import shutil
+import signal
+from pathlib import Path
+from typing import Callable, List, Optional
+
+from tjpy_subprocess_util.exception import SubProcessCpuTimeLimitException, SubProcessExecutionException, \
+    SubProcessFileSizeLimitException, SubProcessOutputLimitException
+
+_logger = logging.getLogger(__name__)
+
+IO_PRIORITY_CLASS_REALTIME = 1
+IO_PRIORITY_CLASS_BEST_EFFORT = 2
+IO_PRIORITY_CLASS_IDLE = 3
+_CPU_MAX_PERIOD_MICROSECONDS = 100000
+
+
+class ResourceLimits:
+    # limits applied to a child before it executes the command, None keeps the limit inherited from this process
+    # they are applied by exec shims (prlimit, nice, ionice and sh for the cgroup), so the tools must be installed
+    # cpu_seconds, address_space_bytes, open_files and file_size_bytes are rlimits of the child,
+    # nice and the io priority lower its priority and cgroup is the directory of a cgroup v2 the child is moved into
+    # (if it is writable)
+    # output_bytes caps the output read from the pipes of the child (stdout and stderr together),
+    # the child is killed as soon as it writes more (an rlimit can not limit pipes, only files)
+    # breaches which can be told apart from an ordinary failure are raised as a subclass of SubProcessLimitException,
+    # address space and open files breaches only show up as failing allocations or opens within the command
+
+    def __init__(self,
+                 cpu_seconds: Optional[int] = None,
+                 address_space_bytes: Optional[int] = None,
+                 open_files: Optional[int] = None,
+                 file_size_bytes: Optional[int] = None,
+                 output_bytes: Optional[int] = None,
+                 nice: Optional[int] = None,
+                 io_priority_class: Optional[int] = None,
+                 io_priority_level: int = 4,
+                 cgroup: Optional[Path] = None):
+        self.cpu_seconds = cpu_seconds
+        self.address_space_bytes = address_space_bytes
+        self.open_files = open_files
+        self.file_size_bytes = file_size_bytes
+        self.output_bytes = output_bytes
+        self.nice = nice
+        self.io_priority_class = io_priority_class
+        self.io_priority_level = io_priority_level
+        self.cgroup = cgroup
+
+    def command_prefix(self) -> List[str]:
+        # the exec shims applying the limits, the command is appended to them
+        # every shim replaces itself with the next one, so the child keeps its pid and the command its args
+        # no python code runs in the forked child, which would not be safe in a process with other threads
+        # (and rules out the vfork of subprocess and posix_spawn)
+        prefix: List[str] = []
+        cgroup_procs = self._writable_cgroup_procs()
+        if cgroup_procs is not None:
+            # the shell moves itself into the cgroup, so the command is in it from the start
+            prefix += ["/bin/sh", "-c", 'echo $$ > "$0" && exec "$@"', cgroup_procs]
+        if self.io_priority_class is not None:
+            prefix += [ResourceLimits._shim_path("ionice"), "-c", str(self.io_priority_class)]
+            if self.io_priority_class != IO_PRIORITY_CLASS_IDLE:
+                prefix += ["-n", str(self.io_priority_level)]
+        if self.nice is not None:
+            prefix += [ResourceLimits._shim_path("nice"), "-n", str(self.nice)]
+        rlimit_options: List[str] = []
+        if self.cpu_seconds is not None:
+            # the soft limit sends SIGXCPU, the hard limit one second later kills a command which ignores it
+            rlimit_options.append(ResourceLimits._rlimit_option("cpu", resource.RLIMIT_CPU, self.cpu_seconds,
+                                                                self.cpu_seconds + 1))
+        if self.address_space_bytes is not None:
+            rlimit_options.append(ResourceLimits._rlimit_option("as", resource.RLIMIT_AS, self.address_space_bytes))
+        if self.open_files is not None:
+            rlimit_options.append(ResourceLimits._rlimit_option("nofile", resource.RLIMIT_NOFILE, self.open_files))
+        if self.file_size_bytes is not None:
+            rlimit_options.append(ResourceLimits._rlimit_option("fsize", resource.RLIMIT_FSIZE,
+                                                                self.file_size_bytes))
+        if len(rlimit_options) != 0:
+            # the last shim, so the limits do not count the other shims
+            prefix += [ResourceLimits._shim_path("prlimit")] + rlimit_options + ["--"]
+        return prefix
+
+    def limit_exception(self,
+                        failure: SubProcessExecutionException,
+                        output_limit_exceeded: bool = False) -> SubProcessExecutionException:
+        # the failure as the exception of the limit it breached, if it can be attributed to one
+        if output_limit_exceeded:
+            return SubProcessOutputLimitException.from_failure(failure, self.output_bytes)
+        if self.cpu_seconds is not None:
+            execution_stats = failure.execution_stats
+            cpu_seconds = execution_stats.cpu_seconds if execution_stats is not None else None
+            killed_at_hard_limit = ResourceLimits._killed_by(failure.exit_code, signal.SIGKILL) \
+                and cpu_seconds is not None and cpu_seconds >= self.cpu_seconds
+            if ResourceLimits._killed_by(failure.exit_code, signal.SIGXCPU) or killed_at_hard_limit:
+                return SubProcessCpuTimeLimitException.from_failure(failure, self.cpu_seconds)
+        if self.file_size_bytes is not None and ResourceLimits._killed_by(failure.exit_code, signal.SIGXFSZ):
+            return SubProcessFileSizeLimitException.from_failure(failure, self.file_size_bytes)
+        return failure
+
+    @staticmethod
+    def _killed_by(exit_code: int, signal_number: int) -> bool:
+        # a shell running the command reports a process killed by a signal with the exit code 128 + signal
+        return exit_code in (-signal_number, 128 + signal_number)
+
+    @staticmethod
+    def create_cgroup(path: Path,
+                      memory_max_bytes: Optional[int] = None,
+                      cpu_max_fraction: Optional[float] = None,
+                      pids_max: Optional[int] = None) -> Optional[Path]:
+        # creates (or updates) a cgroup v2 below a delegated subtree, e.g. /sys/fs/cgroup/user.slice/.../commands
+        # the controllers must be enabled in the cgroup.subtree_control of the parent
+        # returns None if the cgroup can not be written, so the commands simply run without it
+        settings = {}
+        if memory_max_bytes is not None:
+            settings["memory.max"] = str(memory_max_bytes)
+        if cpu_max_fraction is not None:
+            settings["cpu.max"] = f"{int(cpu_max_fraction * _CPU_MAX_PERIOD_MICROSECONDS)} " \
+                f"{_CPU_MAX_PERIOD_MICROSECONDS}"
+        if pids_max is not None:
+            settings["pids.max"] = str(pids_max)
+        try:
+            path.mkdir(exist_ok=True)
+            if not (path / "cgroup.procs").exists():
+                _logger.warning(f"{path} is not a cgroup v2, commands can not be placed into it")
+                return None
+            for file_name, value in settings.items():
+                (path / file_name).write_text(value)
+        except OSError as os_error:
+            _logger.warning(f"Cgroup {path} can not be used: {os_error}")
+            return None
+        return path
+
+    @staticmethod
+    def _rlimit_option(name: str, rlimit: int, soft_limit: int, hard_limit: Optional[int] = None) -> str:
+        # the hard limit is lowered as well, the child must not be able to raise the limit again
+        _, current_hard_limit = resource.getrlimit(rlimit)
+        if current_hard_limit != resource.RLIM_INFINITY and soft_limit > current_hard_limit:
+            raise ValueError(f"Limit {soft_limit} exceeds the hard limit {current_hard_limit} of this process")
+        hard_limit = hard_limit if hard_limit is not None else soft_limit
+        if current_hard_limit != resource.RLIM_INFINITY:
+            hard_limit = min(hard_limit, current_hard_limit)
+        return f"--{name}={soft_limit}:{hard_limit}"
+
+    @staticmethod
+    def _shim_path(name: str) -> str:
+        # prlimit and ionice are part of util-linux, nice of coreutils
+        path = shutil.which(name)
+        if path is None:
+            raise ValueError(f"The limits require {name}, which has not been found in the PATH")
+        return path
+
+    def _writable_cgroup_procs(self) -> Optional[str]:
+        if self.cgroup is None:
+            return None
+        cgroup_procs = self.cgroup / "cgroup.procs"
+        if not os.access(cgroup_procs, os.W_OK):
+            _logger.debug(f"Cgroup {self.cgroup} is not writable, the command is executed without it")
+            return None
+        return str(cgroup_procs)
+
+
+class OutputLimit:
+    # counts the output read from the pipes of a child and kills the child as soon as it exceeds max_bytes
+    # the output up to the limit is still passed on, everything after it is discarded
+
+    def __init__(self, max_bytes: int, kill: Callable[[], None]):
+        self.max_bytes = max_bytes
+        self.exceeded = False
+        self._kill = kill
+        self._total_bytes = 0
+
+    def wrap(self, on_data: Callable[[bytes], None]) -> Callable[[bytes], None]:
+        def on_limited_data(data: bytes) -> None:
+            if self.exceeded:
+                return
+            remaining_bytes = self.max_bytes - self._total_bytes
+            self._total_bytes += len(data)
+            if len(data) > remaining_bytes:
+                self.exceeded = True
+                if remaining_bytes > 0:
+                    on_data(data[:remaining_bytes])
+                self._kill()
+            else:
+                on_data(data)
+        return on_limited_data
@@ -0,0 +1,202 @@
+import os
+
+import bisect
+import json
+import tempfile
+import threading
+import weakref
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from tjpy_subprocess_util.exception import SubProcessExecutionException
+from tjpy_subprocess_util.instrumentation import ExecutionObserver, ExecutionStats
+
+DEFAULT_DURATION_BUCKETS_SECONDS: Tuple[float, ...] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                                                       10.0, 30.0, 60.0, 300.0)
+
+
+class CommandMetrics:
+    # lifetime aggregates of all executions of one command
+    # bucket_counts are not cumulative, the last bucket counts the executions slower than the largest bound
+
+    def __init__(self, bucket_bounds: Sequence[float]):
+        self.bucket_bounds = bucket_bounds
+        self.calls = 0
+        self.failures = 0
+        self.bucket_counts = [0] * (len(bucket_bounds) + 1)
+        self.duration_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.stdout_bytes = 0
+        self.stderr_bytes = 0
+
+    def record(self, failed: bool, execution_stats: Optional[ExecutionStats], stdout_bytes: int, stderr_bytes: int):
+        self.calls += 1
+        if failed:
+            self.failures += 1
+        if execution_stats is not None:
+            self.bucket_counts[bisect.bisect_left(self.bucket_bounds, execution_stats.duration_seconds)] += 1
+            self.duration_seconds += execution_stats.duration_seconds
+            self.cpu_seconds += execution_stats.cpu_seconds or 0.0
+        self.stdout_bytes += stdout_bytes
+        self.stderr_bytes += stderr_bytes
+
+    def add(self, other: "CommandMetrics") -> None:
+        self.calls += other.calls
+        self.failures += other.failures
+        self.bucket_counts = [count + other_count for count, other_count in zip(self.bucket_counts,
+                                                                                other.bucket_counts)]
+        self.duration_seconds += other.duration_seconds
+        self.cpu_seconds += other.cpu_seconds
+        self.stdout_bytes += other.stdout_bytes
+        self.stderr_bytes += other.stderr_bytes
+
+    @property
+    def timed_calls(self) -> int:
+        # executions which could not be started have no duration
+        return sum(self.bucket_counts)
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "failures": self.failures,
+            "duration_seconds": self.duration_seconds,
+            "cpu_seconds": self.cpu_seconds,
+            "stdout_bytes": self.stdout_bytes,
+            "stderr_bytes": self.stderr_bytes,
+            # pairs of the upper bound (None for the last bucket) and the count of the executions in the bucket
+            "duration_buckets": [[bound, count]
+                                 for bound, count in zip(list(self.bucket_bounds) + [None], self.bucket_counts)],
+        }
+
+
+class _ShardOwner:
+    # only kept in the thread-local storage to notice the exit of the thread
+    pass
+
+
+class MetricsRegistry(ExecutionObserver):
+    # aggregates the executions per command label, it is fed by registering it with ExecutionObservers.register
+    # every thread updates its own shard without any lock, the shards are only merged when taking a snapshot
+    # the shard of a thread which exited is folded into the retired metrics, so short-lived pools do not add up
+    # by default, the label of a command is the file name of the executable
+
+    def __init__(self,
+                 label: Optional[Callable[[List[str]], str]] = None,
+                 duration_buckets_seconds: Sequence[float] = DEFAULT_DURATION_BUCKETS_SECONDS,
+                 metric_prefix: str = "subprocess"):
+        self._label = label or MetricsRegistry.command_name
+        self._bucket_bounds = tuple(sorted(duration_buckets_seconds))
+        self._metric_prefix = metric_prefix
+        self._local = threading.local()
+        self._shards: List[Dict[str, CommandMetrics]] = []
+        self._retired_metrics: Dict[str, CommandMetrics] = {}
+        self._shards_lock = threading.Lock()
+
+    @staticmethod
+    def command_name(args: List[str]) -> str:
+        return os.path.basename(args[0]) if len(args) != 0 else ""
+
+    def on_complete(self, args: List[str], result: Any) -> None:
+        self._metrics(args).record(False, result.execution_stats, result.stdout_size_bytes, result.stderr_size_bytes)
+
+    def on_failure(self, args: List[str], exception: Exception) -> None:
+        execution_stats = None
+        if isinstance(exception, SubProcessExecutionException):
+            execution_stats = exception.execution_stats
+        self._metrics(args).record(True, execution_stats, 0, 0)
+
+    def snapshot(self) -> Dict[str, CommandMetrics]:
+        # the shards might be updated concurrently, so a snapshot might miss executions which are just completing
+        merged: Dict[str, CommandMetrics] = {}
+        with self._shards_lock:
+            for shard in [self._retired_metrics] + self._shards:
+                self._merge(merged, shard)
+        return merged
+
+    def to_prometheus_text(self) -> str:
+        snapshot = sorted(self.snapshot().items())
+        prefix = self._metric_prefix
+        lines: List[str] = []
+
+        def add_metric(name: str, metric_type: str, help_text: str, value: Callable[[CommandMetrics], float]):
+            lines.append(f"# HELP {prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{name} {metric_type}")
+            for label, metrics in snapshot:
+                lines.append(f"{prefix}_{name}{{command=\"{MetricsRegistry._escape(label)}\"}} {value(metrics)}")
+
+        add_metric("calls_total", "counter", "Number of executed commands.", lambda metrics: metrics.calls)
+        add_metric("failures_total", "counter", "Number of commands which failed or could not be started.",
+                   lambda metrics: metrics.failures)
+        add_metric("cpu_seconds_total", "counter", "User and system CPU time of the commands.",
+                   lambda metrics: metrics.cpu_seconds)
+        add_metric("stdout_bytes_total", "counter", "Bytes of stdout of the successful commands.",
+                   lambda metrics: metrics.stdout_bytes)
+        add_metric("stderr_bytes_total", "counter", "Bytes of stderr of the successful commands.",
+                   lambda metrics: metrics.stderr_bytes)
+
+        lines.append(f"# HELP {prefix}_duration_seconds Wall-clock duration of the commands.")
+        lines.append(f"# TYPE {prefix}_duration_seconds histogram")
+        for label, metrics in snapshot:
+            escaped_label = MetricsRegistry._escape(label)
+            cumulative_count = 0
+            for bound, count in zip(list(metrics.bucket_bounds) + [float("inf")], metrics.bucket_counts):
+                cumulative_count += count
+                bound_text = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{prefix}_duration_seconds_bucket{{command=\"{escaped_label}\",le=\"{bound_text}\"}} "
+                             f"{cumulative_count}")
+            lines.append(f"{prefix}_duration_seconds_sum{{command=\"{escaped_label}\"}} {metrics.duration_seconds}")
+            lines.append(f"{prefix}_duration_seconds_count{{command=\"{escaped_label}\"}} {metrics.timed_calls}")
+        return "\n".join(lines) + "\n"
+
+    def to_json(self) -> Dict[str, Any]:
+        return {label: metrics.to_json() for label, metrics in sorted(self.snapshot().items())}
+
+    def write_prometheus_text(self, path: Path) -> None:
+        # e.g. for the textfile collector of the node exporter, which requires the file to be replaced atomically
+        MetricsRegistry._write_atomically(path, self.to_prometheus_text())
+
+    def write_json(self, path: Path) -> None:
+        MetricsRegistry._write_atomically(path, json.dumps(self.to_json(), indent=2))
+
+    def _metrics(self, args: List[str]) -> CommandMetrics:
+        shard: Optional[Dict[str, CommandMetrics]] = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = {}
+            # the thread-local values are dropped when the thread exits, which retires the shard
+            self._local.shard_owner = _ShardOwner()
+            weakref.finalize(self._local.shard_owner, self._retire_shard, shard)
+            with self._shards_lock:
+                self._shards.append(shard)
+        label = self._label(args)
+        metrics = shard.get(label)
+        if metrics is None:
+            metrics = shard[label] = CommandMetrics(self._bucket_bounds)
+        return metrics
+
+    def _retire_shard(self, shard: Dict[str, CommandMetrics]) -> None:
+        with self._shards_lock:
+            self._shards.remove(shard)
+            self._merge(self._retired_metrics, shard)
+
+    def _merge(self, merged: Dict[str, CommandMetrics], shard: Dict[str, CommandMetrics]) -> None:
+        for label, metrics in list(shard.items()):
+            merged_metrics = merged.get(label)
+            if merged_metrics is None:
+                merged_metrics = merged[label] = CommandMetrics(self._bucket_bounds)
+            merged_metrics.add(metrics)
+
+    @staticmethod
+    def _escape(label: str) -> str:
+        return label.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+    @staticmethod
+    def _write_atomically(path: Path, content: str) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=str(path.parent), prefix=".tmp-")
+        try:
+            with os.fdopen(file_descriptor, "w", encoding="utf-8") as file:
+                file.write(content)
+            os.replace(temporary_path, str(path))
+        except BaseException:
+            os.unlink(temporary_path)
+            raise
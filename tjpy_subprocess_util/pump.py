@@ -0,0 +1,201 @@
+import os
+
+import selectors
+import threading
+from typing import Any, Callable, IO, Iterator, Optional, Union
+
+_CHUNK_SIZE = 64 * 1024
+
+
+class Pump:
+    # moves data between the pipes of sub-processes and callbacks using a single selector on the calling thread
+    # pipes are closed by the pump as soon as they reached their end, or when the pump is closed
+
+    def __init__(self, chunk_size: int = _CHUNK_SIZE) -> None:
+        self._selector = selectors.DefaultSelector()
+        self._chunk_size = chunk_size
+
+    # on_finish is called after the pipe reached its end and has been closed, but not when the pump is closed
+
+    def add_reader(self,
+                   pipe: IO,
+                   on_data: Callable[[bytes], None],
+                   on_finish: Optional[Callable[[], None]] = None) -> None:
+        self._selector.register(pipe, selectors.EVENT_READ, (self._read, pipe, on_data, on_finish))
+
+    def add_writer(self,
+                   pipe: IO,
+                   chunks: Union[Iterator[Union[bytes, memoryview]], "ChunkFeeder"],
+                   on_finish: Optional[Callable[[], None]] = None,
+                   close_pipe: bool = True) -> None:
+        # the pipe is switched to non-blocking mode so that a slow reader never blocks the other pipes
+        # chunks which might take a while to be produced should be given as a ChunkFeeder, so that a slow producer
+        # never blocks them either
+        # without close_pipe, the pipe stays open after the chunks have been written, e.g. for further writers
+        os.set_blocking(pipe.fileno(), False)
+        self._selector.register(pipe, selectors.EVENT_WRITE,
+                                (self._write, pipe, _PendingWrite(chunks, close_pipe), on_finish))
+
+    def add_watch(self, file: Any, on_ready: Callable[[], None]) -> None:
+        # calls on_ready whenever the file (object or descriptor) is readable, until the watch is removed
+        # nothing is read from the file and it is never closed by the pump, e.g. for pidfds
+        self._selector.register(file, selectors.EVENT_READ, (self._watch, file, on_ready, None))
+
+    def remove_watch(self, file: Any) -> None:
+        self._selector.unregister(file)
+
+    @property
+    def active(self) -> bool:
+        return len(self._selector.get_map()) != 0
+
+    def poll(self, timeout: Optional[float] = None) -> None:
+        for key, _ in self._selector.select(timeout):
+            # a callback of an earlier event of the same batch might have removed the registration
+            if self._selector.get_map().get(key.fd) is not key:
+                continue
+            handler, pipe, state, _ = key.data
+            handler(pipe, state)
+
+    def run(self) -> None:
+        while self.active:
+            self.poll()
+
+    def close(self) -> None:
+        for key in list(self._selector.get_map().values()):
+            if key.data[0] == self._watch:
+                self.remove_watch(key.data[1])
+            else:
+                self._finish(key.fileobj, notify=False)
+        self._selector.close()
+
+    def _read(self, pipe: IO, on_data: Callable[[bytes], None]) -> None:
+        data = os.read(pipe.fileno(), self._chunk_size)
+        if len(data) == 0:
+            self._finish(pipe)
+        else:
+            on_data(data)
+
+    def _watch(self, file: Any, on_ready: Callable[[], None]) -> None:
+        on_ready()
+
+    def _write(self, pipe: IO, pending_write: "_PendingWrite") -> None:
+        try:
+            while True:
+                if pending_write.remaining is None or len(pending_write.remaining) == 0:
+                    chunks = pending_write.chunks
+                    if isinstance(chunks, ChunkFeeder):
+                        # the pipe is only watched again once the feeder has produced the next chunk
+                        on_finish = self._selector.unregister(pipe).data[3]
+                        self._selector.register(chunks, selectors.EVENT_READ,
+                                                (self._feed, pipe, pending_write, on_finish))
+                        return
+                    next_chunk = next(chunks, None)
+                    if next_chunk is None:
+                        self._finish(pipe)
+                        return
+                    pending_write.remaining = memoryview(next_chunk)
+                written = os.write(pipe.fileno(), pending_write.remaining[:self._chunk_size])
+                pending_write.remaining = pending_write.remaining[written:]
+        except BlockingIOError:
+            pass
+        except BrokenPipeError:
+            # the sub-process does not read any more input, which is not an error by itself (same as communicate)
+            self._finish(pipe)
+
+    def _feed(self, pipe: IO, pending_write: "_PendingWrite") -> None:
+        assert isinstance(pending_write.chunks, ChunkFeeder)
+        next_chunk = pending_write.chunks.take()
+        if next_chunk is None:
+            self._finish(pending_write.chunks)
+            return
+        pending_write.remaining = memoryview(next_chunk)
+        on_finish = self._selector.unregister(pending_write.chunks).data[3]
+        self._selector.register(pipe, selectors.EVENT_WRITE, (self._write, pipe, pending_write, on_finish))
+        self._write(pipe, pending_write)
+
+    def _finish(self, file: Any, notify: bool = True) -> None:
+        # the file is the registered one, the writer of a pipe might be waiting for its feeder
+        _, pipe, state, on_finish = self._selector.unregister(file).data
+        if isinstance(state, _PendingWrite):
+            # generators of chunks might hold resources, e.g. the file of an input which has not been read completely
+            close_chunks = getattr(state.chunks, "close", None)
+            if close_chunks is not None:
+                close_chunks()
+            if state.close_pipe:
+                pipe.close()
+        else:
+            pipe.close()
+        if notify and on_finish is not None:
+            on_finish()
+
+
+class ChunkFeeder:
+    # produces the chunks of an iterator on its own thread, e.g. a generator or the reads from a pipe or a socket,
+    # so the thread pumping the output of a command never waits for its input
+    # the next chunk is already produced while the previous one is written, the feeder is readable (for a selector)
+    # as soon as a chunk can be taken without blocking
+    # an exception of the iterator is raised again by take, close also closes the iterator (on the feeder thread)
+
+    def __init__(self, chunks: Iterator[Union[bytes, memoryview]]) -> None:
+        self._chunks = chunks
+        self._ready_read, self._ready_write = os.pipe()
+        self._taken = threading.Event()
+        self._taken.set()
+        self._closed = False
+        self._chunk: Optional[Union[bytes, memoryview]] = None
+        self._error: Optional[BaseException] = None
+        threading.Thread(target=self._produce, name="chunk-feeder", daemon=True).start()
+
+    def fileno(self) -> int:
+        return self._ready_read
+
+    def take(self) -> Optional[Union[bytes, memoryview]]:
+        # blocks until the next chunk has been produced, None is the end of the chunks
+        os.read(self._ready_read, 1)
+        chunk, error = self._chunk, self._error
+        self._chunk = None
+        self._taken.set()
+        if error is not None:
+            raise error
+        return chunk
+
+    def close(self) -> None:
+        # a chunk which is still produced is discarded by the feeder thread
+        if not self._closed:
+            self._closed = True
+            self._taken.set()
+            os.close(self._ready_read)
+
+    def _produce(self) -> None:
+        # the write end of the ready pipe belongs to this thread, so its descriptor can not be reused while written
+        try:
+            while True:
+                self._taken.wait()
+                self._taken.clear()
+                if self._closed:
+                    return
+                chunk = None
+                try:
+                    chunk = next(self._chunks, None)
+                except BaseException as error:
+                    self._error = error
+                self._chunk = chunk
+                os.write(self._ready_write, b"\0")
+                if chunk is None:
+                    return
+        except OSError:
+            # the feeder has been closed in the meantime
+            pass
+        finally:
+            close_chunks = getattr(self._chunks, "close", None)
+            if close_chunks is not None:
+                close_chunks()
+            os.close(self._ready_write)
+
+
+class _PendingWrite:
+
+    def __init__(self, chunks: Union[Iterator[Union[bytes, memoryview]], ChunkFeeder], close_pipe: bool) -> None:
+        self.chunks = chunks
+        self.close_pipe = close_pipe
+        self.remaining: Optional[memoryview] = None
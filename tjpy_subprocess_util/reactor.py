@@ -0,0 +1,223 @@
+import os
+
+import collections
+import functools
+import logging
+import resource
+import time
+from pathlib import Path
+from typing import Callable, Deque, Generator, Iterable, List, Mapping, Optional, Set
+
+from tjpy_subprocess_util.capture import CaptureBuffer
+from tjpy_subprocess_util.exception import SubProcessStartException
+from tjpy_subprocess_util.instrumentation import ExecutionStats
+from tjpy_subprocess_util.limits import OutputLimit, ResourceLimits
+from tjpy_subprocess_util.pump import Pump
+from tjpy_subprocess_util.source import CustomInput, InputSource
+from tjpy_subprocess_util.spawn import Process, ProcessSpawner, SPAWN_BACKEND_SUBPROCESS
+
+_logger = logging.getLogger(__name__)
+
+# file descriptors left for the rest of the process when the number of children is derived from the limit
+_RESERVED_FILE_DESCRIPTORS = 64
+# the pipes for stdin, stdout and stderr and the pidfd
+_FILE_DESCRIPTORS_PER_CHILD = 4
+_MAX_DEFAULT_CHILDREN = 4096
+
+
+class ReactorTask:
+    # a command supervised by a ChildReactor, its outcome is set when the reactor yields it
+
+    def __init__(self,
+                 index: int,
+                 args: List[str],
+                 working_directory: Optional[Path],
+                 custom_input: Optional[CustomInput],
+                 environment: Optional[Mapping[str, str]],
+                 stdout_buffer: CaptureBuffer,
+                 stderr_buffer: CaptureBuffer,
+                 limits: Optional[ResourceLimits] = None):
+        self.index = index
+        self.args = args
+        self.working_directory = working_directory
+        self.custom_input = custom_input
+        self.environment = environment
+        self.stdout_buffer = stdout_buffer
+        self.stderr_buffer = stderr_buffer
+        self.limits = limits
+        self.exit_code: Optional[int] = None
+        # the child has been killed because its output exceeded the output limit
+        self.output_limit_exceeded = False
+        self.execution_stats: Optional[ExecutionStats] = None
+        # set instead of the exit code if the command could not be started
+        self.start_exception: Optional[SubProcessStartException] = None
+        self._process: Optional[Process] = None
+        self._open_pipes = 0
+        self._pidfd: Optional[int] = None
+        self._output_limit: Optional[OutputLimit] = None
+        self._start_time = 0.0
+
+
+class ChildReactor:
+    # supervises many concurrent children from the calling thread: the pipes and the exits of all children are
+    # multiplexed with a single selector (epoll on Linux), so no thread and no blocking wait is needed per child
+    # the exit of a child is noticed with a pidfd (Linux 5.3+, Python 3.9+), otherwise the children which closed
+    # their pipes are reaped by polling with a non-blocking wait every exit_poll_interval_seconds
+    # the memory per child is bounded by its capture buffers, e.g. with TailCapture
+
+    def __init__(self,
+                 spawn_backend: str = SPAWN_BACKEND_SUBPROCESS,
+                 exit_poll_interval_seconds: float = 0.01):
+        self.spawn_backend = spawn_backend
+        self.exit_poll_interval_seconds = exit_poll_interval_seconds
+
+    @staticmethod
+    def default_max_children() -> int:
+        # as many children as the limit of open file descriptors allows
+        soft_limit, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft_limit == resource.RLIM_INFINITY:
+            return _MAX_DEFAULT_CHILDREN
+        return max(1, min((soft_limit - _RESERVED_FILE_DESCRIPTORS) // _FILE_DESCRIPTORS_PER_CHILD,
+                          _MAX_DEFAULT_CHILDREN))
+
+    def run(self,
+            tasks: Iterable[ReactorTask],
+            max_children: Optional[int] = None) -> Generator[ReactorTask, None, None]:
+        # starts the tasks lazily while fewer than max_children are running and yields them as soon as they finished
+        # closing the generator early kills the children which are still running
+        if max_children is None:
+            max_children = ChildReactor.default_max_children()
+        if max_children < 1:
+            raise ValueError(f"max_children must be at least 1, but was {max_children}")
+        reactor_run = _ReactorRun(self.spawn_backend)
+        pending_tasks = iter(tasks)
+        all_started = False
+        try:
+            while True:
+                while not all_started and len(reactor_run.running) < max_children:
+                    task = next(pending_tasks, None)
+                    if task is None:
+                        all_started = True
+                    else:
+                        reactor_run.start(task)
+                while len(reactor_run.finished) != 0:
+                    yield reactor_run.finished.popleft()
+                if len(reactor_run.running) == 0:
+                    if all_started:
+                        return
+                    continue
+                reactor_run.poll(self.exit_poll_interval_seconds)
+        finally:
+            reactor_run.close()
+
+
+class _ReactorRun:
+
+    def __init__(self, spawn_backend: str):
+        self.spawn_backend = spawn_backend
+        self.pump = Pump()
+        self.running: Set[ReactorTask] = set()
+        self.finished: Deque[ReactorTask] = collections.deque()
+        # children without a pidfd which closed their pipes, but have not exited yet
+        self.awaiting_exit: List[ReactorTask] = []
+
+    def start(self, task: ReactorTask) -> None:
+        task._start_time = time.perf_counter()
+        try:
+            process = ProcessSpawner.start(task.args, task.working_directory, task.custom_input is not None,
+                                           spawn_backend=self.spawn_backend, environment=task.environment,
+                                           limits=task.limits)
+        except SubProcessStartException as start_exception:
+            task.start_exception = start_exception
+            self.finished.append(task)
+            return
+        task._process = process
+        self.running.add(task)
+        on_pipe_finished = functools.partial(self._on_pipe_finished, task)
+        on_stdout: Callable[[bytes], None] = task.stdout_buffer.write
+        on_stderr: Callable[[bytes], None] = task.stderr_buffer.write
+        if task.limits is not None and task.limits.output_bytes is not None:
+            task._output_limit = OutputLimit(task.limits.output_bytes, process.kill)
+            on_stdout = task._output_limit.wrap(on_stdout)
+            on_stderr = task._output_limit.wrap(on_stderr)
+        assert process.stdout is not None and process.stderr is not None
+        self.pump.add_reader(process.stdout, on_stdout, on_pipe_finished)
+        self.pump.add_reader(process.stderr, on_stderr, on_pipe_finished)
+        task._open_pipes = 2
+        if task.custom_input is not None:
+            assert process.stdin is not None
+            self.pump.add_writer(process.stdin, InputSource.pumped_chunks(task.custom_input), on_pipe_finished)
+            task._open_pipes += 1
+        task._pidfd = _ReactorRun._open_pidfd(process.pid)
+        if task._pidfd is not None:
+            self.pump.add_watch(task._pidfd, functools.partial(self._on_exit, task))
+
+    def poll(self, exit_poll_interval_seconds: float) -> None:
+        self.pump.poll(exit_poll_interval_seconds if len(self.awaiting_exit) != 0 else None)
+        for task in list(self.awaiting_exit):
+            assert task._process is not None
+            if task._process.poll() is not None:
+                self.awaiting_exit.remove(task)
+                self._finish(task)
+
+    def close(self) -> None:
+        self.pump.close()
+        for task in self.running:
+            assert task._process is not None
+            if task._process.returncode is None:
+                _logger.debug(f"Killing command {task.args!r} because the reactor has been closed.")
+                task._process.kill()
+                task._process.wait()
+            if task._pidfd is not None:
+                os.close(task._pidfd)
+        self.running.clear()
+
+    def _on_pipe_finished(self, task: ReactorTask) -> None:
+        task._open_pipes -= 1
+        if task._open_pipes != 0:
+            return
+        assert task._process is not None
+        if task._process.poll() is not None:
+            self._finish(task)
+        elif task._pidfd is None:
+            self.awaiting_exit.append(task)
+
+    def _on_exit(self, task: ReactorTask) -> None:
+        assert task._process is not None
+        # the child has exited, so the wait returns immediately
+        task._process.wait()
+        if task._open_pipes == 0:
+            self._finish(task)
+        else:
+            # a grandchild might still hold the pipes, the command only finishes when they are closed (as communicate)
+            self._close_pidfd(task)
+
+    def _finish(self, task: ReactorTask) -> None:
+        assert task._process is not None
+        self._close_pidfd(task)
+        self.running.remove(task)
+        task.exit_code = task._process.returncode
+        task.output_limit_exceeded = task._output_limit is not None and task._output_limit.exceeded
+        task.execution_stats = ExecutionStats.from_resource_usage(time.perf_counter() - task._start_time,
+                                                                  task._process.spawn_latency_seconds,
+                                                                  task._process.resource_usage)
+        # the process object is not needed anymore, dropping it keeps the memory of a long run bounded
+        task._process = None
+        self.finished.append(task)
+
+    def _close_pidfd(self, task: ReactorTask) -> None:
+        if task._pidfd is not None:
+            self.pump.remove_watch(task._pidfd)
+            os.close(task._pidfd)
+            task._pidfd = None
+
+    @staticmethod
+    def _open_pidfd(pid: int) -> Optional[int]:
+        pidfd_open = getattr(os, "pidfd_open", None)
+        if pidfd_open is None:
+            return None
+        try:
+            return pidfd_open(pid)
+        except OSError:
+            # e.g. kernels older than 5.3
+            return None
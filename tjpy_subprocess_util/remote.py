@@ -0,0 +1,362 @@
+import os
+
+import argparse
+import functools
+import logging
+import selectors
+import socket
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Mapping, Optional, Tuple, Union
+
+from tjpy_subprocess_util.capture import OutputCapture
+from tjpy_subprocess_util.exception import SubProcessStartException
+from tjpy_subprocess_util.execution import Result, SubProcessExecution
+from tjpy_subprocess_util.forkserver import CommandRunner, ForkServer
+from tjpy_subprocess_util.instrumentation import ExecutionStats
+from tjpy_subprocess_util.source import CustomInput
+from tjpy_subprocess_util.spawn import SPAWN_BACKEND_SUBPROCESS
+
+_logger = logging.getLogger(__name__)
+
+# (host, port) of a TCP socket or the path of a Unix socket
+AgentAddress = Union[Tuple[str, int], str]
+
+# the token is read from the environment by the command line entry point, so it does not show up in process lists
+TOKEN_ENVIRONMENT_VARIABLE = "TJPY_WORKER_AGENT_TOKEN"
+
+# agents which could not be connected to are skipped for this long
+_UNAVAILABLE_AGENT_RETRY_SECONDS = 30.0
+
+
+class WorkerAgent:
+    # server executing commands for RemoteExecutors, every connection executes one command on its own thread
+    # it speaks the protocol of the fork server, the output is streamed back chunk by chunk while the command runs
+    # connections are not encrypted and only authenticated by the token, so agents listening on TCP should only be
+    # reachable from trusted networks (e.g. through an SSH tunnel), they always require a token
+    # start it with: TJPY_WORKER_AGENT_TOKEN=... python -m tjpy_subprocess_util.remote host:port
+
+    def __init__(self, address: AgentAddress, token: Optional[str] = None):
+        if isinstance(address, tuple) and token is None:
+            raise ValueError("Agents listening on TCP require a token")
+        self._requested_address = address
+        self._token = token
+        self._listener: Optional[socket.socket] = None
+        self._wakeup_pipe: Optional[Tuple[int, int]] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def address(self) -> AgentAddress:
+        # the address the agent listens on, e.g. with the port chosen by the system if port 0 was requested
+        if self._listener is None:
+            raise RuntimeError("The agent has not been started.")
+        if self._listener.family == socket.AF_UNIX:
+            return self._listener.getsockname()
+        host, port = self._listener.getsockname()[:2]
+        return host, port
+
+    def start(self) -> None:
+        # serves on a background thread
+        self._bind()
+        self._thread = threading.Thread(target=self._serve, name="tjpy-worker-agent", daemon=True)
+        self._thread.start()
+
+    def serve_forever(self) -> None:
+        # serves on the calling thread until the agent is stopped from another thread
+        self._bind()
+        self._serve()
+
+    def stop(self) -> None:
+        if self._wakeup_pipe is not None:
+            os.write(self._wakeup_pipe[1], b"x")
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self) -> "WorkerAgent":
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.stop()
+
+    def _bind(self) -> None:
+        if self._listener is not None:
+            raise RuntimeError("The agent has already been started.")
+        if isinstance(self._requested_address, tuple):
+            family = socket.AF_INET6 if ":" in self._requested_address[0] else socket.AF_INET
+            listener = socket.socket(family, socket.SOCK_STREAM)
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        else:
+            listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            listener.bind(self._requested_address)
+            listener.listen(128)
+        except BaseException:
+            listener.close()
+            raise
+        self._listener = listener
+        self._wakeup_pipe = os.pipe()
+        _logger.info(f"Worker agent listening on {self.address!r}")
+
+    def _serve(self) -> None:
+        assert self._listener is not None and self._wakeup_pipe is not None
+        selector = selectors.DefaultSelector()
+        selector.register(self._listener, selectors.EVENT_READ)
+        selector.register(self._wakeup_pipe[0], selectors.EVENT_READ)
+        try:
+            while True:
+                for key, _ in selector.select():
+                    if key.fileobj is not self._listener:
+                        return
+                    connection, _ = self._listener.accept()
+                    if connection.family != socket.AF_UNIX:
+                        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    threading.Thread(target=ForkServer._handle, args=(connection, self._token), daemon=True).start()
+        finally:
+            selector.close()
+            self._close()
+
+    def _close(self) -> None:
+        assert self._listener is not None and self._wakeup_pipe is not None
+        unix_socket_path = self.address if self._listener.family == socket.AF_UNIX else None
+        self._listener.close()
+        self._listener = None
+        for fd in self._wakeup_pipe:
+            os.close(fd)
+        self._wakeup_pipe = None
+        if isinstance(unix_socket_path, str):
+            os.unlink(unix_socket_path)
+
+    @staticmethod
+    def parse_address(text: str) -> AgentAddress:
+        # "host:port" (IPv6 hosts in brackets) for TCP, everything else is the path of a Unix socket
+        host, separator, port = text.rpartition(":")
+        if separator == "" or not port.isdigit() or os.sep in host:
+            return text
+        return host.strip("[]"), int(port)
+
+
+class RemoteAgent(CommandRunner):
+    # client of a WorkerAgent, it runs at most max_concurrency commands at a time when used by a RemoteExecutor
+    # the working directory is a path on the host of the agent, the environment is merged into the one of the agent
+    # commands do not get the stdin of this process, but an empty input if there is no custom input
+
+    def __init__(self,
+                 address: AgentAddress,
+                 token: Optional[str] = None,
+                 max_concurrency: int = 4,
+                 connect_timeout_seconds: float = 10.0):
+        if max_concurrency < 1:
+            raise ValueError(f"max_concurrency must be at least 1, but was {max_concurrency}")
+        self.address = address
+        self.token = token
+        self.max_concurrency = max_concurrency
+        self.connect_timeout_seconds = connect_timeout_seconds
+
+    def connect(self) -> socket.socket:
+        connection: socket.socket
+        if isinstance(self.address, tuple):
+            connection = socket.create_connection(self.address, timeout=self.connect_timeout_seconds)
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        else:
+            connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            connection.settimeout(self.connect_timeout_seconds)
+            try:
+                connection.connect(self.address)
+            except BaseException:
+                connection.close()
+                raise
+        # commands may run for a long time without any output
+        connection.settimeout(None)
+        return connection
+
+    def run(self,
+            args: List[str],
+            working_directory: Optional[Path],
+            custom_input: Optional[Iterable[Union[bytes, memoryview]]],
+            on_stdout: Callable[[bytes], None],
+            on_stderr: Callable[[bytes], None],
+            spawn_backend: str = SPAWN_BACKEND_SUBPROCESS,
+            environment: Optional[Mapping[str, str]] = None,
+            executable: Optional[str] = None) -> Tuple[int, ExecutionStats]:
+        start_time = time.perf_counter()
+        return self._run_on_connection(self.connect(), args, working_directory, custom_input, on_stdout, on_stderr,
+                                       spawn_backend, environment, start_time, executable)
+
+    def _run_on_connection(self,
+                           connection: socket.socket,
+                           args: List[str],
+                           working_directory: Optional[Path],
+                           custom_input: Optional[Iterable[Union[bytes, memoryview]]],
+                           on_stdout: Callable[[bytes], None],
+                           on_stderr: Callable[[bytes], None],
+                           spawn_backend: str,
+                           environment: Optional[Mapping[str, str]],
+                           start_time: float,
+                           executable: Optional[str] = None) -> Tuple[int, ExecutionStats]:
+        return ForkServer._run_on_connection(connection, f"agent {self.address!r}", {
+            "args": list(args),
+            "working_directory": None if working_directory is None else str(working_directory),
+            "pipe_input": True,
+            "spawn_backend": spawn_backend,
+            "environment": None,
+            "environment_overlay": None if environment is None else dict(environment),
+            "executable": executable,
+            "token": self.token,
+        }, custom_input if custom_input is not None else (), on_stdout, on_stderr, start_time)
+
+
+class _ConnectedAgent(CommandRunner):
+    # an agent with an established connection for a single command
+
+    def __init__(self, agent: RemoteAgent, connection: socket.socket, start_time: float):
+        self._agent = agent
+        self._connection = connection
+        self._start_time = start_time
+
+    def run(self,
+            args: List[str],
+            working_directory: Optional[Path],
+            custom_input: Optional[Iterable[Union[bytes, memoryview]]],
+            on_stdout: Callable[[bytes], None],
+            on_stderr: Callable[[bytes], None],
+            spawn_backend: str = SPAWN_BACKEND_SUBPROCESS,
+            environment: Optional[Mapping[str, str]] = None,
+            executable: Optional[str] = None) -> Tuple[int, ExecutionStats]:
+        return self._agent._run_on_connection(self._connection, args, working_directory, custom_input, on_stdout,
+                                              on_stderr, spawn_backend, environment, self._start_time, executable)
+
+
+class _AgentState:
+
+    def __init__(self, agent: RemoteAgent):
+        self.agent = agent
+        self.in_flight = 0
+        self.unavailable_until = 0.0
+
+
+class RemoteExecutor:
+    # executes commands on worker agents with the same results and exceptions as SubProcessExecution
+    # every command is executed on the agent with the fewest running commands which is below its concurrency limit,
+    # agents which can not be connected to are skipped for a while
+    # a command whose connection is lost while it runs is not repeated, a ConnectionError is raised instead
+    # (also by execute_many with aggregate_failures, as the command might have been executed)
+    # a command which can not be sent to any agent raises a SubProcessStartException (caused by a ConnectionError)
+    # and a rejected token a SubProcessAuthenticationException
+
+    def __init__(self, agents: Iterable[RemoteAgent]):
+        self._agent_states = [_AgentState(agent) for agent in agents]
+        if len(self._agent_states) == 0:
+            raise ValueError("A remote executor needs at least one agent")
+        self._condition = threading.Condition()
+
+    @property
+    def max_concurrency(self) -> int:
+        return sum(agent_state.agent.max_concurrency for agent_state in self._agent_states)
+
+    def execute(self,
+                args: List[str],
+                check_error_code: bool = True,
+                follow_output: bool = False,
+                working_directory: Optional[Path] = None,
+                logging_level: str = "DEBUG",
+                custom_input: Optional[CustomInput] = None,
+                capture: Optional[OutputCapture] = None,
+                binary: bool = False,
+                spawn_backend: str = SPAWN_BACKEND_SUBPROCESS,
+                environment: Optional[Dict[str, str]] = None) -> Result:
+        # the environment is merged into the environment of the agent, not into the one of this process
+        SubProcessExecution._log_execute_call(args, working_directory, logging_level)
+        try:
+            agent_state, connection, start_time = self._connect()
+        except ConnectionError as connection_error:
+            # the command has not been sent anywhere, so it is reported like any other command which can not start
+            raise SubProcessStartException(list(args)) from connection_error
+        try:
+            return SubProcessExecution._execute_uncached(args, check_error_code, follow_output, working_directory,
+                                                         custom_input, capture, binary, spawn_backend,
+                                                         _ConnectedAgent(agent_state.agent, connection, start_time),
+                                                         environment)
+        finally:
+            connection.close()
+            with self._condition:
+                agent_state.in_flight -= 1
+                self._condition.notify_all()
+
+    def execute_many(self,
+                     args_list: Iterable[List[str]],
+                     check_error_code: bool = True,
+                     follow_output: bool = False,
+                     working_directory: Optional[Path] = None,
+                     logging_level: str = "DEBUG",
+                     custom_input: Optional[CustomInput] = None,
+                     capture: Optional[OutputCapture] = None,
+                     binary: bool = False,
+                     spawn_backend: str = SPAWN_BACKEND_SUBPROCESS,
+                     environment: Optional[Dict[str, str]] = None,
+                     aggregate_failures: bool = False) -> List[Result]:
+        # same as SubProcessExecution.execute_many, with as many parallel commands as all agents allow together
+        SubProcessExecution._check_reusable_input(custom_input)
+        execute: Callable[[List[str]], Result] = functools.partial(
+            self.execute,
+            check_error_code=check_error_code,
+            follow_output=follow_output,
+            working_directory=working_directory,
+            logging_level=logging_level,
+            custom_input=custom_input,
+            capture=capture,
+            binary=binary,
+            spawn_backend=spawn_backend,
+            environment=environment
+        )
+        outcomes = SubProcessExecution._execute_many_outcomes(args_list, execute, self.max_concurrency)
+        return SubProcessExecution._results_in_order(
+            SubProcessExecution._results_as_completed(outcomes, aggregate_failures))
+
+    def _connect(self) -> Tuple[_AgentState, socket.socket, float]:
+        # connects to a free agent, the agent stays reserved for the command until it is released
+        while True:
+            agent_state = self._reserve_agent()
+            start_time = time.perf_counter()
+            try:
+                return agent_state, agent_state.agent.connect(), start_time
+            except OSError as connection_error:
+                _logger.warning(f"Skipping agent {agent_state.agent.address!r} for "
+                                f"{_UNAVAILABLE_AGENT_RETRY_SECONDS} s, because it could not be connected to: "
+                                f"{connection_error}")
+                with self._condition:
+                    agent_state.in_flight -= 1
+                    agent_state.unavailable_until = time.monotonic() + _UNAVAILABLE_AGENT_RETRY_SECONDS
+                    self._condition.notify_all()
+
+    def _reserve_agent(self) -> _AgentState:
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                available_agents = [agent_state for agent_state in self._agent_states
+                                    if agent_state.unavailable_until <= now]
+                if len(available_agents) == 0:
+                    raise ConnectionError(f"None of the agents {[state.agent.address for state in self._agent_states]}"
+                                          f" can be connected to.")
+                free_agents = [agent_state for agent_state in available_agents
+                               if agent_state.in_flight < agent_state.agent.max_concurrency]
+                if len(free_agents) != 0:
+                    agent_state = min(free_agents, key=lambda free_agent: free_agent.in_flight)
+                    agent_state.in_flight += 1
+                    return agent_state
+                self._condition.wait()
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Worker agent executing commands for remote executors.")
+    parser.add_argument("address", help="host:port to listen on TCP or the path of a Unix socket")
+    arguments = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    agent = WorkerAgent(WorkerAgent.parse_address(arguments.address), os.environ.get(TOKEN_ENVIRONMENT_VARIABLE))
+    agent.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+import os
+
+import heapq
+import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from tjpy_subprocess_util.exception import SubProcessException, SubProcessScheduleException
+from tjpy_subprocess_util.execution import Result, SubProcessExecution
+from tjpy_subprocess_util.throttle import AdaptiveLimiter
+
+_logger = logging.getLogger(__name__)
+
+
+class ScheduledCommand:
+    # a command of a schedule, which is only started after all commands it depends on succeeded
+    # commands with a higher priority are started first, the weight is its share of the resource budget
+    # options are passed to SubProcessExecution.execute, e.g. working_directory, custom_input or environment
+
+    def __init__(self,
+                 name: str,
+                 args: List[str],
+                 dependencies: Iterable[str] = (),
+                 priority: int = 0,
+                 weight: float = 1.0,
+                 options: Optional[Dict[str, Any]] = None):
+        if weight <= 0:
+            raise ValueError(f"weight of command {name} must be positive, but was {weight}")
+        self.name = name
+        self.args = args
+        self.dependencies = list(dependencies)
+        self.priority = priority
+        self.weight = weight
+        self.options = options or {}
+
+
+class CommandTiming:
+
+    def __init__(self, start_seconds: float, end_seconds: float):
+        # seconds since the start of the schedule
+        self.start_seconds = start_seconds
+        self.end_seconds = end_seconds
+
+    @property
+    def duration_seconds(self) -> float:
+        return self.end_seconds - self.start_seconds
+
+
+class ScheduleReport:
+
+    def __init__(self,
+                 commands: Dict[str, ScheduledCommand],
+                 results: Dict[str, Result],
+                 failures: Dict[str, SubProcessException],
+                 skipped: List[str],
+                 timings: Dict[str, CommandTiming],
+                 wall_seconds: float):
+        self.results = results
+        self.failures = failures
+        # commands which have not been executed, because a dependency failed or the schedule stopped
+        self.skipped = skipped
+        self.timings = timings
+        self.wall_seconds = wall_seconds
+        self.critical_path = ScheduleReport._critical_path(commands, timings)
+
+    @property
+    def critical_path_seconds(self) -> float:
+        return sum(self.timings[name].duration_seconds for name in self.critical_path)
+
+    @property
+    def busy_seconds(self) -> float:
+        return sum(timing.duration_seconds for timing in self.timings.values())
+
+    def summary(self, slowest_commands: int = 5) -> str:
+        parallelism = self.busy_seconds / self.wall_seconds if self.wall_seconds > 0 else 0.0
+        critical_path_text = " -> ".join(f"{name} ({self.timings[name].duration_seconds:.3f} s)"
+                                         for name in self.critical_path)
+        slowest = sorted(self.timings.items(), key=lambda item: item[1].duration_seconds, reverse=True)
+        slowest_text = "".join(f"\n  {name}: {timing.duration_seconds:.3f} s" for name, timing in
+                               slowest[:slowest_commands])
+        return f"Executed {len(self.timings)} commands in {self.wall_seconds:.3f} s " \
+            f"({len(self.failures)} failed, {len(self.skipped)} skipped, " \
+            f"busy {self.busy_seconds:.3f} s, average parallelism {parallelism:.2f})\n" \
+            f"Critical path ({self.critical_path_seconds:.3f} s): {critical_path_text}\n" \
+            f"Slowest commands:{slowest_text}"
+
+    @staticmethod
+    def _critical_path(commands: Dict[str, ScheduledCommand], timings: Dict[str, CommandTiming]) -> List[str]:
+        # the chain of dependent executed commands with the largest sum of durations
+        path_seconds: Dict[str, float] = {}
+        predecessor: Dict[str, Optional[str]] = {}
+        for name in sorted(timings, key=lambda executed_name: timings[executed_name].end_seconds):
+            longest_dependency = max((dependency for dependency in commands[name].dependencies
+                                      if dependency in path_seconds),
+                                     key=lambda dependency: path_seconds[dependency], default=None)
+            predecessor[name] = longest_dependency
+            path_seconds[name] = timings[name].duration_seconds + \
+                (path_seconds[longest_dependency] if longest_dependency is not None else 0.0)
+        if len(path_seconds) == 0:
+            return []
+        path: List[str] = []
+        current: Optional[str] = max(path_seconds, key=lambda executed_name: path_seconds[executed_name])
+        while current is not None:
+            path.append(current)
+            current = predecessor[current]
+        return list(reversed(path))
+
+
+class CommandScheduler:
+    # executes a graph of commands with as much parallelism as the concurrency and resource budget allow
+    # without continue_on_error, no further commands are started after the first failure,
+    # otherwise only the commands depending on a failed command are skipped
+    # a SubProcessScheduleException is raised at the end if any command failed
+
+    def __init__(self,
+                 max_concurrency: Optional[int] = None,
+                 resource_budget: Optional[float] = None,
+                 continue_on_error: bool = False,
+                 limiter: Optional[AdaptiveLimiter] = None):
+        # with a limiter, the number of parallel commands is adapted to the load of the host instead of max_concurrency
+        self._limiter = limiter
+        self._max_concurrency = (limiter.max_limit if limiter is not None else max_concurrency) or os.cpu_count() or 1
+        if self._max_concurrency < 1:
+            raise ValueError(f"max_concurrency must be at least 1, but was {max_concurrency}")
+        # a command heavier than the budget is still executed, but only when nothing else is running
+        self._resource_budget = resource_budget if resource_budget is not None else float(self._max_concurrency)
+        self._continue_on_error = continue_on_error
+        self._commands: Dict[str, ScheduledCommand] = {}
+        self._lock = threading.Lock()
+
+    def add(self,
+            name: str,
+            args: List[str],
+            dependencies: Iterable[str] = (),
+            priority: int = 0,
+            weight: float = 1.0,
+            **options: Any) -> ScheduledCommand:
+        return self.add_command(ScheduledCommand(name, args, dependencies, priority, weight, options))
+
+    def add_command(self, command: ScheduledCommand) -> ScheduledCommand:
+        with self._lock:
+            if command.name in self._commands:
+                raise ValueError(f"Command {command.name} has already been added")
+            self._commands[command.name] = command
+        return command
+
+    def run(self) -> ScheduleReport:
+        with self._lock:
+            commands = dict(self._commands)
+        order = {name: index for index, name in enumerate(commands)}
+        dependents = CommandScheduler._dependents(commands)
+        # commands on longer chains are preferred among commands of the same priority
+        chain_lengths = CommandScheduler._chain_lengths(commands, dependents)
+
+        remaining_dependencies = {name: len(set(command.dependencies)) for name, command in commands.items()}
+        ready: List[Tuple[int, int, int, str]] = []
+        for name, count in remaining_dependencies.items():
+            if count == 0:
+                CommandScheduler._push_ready(ready, commands[name], chain_lengths, order)
+
+        results: Dict[str, Result] = {}
+        failures: Dict[str, SubProcessException] = {}
+        timings: Dict[str, CommandTiming] = {}
+        running: Dict[Future, str] = {}
+        used_budget = 0.0
+        stopped = False
+        schedule_start = time.perf_counter()
+
+        with ThreadPoolExecutor(max_workers=self._max_concurrency) as executor:
+            while True:
+                if not stopped:
+                    blocked: List[Tuple[int, int, int, str]] = []
+                    while len(ready) != 0 and len(running) < self._max_concurrency:
+                        entry = heapq.heappop(ready)
+                        command = commands[entry[3]]
+                        fits = used_budget + command.weight <= self._resource_budget or len(running) == 0
+                        if not fits:
+                            # smaller commands of lower priority may still fit into the remaining budget
+                            blocked.append(entry)
+                            continue
+                        execute = CommandScheduler._execute
+                        if self._limiter is not None:
+                            # same as execute_many, the slot is released by the worker
+                            if not self._limiter.acquire(timeout=0 if len(running) != 0 else None):
+                                blocked.append(entry)
+                                break
+                            execute = self._limiter.releasing(
+                                execute, lambda command, _: AdaptiveLimiter.command_name(command.args))
+                        used_budget += command.weight
+                        future = executor.submit(execute, command, schedule_start)
+                        running[future] = command.name
+                    for entry in blocked:
+                        heapq.heappush(ready, entry)
+                if len(running) == 0:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    used_budget -= commands[name].weight
+                    outcome, timing = future.result()
+                    timings[name] = timing
+                    if isinstance(outcome, SubProcessException):
+                        failures[name] = outcome
+                        if not self._continue_on_error:
+                            stopped = True
+                        continue
+                    results[name] = outcome
+                    for dependent in dependents[name]:
+                        remaining_dependencies[dependent] -= 1
+                        if remaining_dependencies[dependent] == 0:
+                            CommandScheduler._push_ready(ready, commands[dependent], chain_lengths, order)
+
+        skipped = [name for name in commands if name not in timings]
+        report = ScheduleReport(commands, results, failures, skipped, timings, time.perf_counter() - schedule_start)
+        _logger.debug(report.summary())
+        if len(failures) != 0:
+            raise SubProcessScheduleException(sorted((order[name], failure) for name, failure in failures.items()),
+                                              list(commands), report)
+        return report
+
+    @staticmethod
+    def _execute(command: ScheduledCommand, schedule_start: float) -> Tuple[Any, CommandTiming]:
+        start_seconds = time.perf_counter() - schedule_start
+        outcome: Any
+        try:
+            outcome = SubProcessExecution.execute(command.args, **command.options)
+        except SubProcessException as sub_process_exception:
+            outcome = sub_process_exception
+        return outcome, CommandTiming(start_seconds, time.perf_counter() - schedule_start)
+
+    @staticmethod
+    def _push_ready(ready: List[Tuple[int, int, int, str]],
+                    command: ScheduledCommand,
+                    chain_lengths: Dict[str, int],
+                    order: Dict[str, int]) -> None:
+        heapq.heappush(ready, (-command.priority, -chain_lengths[command.name], order[command.name], command.name))
+
+    @staticmethod
+    def _dependents(commands: Dict[str, ScheduledCommand]) -> Dict[str, List[str]]:
+        dependents: Dict[str, List[str]] = {name: [] for name in commands}
+        for name, command in commands.items():
+            for dependency in set(command.dependencies):
+                if dependency not in commands:
+                    raise ValueError(f"Command {name} depends on unknown command {dependency}")
+                dependents[dependency].append(name)
+        return dependents
+
+    @staticmethod
+    def _chain_lengths(commands: Dict[str, ScheduledCommand], dependents: Dict[str, List[str]]) -> Dict[str, int]:
+        # number of commands on the longest chain starting at each command, also detects cycles
+        remaining_dependencies = {name: len(set(command.dependencies)) for name, command in commands.items()}
+        unblocked = [name for name, count in remaining_dependencies.items() if count == 0]
+        topological_order: List[str] = []
+        while len(unblocked) != 0:
+            name = unblocked.pop()
+            topological_order.append(name)
+            for dependent in dependents[name]:
+                remaining_dependencies[dependent] -= 1
+                if remaining_dependencies[dependent] == 0:
+                    unblocked.append(dependent)
+        if len(topological_order) != len(commands):
+            cyclic_commands = sorted(set(commands) - set(topological_order))
+            raise ValueError(f"The dependencies of the commands {cyclic_commands} form a cycle")
+
+        chain_lengths: Dict[str, int] = {}
+        for name in reversed(topological_order):
+            chain_lengths[name] = 1 + max((chain_lengths[dependent] for dependent in dependents[name]), default=0)
+        return chain_lengths
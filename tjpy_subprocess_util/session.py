@@ -0,0 +1,319 @@
+import logging
+import queue
+import threading
+import time
+import uuid
+from abc import abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from tjpy_subprocess_util.exception import SubProcessException, SubProcessExecutionException
+from tjpy_subprocess_util.execution import Result, SubProcessExecution
+from tjpy_subprocess_util.instrumentation import ExecutionObservers, ExecutionStats
+from tjpy_subprocess_util.pump import Pump
+from tjpy_subprocess_util.spawn import Process, ProcessSpawner
+
+_logger = logging.getLogger(__name__)
+
+# the time a session child gets to exit after its stdin has been closed, before it is killed
+_CLOSE_TIMEOUT_SECONDS = 1.0
+
+
+class SessionProtocol:
+    # frames the requests to a long-running child and its responses
+    # the frames of a response are found with parse methods, which are called whenever new output arrived:
+    # they return None while the response is incomplete, search_start is the position up to which the output
+    # has already been searched without success
+
+    @abstractmethod
+    def encode_request(self, request: str, sentinel: str) -> bytes:
+        pass
+
+    @abstractmethod
+    def parse_stdout(self, output: bytearray, sentinel: str, search_start: int) -> Optional[Tuple[int, int, int]]:
+        # the length of the response, the length of the response including its frame and the exit code of the request
+        pass
+
+    @property
+    def stderr_framed(self) -> bool:
+        # without framed stderr, the stderr of a request is everything that arrived until its stdout is complete
+        return False
+
+    def parse_stderr(self, output: bytearray, sentinel: str, search_start: int) -> Optional[Tuple[int, int]]:
+        # the length of the stderr of the request and the length including its frame
+        return None
+
+
+class ShellProtocol(SessionProtocol):
+    # for POSIX shells (e.g. ["sh"] or ["bash"]): every request is a script, its exit code is the one of the last
+    # command of the script, the end of stdout and stderr is marked by printing the sentinel after the script
+
+    def encode_request(self, request: str, sentinel: str) -> bytes:
+        return f"{request}\nprintf '%s %d\\n' {sentinel} \"$?\"; printf '%s\\n' {sentinel} >&2\n".encode("utf-8")
+
+    def parse_stdout(self, output: bytearray, sentinel: str, search_start: int) -> Optional[Tuple[int, int, int]]:
+        marker = f"{sentinel} ".encode("utf-8")
+        marker_start = output.find(marker, max(search_start - len(marker), 0))
+        if marker_start == -1:
+            return None
+        line_end = output.find(b"\n", marker_start)
+        if line_end == -1:
+            return None
+        return marker_start, line_end + 1, int(output[marker_start + len(marker):line_end])
+
+    @property
+    def stderr_framed(self) -> bool:
+        return True
+
+    def parse_stderr(self, output: bytearray, sentinel: str, search_start: int) -> Optional[Tuple[int, int]]:
+        marker = f"{sentinel}\n".encode("utf-8")
+        marker_start = output.find(marker, max(search_start - len(marker), 0))
+        if marker_start == -1:
+            return None
+        return marker_start, marker_start + len(marker)
+
+
+class DelimiterProtocol(SessionProtocol):
+    # for tools answering every request with exactly one delimited response (e.g. one line per request line)
+    # the exit code of every request is 0, failures of single requests can not be detected
+
+    def __init__(self, request_delimiter: str = "\n", response_delimiter: bytes = b"\n"):
+        self.request_delimiter = request_delimiter
+        self.response_delimiter = response_delimiter
+
+    def encode_request(self, request: str, sentinel: str) -> bytes:
+        return f"{request}{self.request_delimiter}".encode("utf-8")
+
+    def parse_stdout(self, output: bytearray, sentinel: str, search_start: int) -> Optional[Tuple[int, int, int]]:
+        delimiter_start = output.find(self.response_delimiter, max(search_start - len(self.response_delimiter), 0))
+        if delimiter_start == -1:
+            return None
+        return delimiter_start, delimiter_start + len(self.response_delimiter), 0
+
+
+class SubProcessSession:
+    # keeps one child alive and sends it request after request over stdin, which avoids the start-up costs of
+    # the child for every request, the child is started with the first request
+    # if the child exits, the request in progress fails and the child is restarted with the next request
+    # requests of several threads are executed one after another
+
+    def __init__(self,
+                 args: List[str],
+                 protocol: Optional[SessionProtocol] = None,
+                 working_directory: Optional[Path] = None,
+                 environment: Optional[Dict[str, str]] = None,
+                 logging_level: str = "DEBUG",
+                 check_error_code: bool = True):
+        self.args = list(args)
+        self.protocol = protocol or ShellProtocol()
+        self.working_directory = working_directory
+        self.check_error_code = check_error_code
+        self._logging_level: int = logging._nameToLevel[logging_level]
+        self._environment = SubProcessExecution._merge_environment(environment)
+        self._sentinel_prefix = f"__tjpy_session_{uuid.uuid4().hex}_"
+        self._lock = threading.Lock()
+        self._process: Optional[Process] = None
+        self._pump: Optional[Pump] = None
+        self._stdout = bytearray()
+        self._stderr = bytearray()
+        self._stdout_closed = False
+        self._writing = False
+        self._request_count = 0
+        self._restarts = 0
+        # the previous child exited or has been stopped in the middle of a request, the next start is a restart
+        self._child_lost = False
+
+    @property
+    def pid(self) -> Optional[int]:
+        return self._process.pid if self._process is not None else None
+
+    @property
+    def restarts(self) -> int:
+        # the number of times the child has been started again after it exited or had to be stopped during a request
+        return self._restarts
+
+    def execute(self, request: str, check_error_code: Optional[bool] = None) -> Result:
+        # the subprocess_args of exceptions are the args of the session followed by the request
+        request_args = self.args + [request]
+        observers = ExecutionObservers.current()
+        ExecutionObservers.notify_start(observers, request_args, self.working_directory)
+        try:
+            with self._lock:
+                result = self._execute(request, request_args,
+                                       self.check_error_code if check_error_code is None else check_error_code)
+        except SubProcessException as sub_process_exception:
+            ExecutionObservers.notify_failure(observers, request_args, sub_process_exception)
+            raise
+        ExecutionObservers.notify_complete(observers, request_args, result)
+        return result
+
+    def close(self) -> None:
+        with self._lock:
+            self._stop()
+            self._child_lost = False
+
+    def __enter__(self) -> "SubProcessSession":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def _execute(self, request: str, request_args: List[str], check_error_code: bool) -> Result:
+        start_time = time.perf_counter()
+        process, pump = self._ensure_started()
+        _logger.log(self._logging_level, f"Sending request to session {self.args!r} (pid {process.pid}): {request!r}")
+        self._request_count += 1
+        sentinel = f"{self._sentinel_prefix}{self._request_count}"
+        assert process.stdin is not None
+        self._writing = True
+        pump.add_writer(process.stdin, iter([self.protocol.encode_request(request, sentinel)]),
+                        on_finish=self._on_request_written, close_pipe=False)
+
+        stdout_frame: Optional[Tuple[int, int, int]] = None
+        stderr_frame: Optional[Tuple[int, int]] = None
+        stdout_searched = stderr_searched = 0
+        try:
+            while True:
+                if stdout_frame is None:
+                    stdout_frame = self.protocol.parse_stdout(self._stdout, sentinel, stdout_searched)
+                    stdout_searched = len(self._stdout)
+                if stderr_frame is None and self.protocol.stderr_framed:
+                    stderr_frame = self.protocol.parse_stderr(self._stderr, sentinel, stderr_searched)
+                    stderr_searched = len(self._stderr)
+                complete = stdout_frame is not None and (stderr_frame is not None or not self.protocol.stderr_framed)
+                if complete and not self._writing:
+                    break
+                if self._stdout_closed:
+                    self._fail_exited_child(request_args, start_time)
+                pump.poll()
+        except BaseException:
+            # the rest of an interrupted response would be taken for the next one, so the child can not be used anymore
+            # (this also covers a child which exited during the request)
+            self._stop()
+            self._child_lost = True
+            raise
+
+        assert stdout_frame is not None
+        response_length, stdout_frame_length, exit_code = stdout_frame
+        stdout = bytes(self._stdout[:response_length])
+        del self._stdout[:stdout_frame_length]
+        stderr_length, stderr_frame_length = stderr_frame if stderr_frame is not None else (len(self._stderr),) * 2
+        stderr = bytes(self._stderr[:stderr_length])
+        del self._stderr[:stderr_frame_length]
+        execution_stats = ExecutionStats(time.perf_counter() - start_time)
+
+        if check_error_code and exit_code != 0:
+            stdout_text = SubProcessExecution._decode_output(stdout, errors="replace")
+            stderr_text = SubProcessExecution._decode_output(stderr, errors="replace")
+            SubProcessExecution._log_failed_command_output(stdout_text, stderr_text, False)
+            raise SubProcessExecutionException(request_args, exit_code, stdout_text, stderr_text,
+                                               execution_stats=execution_stats)
+        return Result(exit_code=exit_code, stdout=stdout, stderr=stderr, execution_stats=execution_stats)
+
+    def _ensure_started(self) -> Tuple[Process, Pump]:
+        if self._process is not None and self._process.poll() is not None:
+            _logger.debug(f"Restarting session {self.args!r}, which exited with exit code {self._process.returncode}.")
+            self._stop()
+            self._child_lost = True
+        if self._process is None or self._pump is None:
+            if self._child_lost:
+                self._restarts += 1
+                self._child_lost = False
+            SubProcessExecution._log_execute_call(self.args, self.working_directory, self._logging_level)
+            process = ProcessSpawner.start(self.args, self.working_directory, True, environment=self._environment)
+            pump = Pump()
+            assert process.stdout is not None and process.stderr is not None
+            pump.add_reader(process.stdout, self._stdout.extend, self._on_stdout_closed)
+            pump.add_reader(process.stderr, self._stderr.extend)
+            self._process = process
+            self._pump = pump
+        return self._process, self._pump
+
+    def _fail_exited_child(self, request_args: List[str], start_time: float) -> None:
+        # the child closed its stdout without completing the response, so it exited or is about to exit
+        assert self._process is not None and self._pump is not None
+        if self._process.poll() is None:
+            self._process.kill()
+        exit_code = self._process.wait()
+        # the rest of stderr is still read, it likely explains why the child exited
+        while self._pump.active:
+            self._pump.poll()
+        stdout_text = SubProcessExecution._decode_output(bytes(self._stdout), errors="replace")
+        stderr_text = SubProcessExecution._decode_output(bytes(self._stderr), errors="replace")
+        self._stop()
+        SubProcessExecution._log_failed_command_output(stdout_text, stderr_text, False)
+        raise SubProcessExecutionException(request_args, exit_code, stdout_text, stderr_text,
+                                           execution_stats=ExecutionStats(time.perf_counter() - start_time))
+
+    def _stop(self) -> None:
+        process, pump = self._process, self._pump
+        self._process = self._pump = None
+        self._stdout.clear()
+        self._stderr.clear()
+        self._stdout_closed = False
+        self._writing = False
+        if process is None or pump is None:
+            return
+        pump.close()
+        if process.stdin is not None:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+        deadline = time.monotonic() + _CLOSE_TIMEOUT_SECONDS
+        while process.poll() is None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        if process.returncode is None:
+            _logger.debug(f"Killing session {self.args!r}, because it did not exit after closing its input.")
+            process.kill()
+            process.wait()
+
+    def _on_request_written(self) -> None:
+        self._writing = False
+
+    def _on_stdout_closed(self) -> None:
+        self._stdout_closed = True
+
+
+class SubProcessSessionPool:
+    # a fixed number of equal sessions for executing requests in parallel, each request uses a free session
+
+    def __init__(self,
+                 size: int,
+                 args: List[str],
+                 protocol: Optional[SessionProtocol] = None,
+                 working_directory: Optional[Path] = None,
+                 environment: Optional[Dict[str, str]] = None,
+                 logging_level: str = "DEBUG",
+                 check_error_code: bool = True):
+        if size < 1:
+            raise ValueError(f"size must be at least 1, but was {size}")
+        self.size = size
+        self._sessions = [SubProcessSession(args, protocol, working_directory, environment, logging_level,
+                                            check_error_code) for _ in range(size)]
+        self._free_sessions: "queue.Queue[SubProcessSession]" = queue.Queue()
+        for session in self._sessions:
+            self._free_sessions.put(session)
+
+    def execute(self, request: str, check_error_code: Optional[bool] = None) -> Result:
+        session = self._free_sessions.get()
+        try:
+            return session.execute(request, check_error_code)
+        finally:
+            self._free_sessions.put(session)
+
+    def execute_many(self, requests: Iterable[str]) -> List[Result]:
+        # the results are in request order, the first failure is raised after all requests have been executed
+        with ThreadPoolExecutor(max_workers=self.size) as executor:
+            return list(executor.map(self.execute, requests))
+
+    def close(self) -> None:
+        for session in self._sessions:
+            session.close()
+
+    def __enter__(self) -> "SubProcessSessionPool":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
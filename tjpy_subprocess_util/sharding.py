@@ -0,0 +1,64 @@
+import os
+import sys
+
+import struct
+from typing import Generator, Iterable, List, Mapping, Optional
+
+# room for the auxiliary vector and the path of the executable, the same headroom as the one of xargs
+_ARG_MAX_HEADROOM = 2048
+# the minimum required by POSIX, used if the limit of the system can not be queried
+_POSIX_ARG_MAX = 4096
+# Linux limits every single argument to 32 pages in addition to the limit of all arguments
+_LINUX_MAX_ARGUMENT_BYTES = 32 * 4096
+_POINTER_SIZE = struct.calcsize("P")
+
+
+class ArgumentSharder:
+    # packs a large number of arguments into as few command lines as possible (like xargs)
+    # every command line stays below the limit of the system for the size of the arguments and the environment
+
+    @staticmethod
+    def argument_limit(environment: Optional[Mapping[str, str]] = None) -> int:
+        # bytes available for the arguments, environment is the complete environment of the child
+        try:
+            arg_max = os.sysconf("SC_ARG_MAX")
+        except (AttributeError, ValueError, OSError):
+            arg_max = -1
+        if arg_max <= 0:
+            arg_max = _POSIX_ARG_MAX
+        if environment is None:
+            environment = os.environ
+        environment_size = sum(ArgumentSharder.argument_size(f"{name}={value}") for name, value in environment.items())
+        return arg_max - environment_size - _ARG_MAX_HEADROOM
+
+    @staticmethod
+    def argument_size(argument: str) -> int:
+        # the string with its terminating null byte and the pointer to it
+        return len(os.fsencode(argument)) + 1 + _POINTER_SIZE
+
+    @staticmethod
+    def shards(args: List[str],
+               arguments: Iterable[str],
+               environment: Optional[Mapping[str, str]] = None,
+               max_args_per_shard: Optional[int] = None) -> Generator[List[str], None, None]:
+        # yields the args followed by consecutive arguments, the arguments are consumed lazily
+        if max_args_per_shard is not None and max_args_per_shard < 1:
+            raise ValueError(f"max_args_per_shard must be at least 1, but was {max_args_per_shard}")
+        limit = ArgumentSharder.argument_limit(environment)
+        base_size = sum(ArgumentSharder.argument_size(argument) for argument in args)
+        shard = list(args)
+        shard_size = base_size
+        for argument in arguments:
+            size = ArgumentSharder.argument_size(argument)
+            if base_size + size > limit or (sys.platform.startswith("linux") and size > _LINUX_MAX_ARGUMENT_BYTES):
+                raise ValueError(f"Argument {argument[:100]!r} with {size} bytes does not fit into a command line")
+            shard_full = shard_size + size > limit or \
+                (max_args_per_shard is not None and len(shard) - len(args) >= max_args_per_shard)
+            if shard_full:
+                yield shard
+                shard = list(args)
+                shard_size = base_size
+            shard.append(argument)
+            shard_size += size
+        if len(shard) > len(args):
+            yield shard
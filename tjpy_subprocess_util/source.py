@@ -0,0 +1,63 @@
+import mmap
+from pathlib import Path
+from typing import Any, Generator, IO, Iterable, Iterator, Union
+
+from tjpy_subprocess_util.pump import ChunkFeeder
+
+_CHUNK_SIZE = 64 * 1024
+
+# everything that can be given as custom_input, it is written to stdin incrementally chunk by chunk:
+# - str (encoded as utf-8 chunk by chunk, so there is never a second full copy of the input)
+# - bytes-like objects and mmaps (written without copying)
+# - paths of files and binary or text file objects (read chunk by chunk, file objects are not closed)
+# - iterables of bytes or str chunks, e.g. generators
+# file objects and iterables are read on a thread of their own (or in the default executor of the event loop), so a
+# slow producer never holds back the output of the command
+CustomInput = Union[str, bytes, bytearray, memoryview, mmap.mmap, Path, IO[Any], Iterable[Union[bytes, str]]]
+
+
+class InputSource:
+
+    @staticmethod
+    def chunks(custom_input: CustomInput) -> Generator[Union[bytes, memoryview], None, None]:
+        if isinstance(custom_input, str):
+            yield from InputSource._text_chunks(custom_input)
+        elif isinstance(custom_input, (bytes, bytearray, memoryview, mmap.mmap)):
+            yield memoryview(custom_input)
+        elif isinstance(custom_input, Path):
+            with custom_input.open("rb") as file:
+                yield from InputSource._file_chunks(file)
+        elif hasattr(custom_input, "read"):
+            yield from InputSource._file_chunks(custom_input)  # type: ignore
+        else:
+            for chunk in custom_input:
+                if isinstance(chunk, str):
+                    yield from InputSource._text_chunks(chunk)
+                else:
+                    yield chunk
+
+    @staticmethod
+    def pumped_chunks(custom_input: CustomInput) -> Union[Iterator[Union[bytes, memoryview]], ChunkFeeder]:
+        # the chunks for a pump, inputs which are in memory or in a file are produced right away by the pump
+        chunks = InputSource.chunks(custom_input)
+        return chunks if InputSource.is_reusable(custom_input) else ChunkFeeder(chunks)
+
+    @staticmethod
+    def is_reusable(custom_input: CustomInput) -> bool:
+        # inputs which can be written to several commands, e.g. to all commands of execute_many
+        return isinstance(custom_input, (str, bytes, bytearray, memoryview, mmap.mmap, Path))
+
+    @staticmethod
+    def _text_chunks(text: str) -> Generator[bytes, None, None]:
+        for offset in range(0, len(text), _CHUNK_SIZE):
+            yield text[offset:offset + _CHUNK_SIZE].encode("utf-8")
+
+    @staticmethod
+    def _file_chunks(file: IO[Any]) -> Generator[bytes, None, None]:
+        # read1 returns the data which is available instead of waiting for a full chunk, e.g. from a pipe or a socket
+        read = getattr(file, "read1", file.read)
+        while True:
+            chunk = read(_CHUNK_SIZE)
+            if len(chunk) == 0:
+                return
+            yield chunk.encode("utf-8") if isinstance(chunk, str) else chunk
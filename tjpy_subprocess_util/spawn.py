@@ -0,0 +1,265 @@
+import os
+import sys
+
+import logging
+import shutil
+import signal
+import subprocess
+import time
+from pathlib import Path
+from typing import Any, IO, List, Mapping, Optional, Tuple, Union
+
+from tjpy_subprocess_util.exception import SubProcessStartException
+from tjpy_subprocess_util.limits import ResourceLimits
+
+_logger = logging.getLogger(__name__)
+
+SPAWN_BACKEND_SUBPROCESS = "subprocess"
+# uses os.posix_spawnp (vfork-like on Linux) if the options allow it, otherwise falls back to subprocess
+SPAWN_BACKEND_POSIX_SPAWN = "posix_spawn"
+# lists the open file descriptors of this process, which posix_spawn has to close in the child
+_FD_DIRECTORY = "/proc/self/fd" if os.path.isdir("/proc/self/fd") else "/dev/fd"
+
+
+class SpawnedProcess:
+    # minimal counterpart of subprocess.Popen for sub-processes started with os.posix_spawnp
+
+    def __init__(self,
+                 args: List[str],
+                 pid: int,
+                 stdin: Optional[IO[bytes]],
+                 stdout: Optional[IO[bytes]],
+                 stderr: Optional[IO[bytes]]):
+        self.args = args
+        self.pid = pid
+        self.stdin = stdin
+        self.stdout = stdout
+        self.stderr = stderr
+        self.returncode: Optional[int] = None
+        self.spawn_latency_seconds: Optional[float] = None
+        self.resource_usage: Any = None
+
+    def wait(self) -> int:
+        if self.returncode is None:
+            _, status, self.resource_usage = os.wait4(self.pid, 0)
+            self.returncode = ProcessSpawner.exit_code_from_wait_status(status)
+        return self.returncode
+
+    def poll(self) -> Optional[int]:
+        if self.returncode is None:
+            pid, status, resource_usage = os.wait4(self.pid, os.WNOHANG)
+            if pid == self.pid:
+                self.resource_usage = resource_usage
+                self.returncode = ProcessSpawner.exit_code_from_wait_status(status)
+        return self.returncode
+
+    def kill(self) -> None:
+        if self.returncode is None:
+            os.kill(self.pid, signal.SIGKILL)
+
+
+class ResourceUsagePopen(subprocess.Popen):
+    # subprocess.Popen, which reaps the child with os.wait4 to also get the resource usage of the child
+    # the blocking waits of Popen (also the one of communicate) all use _try_wait
+    spawn_latency_seconds: Optional[float] = None
+    resource_usage: Any = None
+
+    def _try_wait(self, wait_flags):
+        if not hasattr(os, "wait4"):
+            return super()._try_wait(wait_flags)  # type: ignore
+        try:
+            pid, status, resource_usage = os.wait4(self.pid, wait_flags)
+        except ChildProcessError:
+            # same as subprocess, the child has already been reaped by someone else
+            return self.pid, 0
+        if pid == self.pid:
+            self.resource_usage = resource_usage
+        return pid, status
+
+    def poll(self) -> Optional[int]:
+        # Popen.poll reaps with os.waitpid, a wait with a timeout uses _try_wait
+        if self.returncode is None:
+            try:
+                return self.wait(timeout=0)
+            except subprocess.TimeoutExpired:
+                return None
+        return self.returncode
+
+
+Process = Union[ResourceUsagePopen, SpawnedProcess]
+
+
+class ProcessSpawner:
+
+    @staticmethod
+    def start(args: List[str],
+              working_directory: Optional[Path],
+              pipe_input: bool,
+              pipe_output: bool = True,
+              spawn_backend: str = SPAWN_BACKEND_SUBPROCESS,
+              stdout_file: Optional[int] = None,
+              environment: Optional[Mapping[str, str]] = None,
+              limits: Optional[ResourceLimits] = None,
+              executable: Optional[str] = None,
+              limits_prefix: Optional[List[str]] = None) -> Process:
+        # with stdout_file (a file descriptor), stdout is redirected to it and only stderr is piped
+        # environment is the complete environment of the child, by default the one of this process
+        # the limits are applied by exec shims in front of the command, the process keeps the args without them
+        # executable is the program to execute instead of args[0], which is then only passed as argv[0] (like Popen)
+        # limits_prefix is the command prefix of the limits if it has already been computed
+        if spawn_backend not in (SPAWN_BACKEND_SUBPROCESS, SPAWN_BACKEND_POSIX_SPAWN):
+            raise ValueError(f"Unknown spawn backend {spawn_backend}")
+        if limits_prefix is not None:
+            command_prefix = limits_prefix
+        else:
+            command_prefix = limits.command_prefix() if limits is not None else []
+        spawn_args = list(args)
+        if len(command_prefix) != 0:
+            # a missing command would only be reported by the shim as exit code 127
+            ProcessSpawner._check_executable(args, working_directory, environment, executable)
+            # the shims execute the command by its args, so the executable also becomes its argv[0]
+            if executable is not None:
+                spawn_args[0] = executable
+                executable = None
+            spawn_args = command_prefix + spawn_args
+        start_time = time.perf_counter()
+        process: Process
+        try:
+            if spawn_backend == SPAWN_BACKEND_POSIX_SPAWN and ProcessSpawner.posix_spawn_possible(working_directory):
+                process = ProcessSpawner._posix_spawn(spawn_args, pipe_input, pipe_output, stdout_file, environment,
+                                                      executable)
+            else:
+                stdin: Union[None, int, IO[Any]] = subprocess.PIPE if pipe_input else sys.stdin
+                stdout: Union[None, int, IO[Any]] = subprocess.PIPE if pipe_output else sys.stdout
+                process = ResourceUsagePopen(
+                    spawn_args,
+                    cwd=working_directory,
+                    stdout=stdout_file if stdout_file is not None else stdout,
+                    stderr=subprocess.PIPE if pipe_output else sys.stderr,
+                    stdin=stdin,
+                    env=environment,
+                    executable=executable
+                )
+        except (OSError, subprocess.SubprocessError) as sub_process_error:
+            raise SubProcessStartException(list(args)) from sub_process_error
+        # both backends only return after the command has been executed in the child (or failed to)
+        process.spawn_latency_seconds = time.perf_counter() - start_time
+        process.args = list(args)
+        return process
+
+    @staticmethod
+    def _check_executable(args: List[str],
+                          working_directory: Optional[Path],
+                          environment: Optional[Mapping[str, str]],
+                          executable: Optional[str] = None) -> None:
+        if executable is None:
+            executable = args[0] if len(args) != 0 else ""
+        if os.sep in executable:
+            found = os.access(Path(working_directory or ".") / executable, os.X_OK)
+        else:
+            search_path = (environment if environment is not None else os.environ).get("PATH")
+            found = shutil.which(executable, path=search_path) is not None
+        if not found:
+            raise SubProcessStartException(list(args)) from FileNotFoundError(f"No such executable: {executable!r}")
+
+    @staticmethod
+    def posix_spawn_possible(working_directory: Optional[Path]) -> bool:
+        # posix_spawn can not change the working directory of the child
+        # and it can only close the inherited file descriptors (like close_fds of subprocess) if they can be listed
+        return hasattr(os, "posix_spawnp") and working_directory is None and os.path.isdir(_FD_DIRECTORY)
+
+    @staticmethod
+    def exit_code_from_wait_status(status: int) -> int:
+        # same convention as subprocess, a negative exit code is the number of the signal that killed the child
+        if os.WIFSIGNALED(status):
+            return -os.WTERMSIG(status)
+        return os.WEXITSTATUS(status)
+
+    @staticmethod
+    def _posix_spawn(args: List[str],
+                     pipe_input: bool,
+                     pipe_output: bool,
+                     stdout_file: Optional[int] = None,
+                     environment: Optional[Mapping[str, str]] = None,
+                     executable: Optional[str] = None) -> SpawnedProcess:
+        # the ends of the pipes used by the child are closed in the parent as soon as the child has been spawned
+        # all pipes are created non-inheritable, dup2 in the child makes only the standard streams inheritable
+        parent_ends: List[int] = []
+        child_ends: List[int] = []
+        file_actions: List[Tuple[int, ...]] = []
+        stdin = stdout = stderr = None
+        try:
+            if pipe_input:
+                stdin_read, stdin_write = os.pipe()
+                parent_ends.append(stdin_write)
+                child_ends.append(stdin_read)
+                file_actions.append((os.POSIX_SPAWN_DUP2, stdin_read, 0))
+            else:
+                ProcessSpawner._inherit_stream(sys.stdin, 0, file_actions)
+            if pipe_output:
+                if stdout_file is not None:
+                    file_actions.append((os.POSIX_SPAWN_DUP2, stdout_file, 1))
+                else:
+                    stdout_read, stdout_write = os.pipe()
+                    parent_ends.append(stdout_read)
+                    child_ends.append(stdout_write)
+                    file_actions.append((os.POSIX_SPAWN_DUP2, stdout_write, 1))
+                stderr_read, stderr_write = os.pipe()
+                parent_ends.append(stderr_read)
+                child_ends.append(stderr_write)
+                file_actions.append((os.POSIX_SPAWN_DUP2, stderr_write, 2))
+            else:
+                ProcessSpawner._inherit_stream(sys.stdout, 1, file_actions)
+                ProcessSpawner._inherit_stream(sys.stderr, 2, file_actions)
+
+            # same as restore_signals of subprocess, signals ignored by python must not stay ignored in the child
+            reset_signals = [getattr(signal, name) for name in ("SIGPIPE", "SIGXFZ", "SIGXFSZ")
+                             if hasattr(signal, name)]
+            # same as close_fds of subprocess, otherwise e.g. a leaked write end of a pipe would keep its reader from
+            # ever getting the end of file, the closes come after the dup2s, which might use these descriptors
+            file_actions += [(os.POSIX_SPAWN_CLOSE, fd) for fd in ProcessSpawner._inheritable_fds()]
+            pid = os.posix_spawnp(executable if executable is not None else args[0], args,
+                                  environment if environment is not None else os.environ,
+                                  file_actions=file_actions,
+                                  setsigdef=reset_signals)
+        except BaseException:
+            for fd in parent_ends:
+                os.close(fd)
+            raise
+        finally:
+            for fd in child_ends:
+                os.close(fd)
+
+        if pipe_input:
+            stdin = open(stdin_write, "wb", buffering=0)
+        if pipe_output:
+            if stdout_file is None:
+                stdout = open(stdout_read, "rb", buffering=0)
+            stderr = open(stderr_read, "rb", buffering=0)
+        return SpawnedProcess(args, pid, stdin, stdout, stderr)
+
+    @staticmethod
+    def _inheritable_fds() -> List[int]:
+        # the inheritable file descriptors above the standard streams
+        inheritable_fds = []
+        for fd_name in os.listdir(_FD_DIRECTORY):
+            fd = int(fd_name)
+            if fd <= 2:
+                continue
+            try:
+                if os.get_inheritable(fd):
+                    inheritable_fds.append(fd)
+            except OSError:
+                # already closed again, e.g. the descriptor of the listing itself
+                pass
+        return inheritable_fds
+
+    @staticmethod
+    def _inherit_stream(stream: Optional[IO], target_fd: int, file_actions: list) -> None:
+        # subprocess uses the file descriptor of the python stream, which is not always the standard one
+        try:
+            fd = stream.fileno() if stream is not None else target_fd
+        except (AttributeError, OSError, ValueError):
+            fd = target_fd
+        if fd != target_fd:
+            file_actions.append((os.POSIX_SPAWN_DUP2, fd, target_fd))
@@ -0,0 +1,141 @@
+import codecs
+import json
+from typing import Any, List, Optional
+
+_WHITESPACE = " \t\n\r"
+_WHITESPACE_BYTES = b" \t\n\r"
+_NUMBER_DELIMITERS = _WHITESPACE + ",]"
+
+
+class JsonLinesParser:
+    # parses JSON Lines chunk by chunk, every line is parsed from its bytes as soon as it is complete
+    # empty lines are skipped, a JSONDecodeError is raised for the first invalid line
+
+    def __init__(self) -> None:
+        self._incomplete_line = bytearray()
+        # the number of the last line that has been parsed, starting at 1
+        self.line_number = 0
+
+    def feed(self, data: bytes) -> List[Any]:
+        last_line_break = data.rfind(b"\n")
+        if last_line_break == -1:
+            self._incomplete_line += data
+            return []
+        self._incomplete_line += data[:last_line_break]
+        lines = self._incomplete_line.split(b"\n")
+        self._incomplete_line = bytearray(data[last_line_break + 1:])
+        records: List[Any] = []
+        for line in lines:
+            self._parse_line(line, records)
+        return records
+
+    def finish(self) -> List[Any]:
+        records: List[Any] = []
+        self._parse_line(self._incomplete_line, records)
+        self._incomplete_line = bytearray()
+        return records
+
+    def _parse_line(self, line: bytearray, records: List[Any]) -> None:
+        self.line_number += 1
+        if len(line.strip(_WHITESPACE_BYTES)) != 0:
+            records.append(json.loads(bytes(line)))
+
+
+class JsonDocumentParser:
+    # parses a single JSON document chunk by chunk
+    # the elements of a top-level array are parsed as soon as they are complete, so only the text of the element
+    # being written is kept in addition to the parsed elements, any other document is parsed once it is complete
+    # an incomplete element is parsed again only when its text doubled, which keeps the parsing time linear
+
+    def __init__(self) -> None:
+        self._mode: Optional[str] = None
+        self._raw_document = bytearray()
+        self._text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self._json_decoder = json.JSONDecoder()
+        self._pending_parts: List[str] = []
+        self._pending_length = 0
+        self._retry_length = 0
+        # within the array: "element" (after "[" or ","), "separator" (after an element) or "end" (after "]")
+        self._array_state = "element"
+        self._after_comma = False
+        self._elements: List[Any] = []
+
+    def feed(self, data: bytes) -> List[Any]:
+        # returns the elements of a top-level array which have been completed by the data
+        if self._mode is None:
+            stripped_data = data.lstrip(_WHITESPACE_BYTES)
+            if len(stripped_data) == 0:
+                return []
+            self._mode = "array" if stripped_data.startswith(b"[") else "document"
+            if self._mode == "array":
+                data = stripped_data[1:]
+        if self._mode == "document":
+            self._raw_document += data
+            return []
+        return self._feed_text(self._text_decoder.decode(data), False)
+
+    def finish(self) -> Any:
+        # returns the parsed document, the list of all elements for a top-level array
+        if self._mode is None:
+            raise json.JSONDecodeError("Expecting value", "", 0)
+        if self._mode == "document":
+            raw_document = bytes(self._raw_document)
+            self._raw_document = bytearray()
+            return json.loads(raw_document)
+        self._feed_text(self._text_decoder.decode(b"", True), True)
+        if self._array_state != "end":
+            raise json.JSONDecodeError("Expecting ']' at the end of the array", "".join(self._pending_parts), 0)
+        return self._elements
+
+    def _feed_text(self, text: str, final: bool) -> List[Any]:
+        self._pending_parts.append(text)
+        self._pending_length += len(text)
+        if self._pending_length < self._retry_length and not final:
+            return []
+        pending_text = "".join(self._pending_parts)
+        offset = 0
+        completed_elements: List[Any] = []
+        while True:
+            while offset < len(pending_text) and pending_text[offset] in _WHITESPACE:
+                offset += 1
+            if offset == len(pending_text):
+                break
+            if self._array_state == "end":
+                raise json.JSONDecodeError("Extra data after the array", pending_text, offset)
+            elif self._array_state == "separator":
+                if pending_text[offset] == ",":
+                    self._array_state = "element"
+                    self._after_comma = True
+                elif pending_text[offset] == "]":
+                    self._array_state = "end"
+                else:
+                    raise json.JSONDecodeError("Expecting ',' delimiter", pending_text, offset)
+                offset += 1
+            elif pending_text[offset] == "]" and not self._after_comma:
+                self._array_state = "end"
+                offset += 1
+            else:
+                try:
+                    element, end = self._json_decoder.raw_decode(pending_text, offset)
+                except json.JSONDecodeError:
+                    if final:
+                        raise
+                    # most likely the element is still incomplete
+                    self._retry_length = 2 * (len(pending_text) - offset)
+                    break
+                number_might_continue = isinstance(element, (int, float)) and not isinstance(element, bool) and \
+                    (end == len(pending_text) or pending_text[end] not in _NUMBER_DELIMITERS)
+                if number_might_continue and not final:
+                    # e.g. "-1." has been parsed as -1, the rest of the number is still to come
+                    self._retry_length = len(pending_text) - offset + 1
+                    break
+                completed_elements.append(element)
+                self._array_state = "separator"
+                self._after_comma = False
+                self._retry_length = 0
+                offset = end
+        remaining_text = pending_text[offset:]
+        self._pending_parts = [remaining_text] if len(remaining_text) != 0 else []
+        self._pending_length = len(remaining_text)
+        self._elements.extend(completed_elements)
+        return completed_elements
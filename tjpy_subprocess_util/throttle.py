@@ -0,0 +1,245 @@
+import os
+
+import collections
+import contextlib
+import logging
+import statistics
+import threading
+import time
+from typing import Callable, Deque, Iterator, List, Optional, TypeVar
+
+_logger = logging.getLogger(__name__)
+
+_MEMINFO_PATH = "/proc/meminfo"
+# latencies per command, whose median is its current latency
+_LATENCY_SAMPLES = 16
+# medians of the past adjustments per command, the lowest of them is the baseline of the command
+_BASELINE_MEDIANS = 60
+# commands whose latency is tracked, the least recently completed ones are forgotten
+_MAX_TRACKED_COMMANDS = 1024
+
+_T = TypeVar("_T")
+
+
+class LimiterDecision:
+    # a change of the limit of an AdaptiveLimiter together with the measurements it is based on
+
+    def __init__(self,
+                 timestamp: float,
+                 previous_limit: int,
+                 limit: int,
+                 reason: str,
+                 load_per_cpu: Optional[float],
+                 available_memory_ratio: Optional[float],
+                 latency_ratio: Optional[float]):
+        self.timestamp = timestamp
+        self.previous_limit = previous_limit
+        self.limit = limit
+        # one of "load", "memory", "latency" (decreased) or "saturated" (increased)
+        self.reason = reason
+        self.load_per_cpu = load_per_cpu
+        self.available_memory_ratio = available_memory_ratio
+        self.latency_ratio = latency_ratio
+
+    def __repr__(self) -> str:
+        return f"LimiterDecision({', '.join(f'{name}={value!r}' for name, value in vars(self).items())})"
+
+
+class _CommandLatency:
+    # recent latencies of one command and its median latencies at past adjustments
+
+    def __init__(self) -> None:
+        self.latencies: Deque[float] = collections.deque(maxlen=_LATENCY_SAMPLES)
+        self.medians: Deque[float] = collections.deque(maxlen=_BASELINE_MEDIANS)
+        self.completed_since_adjustment = False
+
+
+class AdaptiveLimiter:
+    # limits the number of commands in flight, the limit is adapted AIMD-style (like TCP congestion control):
+    # it is halved if the host is overloaded and increased by one if all slots are used and the host is fine
+    # the host counts as overloaded if one of the following is true:
+    # - the 1-minute load average per CPU is above target_load_per_cpu
+    # - less than min_available_memory_ratio of the memory is available (MemAvailable in /proc/meminfo)
+    # - the recent latency of a command is more than latency_tolerance times the lowest recent latency of the same
+    #   command, every command (for execute_many and the scheduler its executable, see command_name) is only compared
+    #   with its own history and the median of its latencies is used, so a mix of fast and slow commands is no overload
+    # measurements which are not available on the platform are ignored
+    # the limit is adapted at most once per adjust_interval_seconds, when a command completes
+    # a single limiter can be shared by all parallel paths (execute_many, the scheduler, ...), the limit then holds for
+    # the commands of all of them together
+
+    def __init__(self,
+                 min_limit: int = 1,
+                 max_limit: Optional[int] = None,
+                 initial_limit: Optional[int] = None,
+                 target_load_per_cpu: float = 1.0,
+                 min_available_memory_ratio: float = 0.1,
+                 latency_tolerance: float = 2.0,
+                 adjust_interval_seconds: float = 1.0,
+                 decrease_factor: float = 0.5,
+                 max_decisions: int = 100):
+        cpu_count = os.cpu_count() or 1
+        self.min_limit = min_limit
+        self.max_limit = max_limit if max_limit is not None else 2 * cpu_count
+        if not 1 <= self.min_limit <= self.max_limit:
+            raise ValueError(f"limits must fulfill 1 <= min_limit <= max_limit, but were {min_limit} and {max_limit}")
+        initial_limit = initial_limit if initial_limit is not None else cpu_count
+        self._limit = min(max(initial_limit, self.min_limit), self.max_limit)
+        self._cpu_count = cpu_count
+        self._target_load_per_cpu = target_load_per_cpu
+        self._min_available_memory_ratio = min_available_memory_ratio
+        self._latency_tolerance = latency_tolerance
+        self._adjust_interval_seconds = adjust_interval_seconds
+        self._decrease_factor = decrease_factor
+
+        self._condition = threading.Condition()
+        self._in_flight = 0
+        self._saturated = False
+        self._last_adjustment = time.monotonic()
+        self._command_latencies: "collections.OrderedDict[str, _CommandLatency]" = collections.OrderedDict()
+        self._decisions: Deque[LimiterDecision] = collections.deque(maxlen=max_decisions)
+
+    @property
+    def limit(self) -> int:
+        return self._limit
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    @property
+    def decisions(self) -> List[LimiterDecision]:
+        with self._condition:
+            return list(self._decisions)
+
+    def acquire(self, timeout: Optional[float] = None) -> bool:
+        # blocks until a slot is free, returns False if no slot became free within the timeout
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self._condition:
+            while self._in_flight >= self._limit:
+                self._saturated = True
+                remaining_seconds = deadline - time.monotonic() if deadline is not None else None
+                if remaining_seconds is not None and remaining_seconds <= 0:
+                    return False
+                self._condition.wait(remaining_seconds)
+            self._in_flight += 1
+            if self._in_flight >= self._limit:
+                self._saturated = True
+            return True
+
+    def release(self, latency_seconds: Optional[float] = None, command: str = "") -> None:
+        # the latency is only compared with earlier latencies of the same command
+        with self._condition:
+            self._in_flight -= 1
+            self._record(latency_seconds, command)
+            self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self, command: str = "") -> Iterator[None]:
+        # measures the latency of the block itself
+        self.acquire()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.release(time.perf_counter() - start, command)
+
+    def releasing(self, function: Callable[..., _T], command: Optional[Callable[..., str]] = None) -> Callable[..., _T]:
+        # for a slot acquired by the caller, e.g. before submitting the function to a thread pool:
+        # the returned function calls the function and releases the slot afterwards with its latency
+        # command determines the command of the latency from the arguments of the function
+        def call_and_release(*args, **kwargs) -> _T:
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.release(time.perf_counter() - start, command(*args, **kwargs) if command is not None else "")
+        return call_and_release
+
+    def _record(self, latency_seconds: Optional[float], command: str) -> None:
+        if latency_seconds is not None:
+            command_latency = self._command_latencies.get(command)
+            if command_latency is None:
+                command_latency = self._command_latencies[command] = _CommandLatency()
+                if len(self._command_latencies) > _MAX_TRACKED_COMMANDS:
+                    self._command_latencies.popitem(last=False)
+            else:
+                self._command_latencies.move_to_end(command)
+            command_latency.latencies.append(latency_seconds)
+            command_latency.completed_since_adjustment = True
+        now = time.monotonic()
+        if now - self._last_adjustment >= self._adjust_interval_seconds:
+            self._last_adjustment = now
+            self._adjust(now)
+
+    def _adjust(self, now: float) -> None:
+        load_per_cpu = AdaptiveLimiter._load_per_cpu(self._cpu_count)
+        available_memory_ratio = AdaptiveLimiter._available_memory_ratio()
+        latency_ratio = self._latency_ratio()
+
+        reason = None
+        if load_per_cpu is not None and load_per_cpu > self._target_load_per_cpu:
+            reason = "load"
+        elif available_memory_ratio is not None and available_memory_ratio < self._min_available_memory_ratio:
+            reason = "memory"
+        elif latency_ratio is not None and latency_ratio > self._latency_tolerance:
+            reason = "latency"
+            # the increased latency is the new normal after a decrease, otherwise it would be decreased again
+            for command_latency in self._command_latencies.values():
+                command_latency.medians.clear()
+        elif self._saturated:
+            reason = "saturated"
+        self._saturated = False
+        if reason is None:
+            return
+
+        previous_limit = self._limit
+        if reason == "saturated":
+            self._limit = min(self._limit + 1, self.max_limit)
+        else:
+            self._limit = max(int(self._limit * self._decrease_factor), self.min_limit)
+        if self._limit != previous_limit:
+            decision = LimiterDecision(now, previous_limit, self._limit, reason,
+                                       load_per_cpu, available_memory_ratio, latency_ratio)
+            self._decisions.append(decision)
+            _logger.debug(f"Adapted concurrency limit: {decision}")
+
+    def _latency_ratio(self) -> Optional[float]:
+        # the highest ratio of the current to the lowest recent median latency among the commands which completed
+        # since the last adjustment
+        latency_ratio = None
+        for command_latency in self._command_latencies.values():
+            if not command_latency.completed_since_adjustment:
+                continue
+            command_latency.completed_since_adjustment = False
+            median_latency = statistics.median(command_latency.latencies)
+            command_latency.medians.append(median_latency)
+            lowest_latency = min(command_latency.medians)
+            if lowest_latency > 0:
+                command_ratio = median_latency / lowest_latency
+                latency_ratio = command_ratio if latency_ratio is None else max(latency_ratio, command_ratio)
+        return latency_ratio
+
+    @staticmethod
+    def command_name(args: List[str]) -> str:
+        # the command of the latency of executing the args, commands are compared by their executable
+        return os.path.basename(args[0]) if len(args) != 0 else ""
+
+    @staticmethod
+    def _load_per_cpu(cpu_count: int) -> Optional[float]:
+        try:
+            return os.getloadavg()[0] / cpu_count
+        except (AttributeError, OSError):
+            return None
+
+    @staticmethod
+    def _available_memory_ratio() -> Optional[float]:
+        try:
+            with open(_MEMINFO_PATH, "r") as meminfo:
+                values = {}
+                for line in meminfo:
+                    name, _, value = line.partition(":")
+                    values[name] = value
+            return int(values["MemAvailable"].split()[0]) / int(values["MemTotal"].split()[0])
+        except (OSError, KeyError, ValueError, ZeroDivisionError):
+            return None
@@ -0,0 +1,51 @@
+import json
+import socket
+import struct
+from typing import Any, Optional, Tuple, Union
+
+
+class FrameStream:
+    # length-prefixed frames with a single byte type over a stream socket
+    # used to talk to helper processes, payloads are either raw output chunks or small json documents
+
+    _HEADER = struct.Struct("!cI")
+
+    def __init__(self, connection: socket.socket) -> None:
+        self._connection = connection
+        self._reader = connection.makefile("rb")
+
+    def send(self, frame_type: bytes, payload: Union[bytes, memoryview] = b"") -> None:
+        self._connection.sendall(self._HEADER.pack(frame_type, len(payload)))
+        if len(payload) != 0:
+            self._connection.sendall(payload)
+
+    def send_json(self, frame_type: bytes, value: Any) -> None:
+        self.send(frame_type, json.dumps(value).encode("utf-8"))
+
+    def receive(self) -> Optional[Tuple[bytes, bytes]]:
+        # returns None if the other side closed the connection between two frames
+        header = self._reader.read(self._HEADER.size)
+        if len(header) == 0:
+            return None
+        if len(header) != self._HEADER.size:
+            raise ConnectionError("Connection has been closed in the middle of a frame.")
+        frame_type, payload_length = self._HEADER.unpack(header)
+        payload = self._reader.read(payload_length) if payload_length != 0 else b""
+        if len(payload) != payload_length:
+            raise ConnectionError("Connection has been closed in the middle of a frame.")
+        return frame_type, payload
+
+    @staticmethod
+    def decode_json(payload: bytes) -> Any:
+        return json.loads(payload.decode("utf-8"))
+
+    def shutdown_sending(self) -> None:
+        self._connection.shutdown(socket.SHUT_WR)
+
+    def shutdown(self) -> None:
+        # ends both directions, also a receive blocked in another thread returns
+        self._connection.shutdown(socket.SHUT_RDWR)
+
+    def close(self) -> None:
+        self._reader.close()
+        self._connection.close()